@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark the bytes tarred over a replayed run with and without
+--dedup-content in files/dx_sync_directory.py.
+
+The run is replayed one cycle at a time: each cycle writes new CBCL
+files, rewrites the run's parameter and config files with the same
+content (as instrument software does when it touches them), and appends
+to a few InterOp files, whose content does change. After each cycle a
+sync finds the files to upload and tars them, as an invocation of
+dx_sync_directory.py would, without uploading anything.
+
+    $ python3 benchmarks/bench_dedup_content.py --cycles 50 --static-files 40
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+import dx_sync_directory as dsd
+
+
+# Time the replayed run starts at, each cycle a minute later
+START = 1.7e9
+
+
+def write(path, data, mtime) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    os.utime(path, (mtime, mtime))
+
+
+def replay_cycle(run_dir, cycle, args) -> None:
+    """Write the files of one cycle, with mtimes a minute apart"""
+    mtime = START + cycle * 60
+
+    for lane in range(1, args.lanes + 1):
+        write(os.path.join(run_dir, "Data/Intensities/BaseCalls", f"L00{lane}",
+                           f"C{cycle}.1", f"L00{lane}_1.cbcl"),
+              os.urandom(args.cbcl_kb * 1024), mtime)
+
+    # rewritten unchanged every cycle, the same content each time
+    for i in range(args.static_files):
+        name = "RunParameters.xml" if i == 0 else f"Config/Settings{i}.cfg"
+        write(os.path.join(run_dir, name),
+              (b"<setting id='%d'/>\n" % i) * (args.static_kb * 50), mtime)
+
+    # InterOp metrics grow every cycle
+    for name in ("ExtractionMetricsOut.bin", "QMetricsOut.bin"):
+        path = os.path.join(run_dir, "InterOp", name)
+        data = b""
+        if os.path.exists(path):
+            with open(path, "rb") as fh:
+                data = fh.read()
+        write(path, data + os.urandom(4096), mtime)
+
+
+def sync(run_dir, tmp, dedup, bench_args) -> dict:
+    """Sync after each cycle, returning the bytes and files tarred"""
+    argv = ["--tar-destination", "project-xxxx:/runs", "--log-file",
+            os.path.join(tmp, "sync.log"), "--prefix", "run.lane.all",
+            "--tar-directory", os.path.join(tmp, "tars"), "--codec", "none",
+            "--auth-token", "token", "--finish", run_dir]
+    if dedup:
+        argv.insert(0, "--dedup-content")
+
+    os.makedirs(os.path.join(tmp, "tars"))
+    args = dsd.check_inputs(dsd.parse_args(argv))
+    log = dsd.read_log(args)
+
+    totals = {"files": 0, "tarred MB": 0.0, "scan s": 0.0}
+    for cycle in range(1, bench_args.cycles + 1):
+        replay_cycle(run_dir, cycle, bench_args)
+
+        start = time.perf_counter()
+        files_to_upload = dsd.get_files_to_upload(log, args)
+        totals["scan s"] += time.perf_counter() - start
+
+        for tar in dsd.split_into_tar_files(files_to_upload, log, args):
+            tar_path = os.path.join(args.tar_directory, dsd.get_tar_filename(log, args))
+            log = dsd.record_tar_file(tar_path, *dsd.build_tar_file(tar, tar_path, args),
+                                      log, args)
+            totals["files"] += len(tar["files"])
+            totals["tarred MB"] += os.path.getsize(tar_path) / 2**20
+            os.remove(tar_path)
+
+    args.state.close()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=50,
+        help="Number of cycles to replay (default %(default)s)")
+    parser.add_argument("--lanes", type=int, default=2,
+        help="Number of lanes, one CBCL file each per cycle (default %(default)s)")
+    parser.add_argument("--cbcl-kb", type=int, default=512,
+        help="Size of each CBCL file in KB (default %(default)s)")
+    parser.add_argument("--static-files", type=int, default=40,
+        help="Number of files rewritten unchanged every cycle (default %(default)s)")
+    parser.add_argument("--static-kb", type=int, default=64,
+        help="Approximate size of each of those files in KB (default %(default)s)")
+    bench_args = parser.parse_args()
+
+    results = []
+    for dedup in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            run_dir = os.path.join(tmp, "run")
+            os.mkdir(run_dir)
+            # keep the sync's own progress out of the results
+            stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+            try:
+                totals = sync(run_dir, tmp, dedup, bench_args)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            results.append(("dedup" if dedup else "mtime", totals))
+
+    print(f"{bench_args.cycles} cycles, {bench_args.static_files} files rewritten "
+          f"unchanged each cycle")
+    print(f"{'check':<8}{'files':>10}{'tarred MB':>12}{'scan s':>10}")
+    for name, totals in results:
+        print(f"{name:<8}{totals['files']:>10}{totals['tarred MB']:>12.1f}"
+              f"{totals['scan s']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
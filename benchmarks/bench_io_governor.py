@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Benchmark the effect of --gentle-io and --yield-to-writes in
+files/dx_sync_directory.py on an instrument writing to the same disk.
+
+A synthetic instrument process writes 1 MB chunks to the disk in
+bursts at a set rate, as cycles are written out, syncing each to disk
+as RTA does its output, whilst a tar file is built from a run directory
+of incompressible files (dropped from the page cache beforehand, so
+they are read from disk). For each setting the table gives how long the
+tar file took to build and was paused for, the instrument's write
+latency and throughput, and how much of the run directory was left in
+the page cache, having evicted whatever was cached before.
+
+--yield-to-writes only has an effect when the benchmark directory is on
+a local block device listed in /proc/diskstats. Whilst the tar file
+being written to the same disk is flushed, the instrument's writes are
+put down to it, so give --tar-dir on another disk (or tmpfs) to see
+reading yield as it would with tar files kept apart from the run.
+
+    $ python3 benchmarks/bench_io_governor.py --run-mb 1024 --write-mb-s 40 --dir /data/bench
+"""
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+import dx_sync_directory as dsd
+
+
+CHUNK = 2**20
+
+
+def get_cached(paths) -> int:
+    """Bytes of the given files in the page cache"""
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    cached = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        pages = -(-size // mmap.PAGESIZE)
+        with open(path, "rb") as fh:
+            mapped = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_COPY)
+        start = ctypes.c_char.from_buffer(mapped)
+        vec = (ctypes.c_ubyte * pages)()
+        libc.mincore(ctypes.c_void_p(ctypes.addressof(start)), ctypes.c_size_t(size), vec)
+        cached += sum(page & 1 for page in vec) * mmap.PAGESIZE
+        del start
+        mapped.close()
+    return cached
+
+
+def drop_from_cache(paths) -> None:
+    for path in paths:
+        with open(path, "rb") as fh:
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def instrument(path, rate, burst, stop, results) -> None:
+    """Until stopped, write CHUNK bytes at rate bytes per second for
+    burst seconds then idle for as long, sending back the latency of
+    each write and sync and the MB/s written whilst writing"""
+    data = os.urandom(CHUNK)
+    latencies = []
+    writing = 0.0
+    with open(path, "wb") as fh:
+        while not stop.is_set():
+            start = time.perf_counter()
+            written = 0
+            while time.perf_counter() - start < burst and not stop.is_set():
+                began = time.perf_counter()
+                fh.write(data)
+                fh.flush()
+                os.fdatasync(fh.fileno())
+                latencies.append(time.perf_counter() - began)
+                written += 1
+                # keep to the rate, catching up after slow writes
+                wait = start + written * CHUNK / rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                if len(latencies) % 256 == 0:
+                    fh.seek(0)
+            writing += time.perf_counter() - start
+            stop.wait(burst)
+    results.put((latencies, len(latencies) / writing))
+
+
+def build(run_dir, files, tmp, tar_dir, flags) -> tuple:
+    """Build a tar file of the run directory, returning the seconds
+    taken and seconds paused for writes"""
+    argv = ["--tar-destination", "project-xxxx:/runs", "--log-file",
+            os.path.join(tmp, "sync.log"), "--prefix", "run.lane.all",
+            "--tar-directory", tar_dir, "--codec", "gzip", "--compress-level", "1",
+            "--compress-threads", "2", "--auth-token", "token", "--finish"] + flags
+    args = dsd.check_inputs(dsd.parse_args(argv + [run_dir]))
+    tar_path = os.path.join(tar_dir, "run_000.tar.gz")
+    size = sum(os.path.getsize(f) for f in files)
+
+    start = time.perf_counter()
+    dsd.build_tar_file({"size": size, "files": files}, tar_path, args)
+    elapsed = time.perf_counter() - start
+
+    os.remove(tar_path)
+    os.remove(dsd.get_index_path(tar_path))
+    args.space_ledger.release(tar_path)
+    return elapsed, args.governor.paused
+
+
+def percentile(values, fraction) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--run-mb", type=int, default=512,
+        help="Size of the run directory tarred in MB (default %(default)s)")
+    parser.add_argument("--write-mb-s", type=float, default=20,
+        help="Rate the instrument writes at in MB/s (default %(default)s)")
+    parser.add_argument("--burst-s", type=float, default=2,
+        help="Seconds the instrument writes for, then idles for (default %(default)s)")
+    parser.add_argument("--yield-mb-s", type=float,
+        help="--yield-to-writes limit (default half of --write-mb-s)")
+    parser.add_argument("--dir", default=None,
+        help="Directory on the disk to benchmark (default a temporary directory)")
+    parser.add_argument("--tar-dir", default=None,
+        help="Directory to write the tar file to (default within --dir)")
+    bench_args = parser.parse_args()
+    yield_mb_s = bench_args.yield_mb_s or bench_args.write_mb_s / 2
+
+    settings = (
+        ("default", []),
+        ("gentle", ["--gentle-io"]),
+        ("gentle+yield", ["--gentle-io", "--yield-to-writes", str(yield_mb_s)]),
+    )
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=bench_args.dir) as tmp, \
+            tempfile.TemporaryDirectory(dir=bench_args.tar_dir or tmp) as tar_dir:
+        run_dir = os.path.join(tmp, "run")
+        files = []
+        for i in range(bench_args.run_mb // 8):
+            path = os.path.join(run_dir, "Data", f"C{i}.1", "L001_1.cbcl")
+            os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as fh:
+                fh.write(os.urandom(8 * CHUNK))
+            files.append(path)
+
+        for name, flags in settings:
+            drop_from_cache(files)
+            stop = multiprocessing.Event()
+            queue = multiprocessing.Queue()
+            writer = multiprocessing.Process(
+                target=instrument,
+                args=(os.path.join(tmp, "instrument.bin"),
+                      bench_args.write_mb_s * CHUNK, bench_args.burst_s, stop, queue))
+            writer.start()
+            # let the writer settle
+            time.sleep(1)
+
+            # keep the sync's own progress out of the results
+            stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+            try:
+                elapsed, paused = build(run_dir, files, tmp, tar_dir, flags)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            cached = get_cached(files)
+
+            stop.set()
+            latencies, rate = queue.get()
+            writer.join()
+            results.append((name, elapsed, paused, latencies, rate, cached))
+
+    print(f"{bench_args.run_mb} MB tarred whilst writing {bench_args.write_mb_s} MB/s "
+          f"in {bench_args.burst_s}s bursts, yielding above {yield_mb_s} MB/s")
+    print(f"{'setting':<14}{'tar s':>8}{'paused s':>10}{'write p50 ms':>14}"
+          f"{'write p99 ms':>14}{'write MB/s':>12}{'cached MB':>11}")
+    for name, elapsed, paused, latencies, rate, cached in results:
+        print(f"{name:<14}{elapsed:>8.1f}{paused:>10.0f}"
+              f"{percentile(latencies, 0.5) * 1000:>14.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>14.1f}"
+              f"{rate:>12.1f}{cached / 2**20:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
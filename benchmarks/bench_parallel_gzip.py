@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark gzipping a tar file with the single threaded `w:gz` path
+against files/pgzip.py on a synthetic CBCL run directory.
+
+    $ python3 benchmarks/bench_parallel_gzip.py --size 2048 --threads 2 4 8
+"""
+import argparse
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+from pgzip import ParallelGzipWriter
+
+
+def make_cbcl_tree(base_dir, total_mb, lanes=2, file_mb=16) -> list:
+    """
+    Write a synthetic run directory of Data/Intensities/BaseCalls/
+    L00<lane>/C<cycle>.1/L00<lane>_1.cbcl files. CBCL tiles hold packed
+    basecalls and binned qualities which gzip only a little further, so
+    each file mixes random bytes with a skewed, compressible alphabet.
+    """
+    rng = random.Random(42)
+    files = []
+    n_files = max(1, total_mb // file_mb)
+
+    for i in range(n_files):
+        lane = i % lanes + 1
+        cycle = i // lanes + 1
+        cycle_dir = os.path.join(
+            base_dir, "Data/Intensities/BaseCalls",
+            f"L00{lane}", f"C{cycle}.1"
+        )
+        os.makedirs(cycle_dir, exist_ok=True)
+        path = os.path.join(cycle_dir, f"L00{lane}_1.cbcl")
+
+        with open(path, "wb") as fh:
+            for _ in range(file_mb):
+                packed = bytes(rng.choices(b"\x00\x11\x22\x33\x44\x55\x66", k=2**19))
+                fh.write(packed + os.urandom(2**19))
+        files.append(path)
+
+    return files
+
+
+def tar_single(files, base_dir, out_path) -> None:
+    with tarfile.open(out_path, "w:gz") as tar_file:
+        for f in files:
+            tar_file.add(f, arcname=os.path.relpath(f, base_dir))
+
+
+def tar_parallel(files, base_dir, out_path, threads) -> None:
+    with open(out_path, "wb") as fh:
+        writer = ParallelGzipWriter(fh, threads=threads)
+        tar_file = tarfile.open(fileobj=writer, mode="w|")
+        for f in files:
+            tar_file.add(f, arcname=os.path.relpath(f, base_dir))
+        tar_file.close()
+        writer.close()
+
+
+def check_tar(out_path, files, base_dir) -> None:
+    """Check the tar file can be read back with all members intact"""
+    with tarfile.open(out_path, "r:gz") as tar_file:
+        names = tar_file.getnames()
+    expected = [os.path.relpath(f, base_dir) for f in files]
+    assert names == expected, "tar members do not match input files"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=512,
+        help="Size (in MB) of synthetic run directory (default %(default)s)")
+    parser.add_argument("--threads", type=int, nargs="+",
+        default=[2, 4, os.cpu_count() or 1],
+        help="Thread counts to benchmark (default %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run_dir = os.path.join(tmp, "run")
+        files = make_cbcl_tree(run_dir, args.size)
+        in_bytes = sum(os.path.getsize(f) for f in files)
+
+        results = []
+
+        out_path = os.path.join(tmp, "single.tar.gz")
+        start = time.perf_counter()
+        tar_single(files, run_dir, out_path)
+        elapsed = time.perf_counter() - start
+        check_tar(out_path, files, run_dir)
+        results.append(("w:gz", elapsed, os.path.getsize(out_path)))
+
+        for threads in sorted(set(args.threads)):
+            out_path = os.path.join(tmp, f"parallel_{threads}.tar.gz")
+            start = time.perf_counter()
+            tar_parallel(files, run_dir, out_path, threads)
+            elapsed = time.perf_counter() - start
+            check_tar(out_path, files, run_dir)
+            results.append((f"pgzip x{threads}", elapsed, os.path.getsize(out_path)))
+
+    baseline = results[0][1]
+    print(f"{in_bytes / 2**20:.0f} MB in {len(files)} CBCL files")
+    print(f"{'method':<12}{'seconds':>10}{'MB/s':>10}{'ratio':>8}{'speedup':>9}")
+    for name, elapsed, out_size in results:
+        print(
+            f"{name:<12}{elapsed:>10.2f}{in_bytes / 2**20 / elapsed:>10.1f}"
+            f"{out_size / in_bytes:>8.3f}{baseline / elapsed:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
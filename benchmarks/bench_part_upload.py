@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Benchmark the throughput of the built in uploader (--builtin-upload,
+files/part_upload.py PartUploader) against a local fake endpoint, as
+used by tests/test_part_upload.py.
+
+A local HTTP server stands in for the platform's upload URLs, reading
+and discarding each part PUT to it, and a fake API hands out URLs on
+it. --latency-ms delays each response, as the round trip and the
+platform's handling of each part do, and --connection-mbps limits each
+connection to a rate, as the path to the platform limits a single
+stream, so that the gain from uploading parts on many threads at once
+shows. The table gives the MB/s reached with each number of threads.
+
+With --project, the same file is also uploaded to that project with
+the built in uploader and the Upload Agent (ua), with the same threads
+and 25 MB parts, using the token of the current dx login. This is the
+comparison that matters for making the built in uploader the default,
+which needs a platform login and ua on the PATH, so is not run by
+default.
+
+    $ python3 benchmarks/bench_part_upload.py --size-mb 512 --latency-ms 50 --connection-mbps 200
+    $ python3 benchmarks/bench_part_upload.py --size-mb 2048 --project project-xxxx
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+from part_upload import PartUploader, upload_file_parts
+
+
+CHUNK = 2**16
+
+
+class DiscardHandler(BaseHTTPRequestHandler):
+    """Reads and discards each part PUT to it, at most at the server's
+    rate per connection, then responds after the server's latency"""
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        remaining = int(self.headers["Content-Length"])
+        start = time.perf_counter()
+        received = 0
+        while remaining:
+            data = self.rfile.read(min(CHUNK, remaining))
+            remaining -= len(data)
+            received += len(data)
+            if self.server.rate:
+                ahead = received / self.server.rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPI():
+    """Stands in for dxpy.api, giving upload URLs on a local server"""
+    def __init__(self, port):
+        self.port = port
+
+    def file_new(self, input_params):
+        return {"id": "file-xxxx"}
+
+    def file_upload(self, file_id, input_params):
+        return {"url": f"http://127.0.0.1:{self.port}/{file_id}/{input_params['index']}"}
+
+    def file_close(self, file_id, input_params):
+        pass
+
+    def file_describe(self, file_id, input_params):
+        return {"state": "closed"}
+
+
+def bench_fake(path, size, threads, part_size, latency, rate):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DiscardHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.rate = rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        uploader = PartUploader(threads=threads, api=FakeAPI(server.server_address[1]))
+        dx_file = uploader.new_file("bench.tar", "project-xxxx", "/")
+        start = time.perf_counter()
+        upload_file_parts(path, dx_file, part_size, threads=threads)
+        return size / 2**20 / (time.perf_counter() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_platform(path, size, threads, part_size, project):
+    """MB/s uploading to the platform with the built in uploader and
+    with ua, removing each file uploaded"""
+    import dxpy
+
+    results = {}
+    uploader = PartUploader(threads=threads)
+    dx_file = uploader.new_file("bench_builtin.tar", project, "/bench_part_upload")
+    start = time.perf_counter()
+    upload_file_parts(path, dx_file, part_size, threads=threads)
+    results["builtin"] = size / 2**20 / (time.perf_counter() - start)
+    dx_file.remove()
+
+    start = time.perf_counter()
+    file_id = subprocess.run(
+        ["ua", "--project", project, "--folder", "/bench_part_upload", "--do-not-compress",
+         "--wait-on-close", "-u", str(threads), "--chunk-size", f"{part_size // 2**20}M",
+         "--auth-token", dxpy.security_context["auth_token"], path],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.strip()
+    results["ua"] = size / 2**20 / (time.perf_counter() - start)
+    dxpy.api.project_remove_objects(project, {"objects": [file_id]})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--part-size", type=int, default=25, help="MB")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--connection-mbps", type=float, default=0,
+                        help="Mbit/s each connection to the fake endpoint is limited to")
+    parser.add_argument("--project", help="also upload to this project with ua")
+    args = parser.parse_args()
+
+    size = args.size_mb * 2**20
+    part_size = args.part_size * 2**20
+    with tempfile.NamedTemporaryFile() as fh:
+        for _ in range(args.size_mb):
+            fh.write(os.urandom(2**20))
+        fh.flush()
+
+        print(f"{args.size_mb} MB in {args.part_size} MB parts, {args.latency_ms:g} ms "
+              f"latency, {args.connection_mbps or 'unlimited':} Mbit/s per connection")
+        print(f"{'threads':>8} {'fake MB/s':>10}" + (f" {'builtin MB/s':>13} {'ua MB/s':>8}"
+                                                    if args.project else ""))
+        for threads in args.threads:
+            fake = bench_fake(fh.name, size, threads, part_size, args.latency_ms / 1000,
+                              args.connection_mbps * 2**20 / 8)
+            line = f"{threads:>8} {fake:>10.1f}"
+            if args.project:
+                platform = bench_platform(fh.name, size, threads, part_size, args.project)
+                line += f" {platform['builtin']:>13.1f} {platform['ua']:>8.1f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmark the metadata load of a sync interval in lane mode
+(incremental_upload.py --num-lanes), with each lane scanning the run
+directory for its own files against one scan shared by every lane.
+
+A synthetic run directory of BCL files for each lane (plus the config
+files every lane uploads) is checked for files to sync by each lane as
+a sync interval would, counting the directories listed and entries
+statted, and timing it. Nothing is tarred.
+
+    $ python3 benchmarks/bench_shared_scan.py --lanes 8 --cycles 300 --tiles 16
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+import dir_scan
+import dx_sync_directory as dsd
+import incremental_upload as iu
+
+
+class CountingScandir():
+    """os.scandir, counting the directories listed and entries found"""
+    def __init__(self) -> None:
+        self.listed = 0
+        self.entries = 0
+        self.scandir = os.scandir
+
+
+    def __call__(self, path):
+        self.listed += 1
+        with self.scandir(path) as entries:
+            found = list(entries)
+        self.entries += len(found)
+        return Listing(found)
+
+
+class Listing(list):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def touch(path) -> None:
+    """Write an empty file, old enough to sync"""
+    open(path, "w").close()
+    os.utime(path, (time.time() - 3600,) * 2)
+
+
+def build_run(run_dir, bench_args) -> None:
+    for name in iu.CONFIG_FILES:
+        touch(os.path.join(run_dir, name))
+    for lane in range(1, bench_args.lanes + 1):
+        for cycle in range(1, bench_args.cycles + 1):
+            cycle_dir = os.path.join(run_dir, "Data", "Intensities", "BaseCalls",
+                                     f"L00{lane}", f"C{cycle}.1")
+            os.makedirs(cycle_dir)
+            for tile in range(1, bench_args.tiles + 1):
+                touch(os.path.join(cycle_dir, f"s_{lane}_{tile}.bcl"))
+
+
+def make_lanes(run_dir, tmp, bench_args) -> tuple:
+    """incremental_upload.py args, and each lane as it makes them with
+    the checked dx_sync_directory.py args and log of the lane"""
+    run_args = argparse.Namespace(
+        run_dir=run_dir, temp_dir=os.path.join(tmp, "tars"), project="project-xxxx",
+        exclude_patterns=None, upload_thumbnails=False, samplesheet_delay=False,
+        prune_unchanged_dirs=False, min_size=100000, max_size=200000, upload_threads=8,
+        compress_threads=1, codec="none", pipeline_depth=1, packing="balanced",
+        compress_level=None, compress_policy=None, api_token="token", verbose=False,
+        dxpy_upload=False, builtin_upload=False, sha256=False, adaptive_upload=False,
+        bandwidth_schedule=None, stream=False, dedup_content=False, change_feed=None,
+        min_age=0, stable_scans=None, churn_threshold=None, space_budget=None,
+        gentle_io=False, yield_to_writes=None, lane_workers=1
+    )
+    os.makedirs(run_args.temp_dir)
+
+    lanes = []
+    for lane in range(1, bench_args.lanes + 1):
+        prefix = f"run.lane.{lane}"
+        lane = {"lane": str(lane), "prefix": prefix,
+                "log_path": os.path.join(tmp, prefix + ".log"), "remote_folder": "/runs"}
+        args = dsd.check_inputs(dsd.parse_args(iu.get_sync_dir_args(lane, run_args)))
+        lanes.append((lane, args, dsd.read_log(args)))
+    return run_args, lanes
+
+
+def run_interval(lanes, scan) -> tuple:
+    """Find each lane's files to sync, returning the seconds taken, the
+    directories listed and entries found, and the files found per lane"""
+    counter = CountingScandir()
+    dir_scan.os.scandir = counter
+    try:
+        start = time.perf_counter()
+        if scan:
+            scan.reset()
+        found = []
+        for lane, args, log in lanes:
+            scanner = scan.view(lane["prefix"]) if scan else None
+            found.append(len(dsd.get_files_to_upload(log, args, scanner)))
+        elapsed = time.perf_counter() - start
+    finally:
+        dir_scan.os.scandir = counter.scandir
+    return elapsed, counter.listed, counter.entries, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lanes", type=int, default=8,
+        help="Number of lanes (default %(default)s)")
+    parser.add_argument("--cycles", type=int, default=300,
+        help="Number of cycles (default %(default)s)")
+    parser.add_argument("--tiles", type=int, default=16,
+        help="Number of BCL files per lane per cycle (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="Intervals timed, the best being reported (default %(default)s)")
+    bench_args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        run_dir = os.path.join(tmp, "run")
+        os.makedirs(run_dir)
+        build_run(run_dir, bench_args)
+
+        # keep the sync's own progress out of the results
+        stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+        try:
+            run_args, lanes = make_lanes(run_dir, tmp, bench_args)
+            scan = iu.start_shared_scan([lane for lane, _, _ in lanes], run_args)
+            for name, lane_scan in (("per lane", None), ("shared", scan)):
+                runs = [run_interval(lanes, lane_scan) for _ in range(bench_args.repeat)]
+                results.append((name, min(runs)))
+            for _, args, _ in lanes:
+                args.state.close()
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+
+    print(f"{bench_args.lanes} lanes, {bench_args.cycles} cycles, "
+          f"{bench_args.tiles} files per lane per cycle")
+    print(f"{'scan':<10}{'dirs listed':>13}{'entries':>10}{'seconds':>10}{'files/lane':>12}")
+    for name, (elapsed, listed, entries, found) in results:
+        print(f"{name:<10}{listed:>13}{entries:>10}{elapsed:>10.2f}{found[0]:>12}")
+    if results[0][1][3] != results[1][1][3]:
+        sys.exit("ERROR: lanes found different files with a shared scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark the startup cost paid by every monitoring cron tick and every
+run of files/dx_sync_directory.py: the time to import each script in a
+fresh Python process, and the time from starting dx_sync_directory.py
+to the first scan of a run directory. Also reports whether dxpy was
+imported by a sync which had nothing to upload (it should not be).
+
+Each figure is the best of --repeat fresh processes. Exits non-zero if
+any is over its budget, so it can be run to catch startup regressions.
+
+    $ python3 benchmarks/bench_startup.py --repeat 5 --import-budget-ms 150
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+FILES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+SCRIPTS = ("dx_sync_directory", "incremental_upload", "monitor_runs")
+
+# Run in a fresh process: syncs a run directory with nothing to upload
+# and prints the time the first scan started at and whether dxpy was
+# ever imported
+FIRST_SCAN = """
+import sys, time
+sys.path.insert(0, {files_dir!r})
+import dx_sync_directory as dsd
+from lazy_import import is_loaded
+
+get_files_to_upload = dsd.get_files_to_upload
+def first_scan(log, args, scanner=None):
+    print(time.time(), flush=True)
+    return get_files_to_upload(log, args, scanner)
+dsd.get_files_to_upload = first_scan
+
+engine = dsd.SyncEngine(dsd.parse_args({argv!r}))
+engine.sync()
+engine.close()
+print(is_loaded(dsd.dxpy))
+"""
+
+
+def time_import(script) -> float:
+    """Seconds taken to import a script in a fresh process"""
+    code = ("import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); "
+            "import %s; print(time.perf_counter() - start)" % (FILES_DIR, script))
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True).stdout
+    return float(output.split()[-1])
+
+
+def time_first_scan(tmp) -> tuple:
+    """Seconds from starting a process to its first scan, and whether
+    the sync imported dxpy"""
+    run_dir = os.path.join(tmp, "run")
+    os.makedirs(os.path.join(run_dir, "InterOp"), exist_ok=True)
+    os.makedirs(os.path.join(tmp, "tars"), exist_ok=True)
+    with open(os.path.join(run_dir, "RunInfo.xml"), "w") as fh:
+        fh.write("<RunInfo/>\n")
+
+    argv = ["--tar-destination", "project-xxxx:/runs", "--log-file",
+            os.path.join(tmp, "sync.log"), "--prefix", "run.lane.all",
+            "--tar-directory", os.path.join(tmp, "tars"), "--min-age", "60",
+            "--min-tar-size", "100000", "--max-tar-size", "200000",
+            "--auth-token", "token", run_dir]
+    code = FIRST_SCAN.format(files_dir=FILES_DIR, argv=argv)
+
+    start = time.time()
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True).stdout.split()
+    return float(output[0]) - start, output[1] == "True"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5,
+        help="Number of fresh processes to take the best of (default %(default)s)")
+    parser.add_argument("--import-budget-ms", type=float, default=250,
+        help="Most time to import each script in ms (default %(default)s)")
+    parser.add_argument("--scan-budget-ms", type=float, default=250,
+        help="Most time from starting dx_sync_directory.py to its first "
+             "scan in ms (default %(default)s)")
+    bench_args = parser.parse_args()
+
+    results = []
+    for script in SCRIPTS:
+        best = min(time_import(script) for _ in range(bench_args.repeat))
+        results.append(("import " + script, best * 1000, bench_args.import_budget_ms))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scans = [time_first_scan(tmp) for _ in range(bench_args.repeat)]
+    results.append(("first scan", min(scan[0] for scan in scans) * 1000,
+                    bench_args.scan_budget_ms))
+    dxpy_imported = any(scan[1] for scan in scans)
+
+    over_budget = False
+    print(f"{'startup':<32}{'best ms':>10}{'budget ms':>12}")
+    for name, ms, budget in results:
+        over = ms > budget
+        over_budget = over_budget or over
+        print(f"{name:<32}{ms:>10.1f}{budget:>12.0f}{'  OVER' if over else ''}")
+    print(f"dxpy imported by a sync with nothing to upload: {dxpy_imported}")
+
+    if over_budget or dxpy_imported:
+        sys.exit("Startup is over budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark the wall and CPU time per sync interval of running
+files/dx_sync_directory.py afresh each interval, as incremental_upload.py
+used to, against syncing with one SyncEngine kept between intervals.
+
+A synthetic run directory is synced once up front, as if its files had
+already been tarred and uploaded, so each interval finds only the few
+files written since the last. --min-tar-size is set high enough that
+nothing is tarred, so the intervals measure the fixed cost of a sync
+(start up, reading the log, scanning the run) and nothing is uploaded.
+
+    $ python3 benchmarks/bench_sync_engine.py --intervals 20 --files 20000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+import dx_sync_directory as dsd
+
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "files", "dx_sync_directory.py")
+
+
+def write(path, size) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(os.urandom(size))
+
+
+def get_argv(run_dir, tmp) -> list:
+    return ["--tar-destination", "project-xxxx:/runs", "--log-file",
+            os.path.join(tmp, "sync.log"), "--prefix", "run.lane.all",
+            "--tar-directory", os.path.join(tmp, "tars"), "--codec", "none",
+            "--min-tar-size", "100000", "--max-tar-size", "200000",
+            "--min-age", "60", "--auth-token", "token", run_dir]
+
+
+def build_run(run_dir, tmp, bench_args) -> None:
+    """Write the run's files and record them all as synced"""
+    for i in range(bench_args.files):
+        write(os.path.join(run_dir, "Data/Intensities/BaseCalls",
+                           f"L00{i % 4 + 1}", f"C{i // 4 % 300}.1", f"s_{i}.cbcl"), 64)
+
+    os.makedirs(os.path.join(tmp, "tars"))
+    args = dsd.check_inputs(dsd.parse_args(get_argv(run_dir, tmp)))
+    log = dsd.read_log(args)
+    args.min_age = args.min_tar_size = 0
+    for tar in dsd.split_into_tar_files(dsd.get_files_to_upload(log, args), log, args):
+        tar_path = os.path.join(args.tar_directory, dsd.get_tar_filename(log, args))
+        log = dsd.record_tar_file(tar_path, *dsd.build_tar_file(tar, tar_path, args),
+                                  log, args)
+        log["tar_files"][tar_path].update(status="removed", file_id="file-xxxx")
+        os.remove(tar_path)
+    dsd.update_log(log, args)
+    args.state.close()
+
+
+def new_files(run_dir, interval, bench_args) -> None:
+    for i in range(bench_args.new_files):
+        write(os.path.join(run_dir, "Data/Intensities/BaseCalls/L001",
+                           f"C{interval}.1", f"new_{i}.cbcl"), 64)
+
+
+def run_script(run_dir, tmp, bench_args) -> tuple:
+    """Run the script afresh each interval, returning the wall and CPU seconds"""
+    argv = [sys.executable, SCRIPT] + get_argv(run_dir, tmp)
+    wall = cpu = 0.0
+    for interval in range(bench_args.intervals):
+        new_files(run_dir, interval, bench_args)
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        wall += time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    return wall, cpu
+
+
+def run_engine(run_dir, tmp, bench_args) -> tuple:
+    """Sync with one engine each interval, returning the wall and CPU seconds"""
+    wall = cpu = 0.0
+    engine = None
+    for interval in range(bench_args.intervals):
+        new_files(run_dir, interval, bench_args)
+
+        start, start_cpu = time.perf_counter(), time.process_time()
+        if engine is None:
+            engine = dsd.SyncEngine(dsd.parse_args(get_argv(run_dir, tmp)))
+        engine.sync()
+        wall += time.perf_counter() - start
+        cpu += time.process_time() - start_cpu
+    engine.close()
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--intervals", type=int, default=20,
+        help="Number of sync intervals (default %(default)s)")
+    parser.add_argument("--files", type=int, default=20000,
+        help="Number of files already synced in the run (default %(default)s)")
+    parser.add_argument("--new-files", type=int, default=20,
+        help="Number of files written each interval (default %(default)s)")
+    bench_args = parser.parse_args()
+
+    results = []
+    for name, run in (("script", run_script), ("engine", run_engine)):
+        with tempfile.TemporaryDirectory() as tmp:
+            run_dir = os.path.join(tmp, "run")
+            # keep the sync's own progress out of the results
+            stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+            try:
+                build_run(run_dir, tmp, bench_args)
+                wall, cpu = run(run_dir, tmp, bench_args)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            results.append((name, wall, cpu))
+
+    print(f"{bench_args.intervals} intervals, {bench_args.files} files synced, "
+          f"{bench_args.new_files} new each interval")
+    print(f"{'sync':<8}{'wall s':>10}{'CPU s':>10}{'wall/interval':>15}")
+    for name, wall, cpu in results:
+        print(f"{name:<8}{wall:>10.2f}{cpu:>10.2f}{wall / bench_args.intervals:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Benchmark keeping the sync log as a JSON file (rewritten and re-read
+after every step) against the SQLite store in files/sync_state.py, for
+a log of a large run.
+
+Each simulated tar file adds a batch of files to the log and takes
+three log updates (tarred, uploaded, removed), as dx_sync_directory.py
+does. The scan of the run directory is simulated by looking up the
+mtime of every file in the log. Every sync interval loads the log and
+scans, so both are reported together too: the SQLite store loads
+almost nothing up front but pays for reading each entry in the scan.
+
+    $ python3 benchmarks/bench_sync_state.py --files 1000000 --tars 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "files"))
+
+from sync_state import SyncState
+
+
+SYNC_DIR = "/data/runs/20240101_LH00123_0001_A22ABCDEF"
+
+
+def make_paths(n_files, lanes=8, tiles=12):
+    """
+    Paths laid out as a NovaSeq X run directory, one CBCL per lane,
+    cycle and tile group
+    """
+    per_cycle = lanes * tiles
+    for i in range(n_files):
+        cycle = i // per_cycle + 1
+        lane = (i // tiles) % lanes + 1
+        tile = i % tiles + 1
+        yield os.path.join(
+            SYNC_DIR, "Data/Intensities/BaseCalls", f"L00{lane}",
+            f"C{cycle}.1", f"L00{lane}_{tile}.cbcl"
+        )
+
+
+def make_log(n_files) -> dict:
+    return {
+        "sync_dir": SYNC_DIR, "tar_destination": "project-xxxx:/runs",
+        "file_prefix": "run.lane.all", "include_patterns": [],
+        "exclude_patterns": [], "next_tar_index": 0, "tar_files": {},
+        "files": dict(
+            (path, {"mtime": 1.7e9, "size": 2**20}) for path in make_paths(n_files)
+        )
+    }
+
+
+def new_batches(n_files, n_tars, files_per_tar):
+    """Paths of the files added by each tar, after those already synced"""
+    paths = make_paths(n_files + n_tars * files_per_tar)
+    for _ in range(n_files):
+        next(paths)
+    for _ in range(n_tars):
+        yield [next(paths) for _ in range(files_per_tar)]
+
+
+def record_tar(log, index, batch, update) -> dict:
+    """Make the three log updates of one tar file"""
+    name = f"/tmp/run.lane.all_{index:03d}.tar.gz"
+    log["tar_files"][name] = {"status": "tarred", "size": len(batch) * 2**20}
+    log["next_tar_index"] = index + 1
+    for path in batch:
+        log["files"][path] = {"mtime": 1.7e9, "size": 2**20}
+    log = update(log)
+
+    log["tar_files"][name]["status"] = "uploaded"
+    log = update(log)
+
+    log["tar_files"][name]["status"] = "removed"
+    return update(log)
+
+
+def scan(log, paths) -> int:
+    """Look up every file as get_files_to_upload does"""
+    changed = 0
+    for path in paths:
+        entry = log["files"].get(path)
+        if entry is None or 1.7e9 > entry["mtime"]:
+            changed += 1
+    return changed
+
+
+def bench_json(tmp, args) -> dict:
+    log_file = os.path.join(tmp, "sync.log")
+    with open(log_file, "w") as fh:
+        json.dump(make_log(args.files), fh)
+
+    def update(log):
+        with open(log_file, "w") as fh:
+            json.dump(log, fh)
+        with open(log_file) as fh:
+            return json.load(fh)
+
+    times = {}
+    start = time.perf_counter()
+    with open(log_file) as fh:
+        log = json.load(fh)
+    times["load"] = time.perf_counter() - start
+
+    paths = list(make_paths(args.files))
+    start = time.perf_counter()
+    scan(log, paths)
+    times["scan"] = time.perf_counter() - start
+
+    batches = list(new_batches(args.files, args.tars, args.files_per_tar))
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        log = record_tar(log, i, batch, update)
+    times["per tar"] = (time.perf_counter() - start) / args.tars
+    times["size MB"] = os.path.getsize(log_file) / 2**20
+
+    return times
+
+
+def bench_sqlite(tmp, args) -> dict:
+    db_file = os.path.join(tmp, "sync.log.db")
+    state = SyncState(db_file, SYNC_DIR)
+    state.import_log(make_log(args.files))
+    state.close()
+
+    def update(log):
+        state.commit(log)
+        return log
+
+    times = {}
+    start = time.perf_counter()
+    state = SyncState(db_file, SYNC_DIR)
+    log = state.load()
+    times["load"] = time.perf_counter() - start
+
+    paths = list(make_paths(args.files))
+    start = time.perf_counter()
+    scan(log, paths)
+    times["scan"] = time.perf_counter() - start
+
+    batches = list(new_batches(args.files, args.tars, args.files_per_tar))
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        log = record_tar(log, i, batch, update)
+    times["per tar"] = (time.perf_counter() - start) / args.tars
+
+    state.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    times["size MB"] = os.path.getsize(db_file) / 2**20
+    state.close()
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=1000000,
+        help="Number of files already in the log (default %(default)s)")
+    parser.add_argument("--tars", type=int, default=5,
+        help="Number of tar files to record (default %(default)s)")
+    parser.add_argument("--files-per-tar", type=int, default=500,
+        help="Number of files added by each tar (default %(default)s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [("json", bench_json(tmp, args)), ("sqlite", bench_sqlite(tmp, args))]
+
+    print(f"{args.files} files in log, {args.tars} tars of {args.files_per_tar} files")
+    print(f"{'store':<8}{'load s':>10}{'scan s':>10}{'load+scan s':>13}"
+          f"{'per tar s':>11}{'size MB':>10}")
+    for name, times in results:
+        print(
+            f"{name:<8}{times['load']:>10.2f}{times['scan']:>10.2f}"
+            f"{times['load'] + times['scan']:>13.2f}"
+            f"{times['per tar']:>11.3f}{times['size MB']:>10.1f}"
+        )
+
+    json_times, sqlite_times = results[0][1], results[1][1]
+    print(f"The SQLite store's scan takes {sqlite_times['scan'] / json_times['scan']:.1f}x "
+          f"as long as the JSON store's, and every sync interval pays it")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Called from dx_sync_directory.py to limit the rate at which tar files
+are uploaded, so that uploads leave room on a shared uplink.
+
+The limit is set by a schedule of time of day windows, each with a rate
+in Mbit/s, e.g. "07:00-19:00=200" caps uploads at 200 Mbit/s during the
+day and leaves them uncapped overnight. Times are local to the host, a
+window may wrap past midnight and the first window a time falls in
+applies.
+
+The limit is applied with a token bucket kept in a small file locked
+with fcntl, so that every upload on the host using the same file (by
+default one in the shared tar directory) is limited together, across
+threads and processes. Uploads take tokens (bytes) as they send data; a
+bucket drawn below empty is a debt which each upload waits out before
+sending more, so uploads share the rate in the order they asked for it.
+"""
+import fcntl
+import json
+import os
+import re
+import time
+
+
+BUCKET_FILE = 'dx_streaming_upload.bandwidth'
+
+# Bytes taken from the bucket at a time as a part is sent
+QUANTUM = 2**20
+
+# Seconds of tokens an idle bucket fills up to, the most sent at once
+# after a pause
+BURST_SECONDS = 1.0
+
+WINDOW = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+(?:\.\d+)?)$')
+
+
+def parse_schedule(windows) -> list:
+    """
+    Parse windows of the form HH:MM-HH:MM=<Mbit/s> into a list of
+    (start minute, end minute, bytes per second). Raises ValueError for
+    a badly formed window.
+    """
+    schedule = []
+    for window in windows:
+        match = WINDOW.match(window.strip())
+        if not match:
+            raise ValueError(
+                f"bandwidth window {window!r} is not of the form HH:MM-HH:MM=<Mbit/s>"
+            )
+        start_h, start_m, end_h, end_m, mbits = match.groups()
+        start = int(start_h) * 60 + int(start_m)
+        end = int(end_h) * 60 + int(end_m)
+        if start > 24 * 60 or end > 24 * 60 or int(start_m) > 59 or int(end_m) > 59:
+            raise ValueError(f"bandwidth window {window!r} has an invalid time")
+        if float(mbits) <= 0:
+            raise ValueError(f"bandwidth window {window!r} must have a rate above 0")
+        schedule.append((start, end, float(mbits) * 1e6 / 8))
+
+    return schedule
+
+
+def get_rate(schedule, when=None):
+    """Bytes per second allowed at the given time (default now), None if uncapped"""
+    local = time.localtime(when)
+    minute = local.tm_hour * 60 + local.tm_min
+
+    for start, end, rate in schedule:
+        if start <= end:
+            if start <= minute < end:
+                return rate
+        elif minute >= start or minute < end:
+            # wraps past midnight
+            return rate
+
+    return None
+
+
+class TokenBucket():
+    """
+    Token bucket shared through a file by everything using the same
+    path.
+
+    Parameters
+    ----------
+    path : str
+        file the bucket's state is kept in, created if needed
+    schedule : list
+        schedule from parse_schedule setting the rate
+    clock : callable
+        returns the current time, time.time by default
+    sleep : callable
+        waits a number of seconds, time.sleep by default
+    """
+    def __init__(self, path, schedule, clock=time.time, sleep=time.sleep) -> None:
+        self.path = path
+        self.schedule = schedule
+        self.clock = clock
+        self.sleep = sleep
+
+
+    def get_rate(self):
+        return get_rate(self.schedule, self.clock())
+
+
+    def throttle(self, data) -> 'ThrottledReader':
+        """File object to send data from at the rate of the bucket"""
+        return ThrottledReader(data, self)
+
+
+    def take(self, size) -> float:
+        """
+        Take size bytes from the bucket, waiting until they may be
+        sent. Returns the seconds waited.
+        """
+        rate = self.get_rate()
+        if rate is None:
+            return 0
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = self.clock()
+            try:
+                state = json.loads(os.pread(fd, 4096, 0))
+                tokens = state['tokens'] + (now - state['time']) * rate
+            except (ValueError, KeyError, TypeError):
+                # new or unreadable bucket, start it full
+                tokens = rate * BURST_SECONDS
+
+            tokens = min(tokens, rate * BURST_SECONDS) - size
+            data = json.dumps({'tokens': tokens, 'time': now}).encode()
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, data, 0)
+        finally:
+            os.close(fd)
+
+        wait = -tokens / rate if tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class ThrottledReader():
+    """
+    Read-only file object over bytes which takes from a bucket as it
+    is read, so a part is sent no faster than the bucket allows. Has a
+    len so that the part is still sent with a Content-Length.
+    """
+    def __init__(self, data, bucket) -> None:
+        self.data = memoryview(data)
+        self.bucket = bucket
+        self.len = len(data)
+        self._pos = 0
+        self._allowed = 0
+
+
+    def __len__(self) -> int:
+        return self.len
+
+
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            size = self.len - self._pos
+        size = min(size, self.len - self._pos)
+
+        if size > self._allowed:
+            quantum = max(QUANTUM, size - self._allowed)
+            quantum = min(quantum, self.len - self._pos - self._allowed)
+            self.bucket.take(quantum)
+            self._allowed += quantum
+
+        data = self.data[self._pos:self._pos + size].tobytes()
+        self._pos += size
+        self._allowed -= size
+        return data
@@ -0,0 +1,425 @@
+"""
+Called from incremental_upload.py to watch a run directory with Linux
+inotify, and from dx_sync_directory.py to read the changes seen.
+
+ChangeWatcher runs in a thread of incremental_upload.py, keeping a watch
+on every directory in the run directory. Each file closed after writing
+or moved into place (with its mtime at the time), and each new
+directory, is appended to a change feed: a small SQLite database shared with the dx_sync_directory.py runs
+for each lane, which read on from where they last stopped rather than
+walking the whole run directory.
+
+The feed can miss changes: the kernel drops events when its queue
+overflows, directories can be moved, and a watcher that has stopped
+sees nothing. These are recorded in the feed (or show up as the feed
+not being in the 'watching' state), and readers fall back to a full
+scan. Readers also make a full scan periodically regardless.
+
+Each reader records how far it has read, and the changes every reader
+has read are deleted, so the feed does not grow for the whole run. A
+reader whose last read is older than the changes deleted (e.g. one that
+has not read since a restart) scans instead.
+
+inotify does not see changes made by other hosts to network file
+systems, so no watcher is started on NFS and similar mounts.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+
+# inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+EVENT_HEADER = struct.Struct('iIII')
+
+# File systems on which inotify does not see all changes
+UNWATCHABLE_FS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'fuse',
+                  'fuse.sshfs', 'gpfs', 'lustre', 'ceph', '9p')
+
+# Kinds of change in the feed
+CHANGED = 'changed'   # a file or directory was written or moved into place
+TREE = 'tree'         # a directory appeared, everything below it is new
+RESCAN = 'rescan'     # changes may have been missed
+
+# States of the feed
+WATCHING = 'watching'
+STOPPED = 'stopped'
+FAILED = 'failed'
+
+# Seconds between the watcher recording that it is still running, and
+# after which a feed with no heartbeat is taken to have been abandoned
+# by a watcher that was killed
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS readers (
+    reader TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+"""
+
+
+def get_fs_type(path) -> str:
+    """File system type of the mount holding path, from /proc/mounts"""
+    path = os.path.realpath(path)
+    fs_type = None
+    longest = -1
+    try:
+        with open('/proc/mounts') as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                    if len(mount_point) > longest:
+                        longest = len(mount_point)
+                        fs_type = fields[2]
+    except OSError:
+        return None
+
+    return fs_type
+
+
+def watch_unsupported(path) -> str:
+    """Reason the given directory cannot be watched, or None if it can"""
+    if not sys.platform.startswith('linux'):
+        return "inotify is only available on Linux"
+
+    fs_type = get_fs_type(path)
+    if fs_type and (fs_type in UNWATCHABLE_FS or fs_type.startswith('fuse.')):
+        return "%s is on a %s file system" % (path, fs_type)
+
+    return None
+
+
+class ChangeFeed():
+    """
+    SQLite database of changes seen in a directory.
+
+    Parameters
+    ----------
+    db_path : str
+        path of the database file, created if it does not exist
+    """
+    def __init__(self, db_path) -> None:
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+    def set_state(self, state, epoch=None) -> None:
+        """
+        Record the state of the watcher, with a new epoch each time a
+        watcher starts so readers can tell they missed the time between
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('state', ?)",
+                (state,)
+            )
+            if epoch is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('epoch', ?)",
+                    (epoch,)
+                )
+
+
+    def heartbeat(self) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('heartbeat', ?)",
+                (str(time.time()),)
+            )
+
+
+    def status(self) -> tuple:
+        """
+        (state, epoch) of the watcher writing to the feed, the state is
+        'stopped' if the watcher has not been heard from for a while
+        """
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        state = meta.get('state')
+        if state == WATCHING and time.time() - float(meta.get('heartbeat', 0)) > HEARTBEAT_TIMEOUT:
+            state = STOPPED
+        return state, meta.get('epoch')
+
+
+    def record(self, changes) -> None:
+        """
+        Append a list of (path, kind) changes, or (path, kind, mtime)
+        for a file closed after writing
+        """
+        if not changes:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO events (path, kind, mtime) VALUES (?, ?, ?)",
+                [tuple(change) + (None,) * (3 - len(change)) for change in changes]
+            )
+
+
+    def last_seq(self) -> int:
+        """seq of the last change recorded, deleted or not"""
+        row = self.conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'events'"
+        ).fetchone()
+        return row[0] if row else 0
+
+
+    def deleted_seq(self) -> int:
+        """seq of the last change deleted, having been read by every reader"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'deleted'").fetchone()
+        return int(row[0]) if row else 0
+
+
+    def mark_read(self, reader, seq) -> None:
+        """
+        Record that a reader has read the changes up to seq, and delete
+        the changes every reader has read
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO readers (reader, seq) VALUES (?, ?)",
+                (reader, seq)
+            )
+            oldest = self.conn.execute("SELECT MIN(seq) FROM readers").fetchone()[0]
+            if oldest > self.deleted_seq():
+                self.conn.execute("DELETE FROM events WHERE seq <= ?", (oldest,))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('deleted', ?)",
+                    (str(oldest),)
+                )
+
+
+    def read(self, after_seq) -> list:
+        """(seq, path, kind) of each change recorded after the given one"""
+        return self.conn.execute(
+            "SELECT seq, path, kind FROM events WHERE seq > ? ORDER BY seq",
+            (after_seq,)
+        ).fetchall()
+
+
+    def closed_mtimes(self, after_seq) -> dict:
+        """
+        mtime of each file at the last time it was seen closed after
+        writing since the given change, keyed on path
+        """
+        return dict(self.conn.execute(
+            "SELECT path, mtime FROM events WHERE seq > ? AND mtime IS NOT NULL "
+            "ORDER BY seq", (after_seq,)
+        ))
+
+
+class ChangeWatcher(threading.Thread):
+    """
+    Thread watching every directory below run_dir with inotify and
+    recording changes in a ChangeFeed.
+
+    Parameters
+    ----------
+    run_dir : str
+        absolute path of the directory to watch
+    feed_path : str
+        path of the change feed database
+    skip_dir : callable
+        optional function given the full path of each directory, which
+        returns True if it is not to be watched
+    """
+    def __init__(self, run_dir, feed_path, skip_dir=None) -> None:
+        super().__init__(name='change-watcher', daemon=True)
+        self.run_dir = run_dir.rstrip(os.sep)
+        self.feed_path = feed_path
+        self.skip_dir = skip_dir
+        self.error = None
+
+        self._stopping = threading.Event()
+        self._ready = threading.Event()
+        self._libc = None
+        self._fd = None
+        self._watches = {}
+
+
+    def start_watching(self, timeout=None) -> bool:
+        """
+        Start the thread and wait until every directory is watched.
+        Returns False, with the reason in error, if watching failed.
+        """
+        self.start()
+        self._ready.wait(timeout)
+        return self.error is None
+
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+
+
+    def run(self) -> None:
+        feed = ChangeFeed(self.feed_path)
+        try:
+            self._init_inotify()
+            feed.set_state(STOPPED, epoch='%d.%d' % (time.time(), os.getpid()))
+            self._watch_tree(self.run_dir)
+            feed.heartbeat()
+            feed.set_state(WATCHING)
+        except OSError as e:
+            self.error = "Unable to watch %s: %s" % (self.run_dir, e)
+            feed.set_state(FAILED)
+            feed.close()
+            if self._fd is not None and self._fd >= 0:
+                os.close(self._fd)
+            self._ready.set()
+            return
+
+        self._ready.set()
+
+        try:
+            poller = select.poll()
+            poller.register(self._fd, select.POLLIN)
+            last_heartbeat = time.time()
+            while not self._stopping.is_set():
+                if poller.poll(1000):
+                    feed.record(self._read_changes())
+                if time.time() - last_heartbeat > HEARTBEAT_INTERVAL:
+                    feed.heartbeat()
+                    last_heartbeat = time.time()
+            feed.set_state(STOPPED)
+        except Exception as e:
+            self.error = "Stopped watching %s: %s" % (self.run_dir, e)
+            feed.set_state(FAILED)
+        finally:
+            os.close(self._fd)
+            feed.close()
+
+
+    def _init_inotify(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+
+    def _add_watch(self, path) -> bool:
+        """Watch a directory, returning False if it has gone"""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno in (2, 20):
+                # ENOENT / ENOTDIR, removed or replaced since listed
+                return False
+            # e.g. ENOSPC, out of watches (fs.inotify.max_user_watches)
+            raise OSError(errno, "%s: %s" % (os.strerror(errno), path))
+        self._watches[wd] = path
+        return True
+
+
+    def _watch_tree(self, top) -> None:
+        """Watch top and every directory below it"""
+        stack = [top]
+        while stack:
+            dir_path = stack.pop()
+            if self.skip_dir and self.skip_dir(dir_path):
+                continue
+            if not self._add_watch(dir_path):
+                continue
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+
+    def _read_changes(self) -> list:
+        """Read the queued inotify events as (path, kind) changes"""
+        try:
+            data = os.read(self._fd, 2**16)
+        except BlockingIOError:
+            return []
+
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changes.append((self.run_dir, RESCAN))
+                continue
+
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            dir_path = self._watches.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & IN_MOVE_SELF:
+                # the paths of everything watched below here are stale
+                changes.append((dir_path, RESCAN))
+                continue
+
+            if mask & IN_DELETE_SELF:
+                continue
+
+            path = os.path.join(dir_path, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # files may be written before the new directory is
+                    # watched, so everything below it is treated as new
+                    self._watch_tree(path)
+                    changes.append((path, TREE))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                # the mtime the file was closed with tells readers it has
+                # not been written to since
+                try:
+                    changes.append((path, CHANGED, os.lstat(path).st_mtime))
+                except OSError:
+                    changes.append((path, CHANGED))
+
+        return changes
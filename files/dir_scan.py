@@ -0,0 +1,270 @@
+"""
+Called from dx_sync_directory.py to find the files in the directory
+being synced.
+
+Built on os.scandir, each entry is statted exactly once and the stat is
+passed on, so files are not statted again to size the tar files or to
+build their tar headers.
+
+The mtime of each directory scanned is returned so it can be kept in
+the sync log. A directory which the previous scan found "settled" (with
+every file in it already synced) and whose mtime has not changed since
+is not listed again, only the directories below it are visited. As a
+directory's mtime changes whenever an entry is added, removed or
+renamed in it, this skips finished lane / cycle directories late in a
+run. A file rewritten in place does not change its directory's mtime,
+so pruning is optional and a full scan is made when finishing a sync.
+
+Directories in which nothing is wanted (e.g. excluded thumbnail image
+directories) can also be skipped altogether.
+
+When the lanes of a run are synced separately (incremental_upload.py
+--num-lanes), each would otherwise walk the whole run directory to pick
+out its own files. A SharedScan walks it once, as the first lane needs
+it, routing each entry to the lanes whose patterns it matches (and
+files every lane needs, such as RunInfo.xml, to all of them) and gives
+each lane a view which it walks as it would a DirScanner.
+"""
+import os
+import stat
+import threading
+
+
+class DirScanner():
+    """
+    Walks a directory top down in the same order as os.walk, with each
+    directory's subdirectories listed before its files.
+
+    Parameters
+    ----------
+    sync_dir : str
+        absolute path of the directory to scan
+    known_dirs : dict
+        optional map of directory path relative to sync_dir to the
+        (mtime, settled) recorded for it by the previous scan, used to
+        skip settled directories which have not changed
+    skip_dir : callable
+        optional function given the full path of each directory, which
+        returns True if nothing in or below the directory is wanted so
+        it is not listed
+    """
+    def __init__(self, sync_dir, known_dirs=None, skip_dir=None) -> None:
+        self.sync_dir = sync_dir.rstrip(os.sep)
+        self.known_dirs = known_dirs or {}
+        self.skip_dir = skip_dir
+
+        # (mtime, settled) of each directory visited in this scan, keyed
+        # on path relative to sync_dir, settled unless told otherwise
+        self.scanned = {}
+        self.pruned = 0
+        self.skipped = 0
+
+        self._children = {}
+        for rel_path in self.known_dirs:
+            if rel_path:
+                parent, _, name = rel_path.rpartition(os.sep)
+                self._children.setdefault(parent, []).append(name)
+
+
+    def relative_path(self, full_path) -> str:
+        return full_path[len(self.sync_dir) + 1:]
+
+
+    def walk(self):
+        """
+        Yield (dir path, entries) for each directory listed, where
+        entries is a list of (full path, os.stat_result) for the
+        directory's subdirectories then its files. Settled, unchanged
+        directories are not listed.
+        """
+        yield from self._walk(self.sync_dir, os.stat(self.sync_dir))
+
+
+    def unsettle(self, dir_path) -> None:
+        """Record that a directory has files still to be synced"""
+        rel_path = self.relative_path(dir_path)
+        self.scanned[rel_path] = (self.scanned[rel_path][0], False)
+
+
+    def _walk(self, dir_path, dir_stat):
+        if self.skip_dir and self.skip_dir(dir_path):
+            self.skipped += 1
+            return
+
+        rel_path = self.relative_path(dir_path)
+        known = self.known_dirs.get(rel_path)
+
+        if known and known[1] and known[0] == dir_stat.st_mtime:
+            # nothing added or removed since every file was synced,
+            # only look for changes in the directories below
+            self.pruned += 1
+            self.scanned[rel_path] = known
+            for name in self._children.get(rel_path, []):
+                child_path = os.path.join(dir_path, name)
+                try:
+                    child_stat = os.lstat(child_path)
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISDIR(child_stat.st_mode):
+                    yield from self._walk(child_path, child_stat)
+            return
+
+        self.scanned[rel_path] = (dir_stat.st_mtime, True)
+
+        dirs = []
+        files = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        # as in os.walk, links to directories are listed
+                        # with directories but not followed
+                        is_dir = entry.is_dir()
+                    except FileNotFoundError:
+                        # removed since the directory was listed
+                        continue
+                    if is_dir:
+                        dirs.append((entry.path, entry_stat))
+                    else:
+                        files.append((entry.path, entry_stat))
+        except (FileNotFoundError, NotADirectoryError):
+            del self.scanned[rel_path]
+            return
+
+        yield dir_path, dirs + files
+
+        for child_path, child_stat in dirs:
+            if stat.S_ISDIR(child_stat.st_mode):
+                yield from self._walk(child_path, child_stat)
+
+
+class SharedScan():
+    """
+    One walk of a directory shared by several syncs of it (e.g. the
+    lanes of a run), each seeing only the entries routed to it.
+
+    Parameters
+    ----------
+    sync_dir : str
+        absolute path of the directory to scan
+    routes : dict
+        map of route name to a function given the full path of each
+        entry, which returns True if the entry is routed to it
+    shared : callable
+        optional function given the full path of each entry, which
+        returns True if the entry is routed to every route
+    skip_dir : callable
+        optional function given the full path of each directory, which
+        returns True if nothing in or below it is wanted by any route
+    prune : bool
+        skip settled directories which have not changed, as DirScanner
+        does with known_dirs, a directory being settled only if every
+        route's view of the last scan found it settled
+    """
+    def __init__(self, sync_dir, routes, shared=None, skip_dir=None, prune=False) -> None:
+        self.sync_dir = sync_dir.rstrip(os.sep)
+        self.routes = routes
+        self.shared = shared
+        self.skip_dir = skip_dir
+        self.prune = prune
+
+        self.scanner = DirScanner(self.sync_dir, skip_dir=skip_dir)
+        self.listings = None
+        self.walked = set()
+        self._lock = threading.Lock()
+
+
+    def view(self, name) -> 'ScanView':
+        """View of the scan for the given route"""
+        return ScanView(self, name)
+
+
+    def reset(self) -> None:
+        """
+        Start a new scan, listed again when a view is next walked. What
+        the last scan found settled is only kept for pruning if every
+        route walked it, so every route has unsettled what it needs to.
+        """
+        with self._lock:
+            known_dirs = None
+            if self.prune and self.listings is not None and self.walked == set(self.routes):
+                known_dirs = self.scanner.scanned
+            self.scanner = DirScanner(self.sync_dir, known_dirs, self.skip_dir)
+            self.listings = None
+            self.walked = set()
+
+
+    def get_listing(self, name) -> tuple:
+        """
+        (dir path, entries) of each directory listed, with only the
+        entries routed to the given route, and the mtime of each
+        directory scanned keyed on relative path, scanning if not yet
+        scanned
+        """
+        with self._lock:
+            if self.listings is None:
+                self._scan()
+            self.walked.add(name)
+            mtimes = dict((path, mtime) for path, (mtime, _) in self.scanner.scanned.items())
+            return self.listings[name], mtimes
+
+
+    def unsettle(self, rel_path) -> None:
+        """Record that a directory has files still to be synced by a route"""
+        with self._lock:
+            self.scanner.scanned[rel_path] = (self.scanner.scanned[rel_path][0], False)
+
+
+    def _scan(self) -> None:
+        self.listings = dict((name, []) for name in self.routes)
+        for dir_path, entries in self.scanner.walk():
+            routed = dict((name, []) for name in self.routes)
+            for entry in entries:
+                if self.shared and self.shared(entry[0]):
+                    for name in routed:
+                        routed[name].append(entry)
+                    continue
+                for name, route in self.routes.items():
+                    if route(entry[0]):
+                        routed[name].append(entry)
+            # every directory listed is passed on, even with nothing
+            # routed, so each route can unsettle recently changed ones
+            for name, listing in self.listings.items():
+                listing.append((dir_path, routed[name]))
+
+
+class ScanView():
+    """
+    A SharedScan as seen by one route, walked in place of a DirScanner.
+    The directories it records as scanned are the route's own, starting
+    out settled.
+    """
+    def __init__(self, shared, name) -> None:
+        self.shared = shared
+        self.name = name
+        self.sync_dir = shared.sync_dir
+        self.scanned = {}
+        self.pruned = 0
+        self.skipped = 0
+
+
+    def relative_path(self, full_path) -> str:
+        return full_path[len(self.sync_dir) + 1:]
+
+
+    def walk(self):
+        """Yield (dir path, entries) for each directory listed by the
+        shared scan, with the entries routed to this view"""
+        listing, mtimes = self.shared.get_listing(self.name)
+        self.scanned = dict((path, (mtime, True)) for path, mtime in mtimes.items())
+        self.pruned = self.shared.scanner.pruned
+        self.skipped = self.shared.scanner.skipped
+        yield from listing
+
+
+    def unsettle(self, dir_path) -> None:
+        """Record that a directory has files still to be synced"""
+        rel_path = self.relative_path(dir_path)
+        self.scanned[rel_path] = (self.scanned[rel_path][0], False)
+        self.shared.unsettle(rel_path)
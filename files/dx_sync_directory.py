@@ -7,25 +7,79 @@ gzipped tar files containing bundles of recently modified files.
 """
 
 import argparse
+import functools
+import glob
+import grp
+import hashlib
 import json
 import os
 import os.path
+import pwd
+import queue
+import shutil
+import stat
 import sys
 import tarfile
 import time
 import tempfile
-import re
 import subprocess
-import dxpy
-import dxpy.utils.resolver
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "."))
+
+from bandwidth import BUCKET_FILE, TokenBucket, get_rate, parse_schedule
+from change_feed import ChangeFeed, RESCAN, TREE, WATCHING
+from dir_scan import DirScanner
+from io_governor import IOGovernor
+from lazy_import import is_loaded, lazy_import
+from manifest import get_manifest_path, get_tar_index, write_manifest
+from part_upload import (MIN_PART_SIZE, PartHasher, PartUploader, StreamingPartWriter,
+                         find_mismatched_parts, format_upload_stats, get_part_count,
+                         get_upload_part_size, get_uploaded_parts, upload_file_parts)
+from path_matcher import PathMatcher
+from space_ledger import LEDGER_FILE, SpaceLedger
+from sync_state import SyncState
+from upload_control import UploadController
+from tar_packing import PACKING, pack_balanced, pack_sequential
+from tar_index import TarIndex, get_index_path
+from tar_codecs import (CODECS, DEFAULT_LEVELS, EXTENSIONS, CompressionPolicy,
+                        TarCompressor, check_codec_available, format_stats, merge_stats)
+
+# Only imported once there is something to upload or remove
+dxpy = lazy_import('dxpy')
+
+# Suffix of tar files whilst they are being built
+PARTIAL_SUFFIX = '.part'
+
+# Seconds a tar file waits for space in the tar directory before the
+# sync gives up
+SPACE_WAIT = 3600
+
+# Number of newly uploaded parts of a streamed tar file after which the
+# log is rewritten to record them
+PARTS_PER_LOG_UPDATE = 20
+
+# Outcomes of checking a file found by a scan or in the change feed
+UPLOAD = 'upload'
+NOT_READY = 'not ready'
+SKIP = 'skip'
+UNCHANGED = 'unchanged'     # rewritten with the data it was synced with
+DEFERRED = 'deferred'       # changed too often, left for --finish
+
+# Suffix added to the log file path to give the path of the SQLite
+# database the log is kept in between runs
+STATE_SUFFIX = '.db'
 
 # For more information about script and inputs run the script with --help option
 # $ python3 dx_sync_directory.py --help
 #
 # Log file structure:
 #
-#  The log file is contains a serialized JSON object containing the
-#  following keys and values:
+#  The log is kept in a SQLite database alongside the log file (see
+#  sync_state.py), which is updated in a single transaction after each
+#  step. The log file itself is written on --finish (and read once to
+#  import the log of a run started by an earlier version) and contains
+#  a serialized JSON object containing the following keys and values:
 #
 #   sync_dir: the path to the local directory to by synchronized
 #
@@ -38,14 +92,32 @@ import dxpy.utils.resolver
 #   exclude_patterns: An array of patterns of files to exclude from the sync
 #
 #   tar_files: an object describing the status of each of the tar
-#   files to be uploaded. Each key is the local path to the tar file;
-#   the corresponding values are objects with the following
-#   keys/values:
+#   files to be uploaded. Each key is the local path to the tar file
+#   (or just its name if it was streamed with --stream); the
+#   corresponding values are objects with the following keys/values:
+#
+#     index: the index of the tar file, used in its name
 #
 #     status: one of the following strings:
 #       "tarred" -- the tar file has been created, but not yet (successfully) uploaded
+#       "streaming" -- the tar file is being streamed straight to the platform
 #       "uploaded" -- the tar file has been successfully uploaded, but not yet locally removed
 #       "removed" -- the tar file has been successfully uploaded and removed from the local filesystem
+#       "abandoned" -- streaming was interrupted, the files in it will be sent in a new tar
+#
+#     streamed: true if the tar file was never written locally
+#
+#     parts: (streamed tar files, and tar files uploaded with
+#     --builtin-upload or --dxpy-upload) an object keyed by part index
+#     giving the size and md5 of each part uploaded so far
+#
+#     part_size: the size of each part other than the last
+#
+#     part_md5s: the md5 of each part of the tar file, computed as it was
+#     written; the parts on the platform are checked against these
+#     before the file is closed and the tar file recorded as uploaded
+#
+#     sha256: (with --sha256 only) the sha256 of the whole tar file
 #
 #     timestamps [Python's time.time() timestamp]
 #       "tar_start"
@@ -55,7 +127,27 @@ import dxpy.utils.resolver
 #       "remove_start"
 #       "remove_end"
 #
-#     file_id: file ID of the uploaded file in the platform
+#     file_id: file ID of the uploaded file in the platform, set as soon
+#     as the platform file is opened when uploading or streaming in parts
+#
+#     index_file_id: file ID of the index of the tar file's members
+#     uploaded next to it (see tar_index.py), used to read single files
+#     from it with ranged reads
+#
+#   compression_stats: an object keyed by compression policy pattern
+#   giving the bytes in and out of the compressor for files matching it,
+#   and for stored files the bytes in and out of a test compression of
+#   a sample of them, used to tune the policy
+#
+#   change_feed: (with --change-feed only) how far the change feed has
+#   been read: the epoch of the watcher writing it, the sequence number
+#   of the last change read, the time of the last full scan and the
+#   files (relative to sync_dir) to check again next time: those not yet
+#   old enough to sync, and those found to sync, in case they are held
+#   back or fail to upload
+#
+#   upload_control: (with --adaptive-upload only) the threads and part
+#   size uploads were left at, which the next invocation starts from
 #
 #   next_tar_index: number giving the index of the next tar file to be
 #   created; used to construct the name of the file.
@@ -65,9 +157,27 @@ import dxpy.utils.resolver
 #   objects with the following keys/values:
 #
 #    mtime: the file's modified timestamp at the time it
-#    was synced
+#    was synced (with --dedup-content, or when it was last found
+#    rewritten with the data it was synced with)
 #
 #    size: the file's size, used to determine if tarball has met minimum size to upload
+#
+#    md5: (regular files only) the md5 of the file's data as it was tarred
+#
+#    tar_index: the index of the tar file the file is in
+#
+#    offset: (regular files only) the offset of the file's data in the
+#    uncompressed tar stream
+#
+#    changes: the number of times the file has been synced again after
+#    changing, files changed --churn-threshold times are left for --finish
+#
+#  On --finish the files are also written to a manifest next to the log
+#  file (see manifest.py), with the file ID of the tar file each is in.
+#
+#  In the database, file paths are stored relative to sync_dir, with
+#  each directory path stored once along with its mtime at the last
+#  scan and whether all of its files had been synced (see dir_scan.py).
 
 # Testing:
 #
@@ -99,18 +209,10 @@ import dxpy.utils.resolver
 # TODO:
 #
 # - Use dx environment to get default for --tar-destination?
-#
-# - Compress log to save space? Test on large runs and determine whether
-#   it's necessary. It may be better not to, in order to prevent
-#   corruption.
-#
-# - Another idea to avoid possible log corruption: don't overwrite the
-#   existing log file; instead, write to a new file, then move it
-#   (i.e., rename it to have the same name as the existing log file).
 
-def parse_args():
-    """Parse the command-line arguments and canonicalize file path
-    arguments."""
+def parse_args(argv=None):
+    """Parse the command-line arguments (or argv) and canonicalize file
+    path arguments."""
 
     parser = argparse.ArgumentParser(description='Script to "synchronize" a local directory into the platform. This does not' +
                                     '\n' + 'transfer files into the platform one-by-one, but rather uploads gzipped tar' +
@@ -170,12 +272,148 @@ def parse_args():
                         '\n' + '--min-tar-size. DEFAULT=75 MB' +
                         '\n' +
                         '\n')
+    parser.add_argument('--packing', choices=PACKING,
+                        help='How files are split into tar files. "balanced"' +
+                        '\n' + 'keeps the files in each directory together and' +
+                        '\n' + 'makes the tar files near equal in size, holding' +
+                        '\n' + 'back files too few to fill a tar file of' +
+                        '\n' + '--min-tar-size until the next invocation.' +
+                        '\n' + '"sequential" fills each tar file in turn in the' +
+                        '\n' + 'order files are found. DEFAULT=balanced' +
+                        '\n' +
+                        '\n')
     parser.add_argument('--upload-threads', '-u', type=int, metavar='<int>',
                         help='Number of upload threads launched by Upload Agent' +
+                        '\n' + '(or used by --builtin-upload and --dxpy-upload)' +
                         '\n' + '(Decrease to improve stability in low-bandwidth' +
                         '\n' + 'connections), DEFAULT=8' +
                         ']n' +
                         '\n')
+    parser.add_argument('--bandwidth-schedule', metavar='<HH:MM-HH:MM=Mbit/s>', nargs='*',
+                        help='Limit the rate tar files are uploaded at during' +
+                        '\n' + 'each window of the day (local time) given, e.g.' +
+                        '\n' + '07:00-19:00=200. The limit is shared by every' +
+                        '\n' + 'upload using the same --tar-directory. Uploads' +
+                        '\n' + 'outside every window are not limited.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--space-budget', type=int, metavar='<MB>',
+                        help='Most space (in MB) that tar files being built or' +
+                        '\n' + 'waiting to be uploaded may take up in' +
+                        '\n' + '--tar-directory, shared by every sync using it.' +
+                        '\n' + 'Space is always reserved for each tar file before' +
+                        '\n' + 'it is built, within the free space on the disk; a' +
+                        '\n' + 'tar file is built from fewer files if not all fit,' +
+                        '\n' + 'or waits for space if not even one does.' +
+                        '\n' + 'DEFAULT is no limit beyond free space.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--gentle-io', action='store_true',
+                        help='Build tar files without getting in the way of the' +
+                        '\n' + 'instrument: read files without keeping them in the' +
+                        '\n' + 'page cache, and build and compress tar files at a' +
+                        '\n' + 'low CPU and I/O priority. Streamed tar files are' +
+                        '\n' + 'only read without being cached.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--yield-to-writes', type=float, metavar='<MB/s>',
+                        help='Pause reading files into tar files whilst other' +
+                        '\n' + 'processes write to the disk holding the sync' +
+                        '\n' + 'directory faster than this, for at most a minute' +
+                        '\n' + 'at a time. Not used for network file systems.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream each tar file straight to the platform as it' +
+                        '\n' + 'is created, instead of writing it to --tar-directory' +
+                        '\n' + 'and uploading it afterwards. The tar file is cut into' +
+                        '\n' + 'parts of --part-size in memory, with at most' +
+                        '\n' + '--upload-threads parts held in memory at once.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compress-threads', type=int, metavar='<int>',
+                        help='Number of threads to compress tar files on. Tar' +
+                        '\n' + 'files are compressed as independent blocks in' +
+                        '\n' + 'parallel (as pigz does). DEFAULT=1' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--codec', choices=CODECS,
+                        help='Compression applied to tar files. With "none" the' +
+                        '\n' + 'tar files are not compressed at all, which pairs' +
+                        '\n' + 'with the --do-not-compress flag passed to the' +
+                        '\n' + 'Upload Agent. DEFAULT=gzip' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compress-level', type=int, metavar='<int>',
+                        help='Compression level for files that are compressed.' +
+                        '\n' + 'DEFAULT=9 for gzip, 3 for zstd' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--compress-policy', metavar='<file>',
+                        help='JSON file of [<regex>, "store"|"compress"] pairs.' +
+                        '\n' + 'The first pattern matching the full path of a file' +
+                        '\n' + 'decides whether it is compressed or stored as is in' +
+                        '\n' + 'the tar file. Files matching no pattern are' +
+                        '\n' + 'compressed. DEFAULT: store CBCL, BCL and other' +
+                        '\n' + 'compressed files, compress everything else' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--pipeline-depth', type=int, metavar='<int>',
+                        help='Number of built tar files that may wait to be' +
+                        '\n' + 'uploaded whilst the next tar file is built, so' +
+                        '\n' + 'that tarring and uploading overlap. Limited further' +
+                        '\n' + 'by free space in --tar-directory. 0 tars and' +
+                        '\n' + 'uploads each file in turn. DEFAULT=1' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--prune-unchanged-dirs', action='store_true',
+                        help='Skip listing directories in which every file has' +
+                        '\n' + 'been synced and nothing has been added or removed' +
+                        '\n' + 'since the last scan. A file rewritten in place in' +
+                        '\n' + 'such a directory is not picked up until --finish,' +
+                        '\n' + 'which always scans the whole directory.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--change-feed', metavar='<path>',
+                        help='Change feed database written by a watcher of the' +
+                        '\n' + 'sync dir (see change_feed.py). Files to sync are' +
+                        '\n' + 'found from the changes recorded since the last' +
+                        '\n' + 'invocation, falling back to scanning the sync dir' +
+                        '\n' + 'if the watcher may have missed any.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--full-scan-interval', type=int, metavar='<seconds>',
+                        help='With --change-feed, scan the whole sync dir if it' +
+                        '\n' + 'has not been scanned for this long, to pick up any' +
+                        '\n' + 'changes the watcher missed. DEFAULT=3600' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--part-size', type=int, metavar='<MB>',
+                        help='Size of each part uploaded when --stream,' +
+                        '\n' + '--builtin-upload or --dxpy-upload is given. An' +
+                        '\n' + 'interrupted upload resumes from the parts already' +
+                        '\n' + 'uploaded. DEFAULT=25 MB' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--adaptive-upload', action='store_true',
+                        help='Adjust the number of parts uploaded at once and' +
+                        '\n' + 'the part size as uploads run, from the throughput' +
+                        '\n' + 'of each part and the errors hit, starting from' +
+                        '\n' + '--upload-threads and --part-size (or where the' +
+                        '\n' + 'last invocation left them). Needs' +
+                        '\n' + '--builtin-upload or --dxpy-upload.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--max-upload-threads', type=int, metavar='<int>',
+                        help='With --adaptive-upload, the most parts uploaded' +
+                        '\n' + 'at once. DEFAULT=twice --upload-threads' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--max-part-size', type=int, metavar='<MB>',
+                        help='With --adaptive-upload, the largest part size.' +
+                        '\n' + 'DEFAULT=4 times --part-size' +
+                        '\n' +
+                        '\n')
     parser.add_argument('--include-patterns', '-i', metavar='<regex>', nargs='*',
                         help='An optional list of regex patterns to search for.' +
                         '\n' + 'If 1 or more regex patterns are given, then' +
@@ -207,6 +445,20 @@ def parse_args():
                         '\n' +
                         '\n')
 
+    parser.add_argument('--sha256', action='store_true',
+                        help='Also compute the sha256 of each tar file as it is' +
+                        '\n' + 'written, and record it in the log alongside the md5' +
+                        '\n' + 'of each part which uploads are checked against.' +
+                        '\n' +
+                        '\n')
+    parser.add_argument('--builtin-upload', action='store_true',
+                        help='Upload tar files with the built in uploader instead' +
+                        '\n' + 'of the default Upload Agent (ua). It sends parts of' +
+                        '\n' + '--part-size on --upload-threads threads over' +
+                        '\n' + 'shared keep-alive connections.' +
+                        '\n' +
+                        '\n')
+
     upload_debug_group = parser.add_mutually_exclusive_group(required=False)
     upload_debug_group.add_argument('--dxpy-upload', '-d', action='store_true',
                                     help='This flag allows you to specify whether to use dxpy' +
@@ -246,9 +498,36 @@ def parse_args():
                            '\n' +
                            '\n')
 
+    parser.add_argument('--stable-scans', type=int, metavar='<int>',
+                        help='Sync files modified within --min-age once they' +
+                        '\n' + 'have been seen with the same size and mtime by' +
+                        '\n' + 'this many invocations in a row, or (with' +
+                        '\n' + '--change-feed) seen closed after writing with the' +
+                        '\n' + 'mtime they still have. --min-age still caps how' +
+                        '\n' + 'long any file waits. At least 2.' +
+                        '\n' +
+                        '\n')
+
+    parser.add_argument('--dedup-content', action='store_true',
+                        help='Check whether synced files modified since they were' +
+                        '\n' + 'synced still have the same size and md5, and if' +
+                        '\n' + 'so record their new mtime rather than tarring them' +
+                        '\n' + 'again. Only files of the same size are read.' +
+                        '\n' +
+                        '\n')
+
+    parser.add_argument('--churn-threshold', type=int, metavar='<int>',
+                        help='Leave files which have been synced again after' +
+                        '\n' + 'changing this many times (e.g. InterOp files' +
+                        '\n' + 'rewritten every cycle) to be synced by --finish,' +
+                        '\n' + 'rather than adding them to yet another tar file.' +
+                        '\n' + 'At least 1.' +
+                        '\n' +
+                        '\n')
+
     parser.add_argument('sync_dir', metavar='<directory>', help='Directory to sync.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 def check_inputs(args):
@@ -274,6 +553,30 @@ def check_inputs(args):
         args.include_patterns = []
     if not args.exclude_patterns:
         args.exclude_patterns = []
+    args.include_patterns = list(dict.fromkeys(args.include_patterns))
+    args.exclude_patterns = list(dict.fromkeys(args.exclude_patterns))
+    if not args.part_size:
+        args.part_size = 25
+    if not args.compress_threads:
+        args.compress_threads = 1
+    if not args.upload_threads:
+        args.upload_threads = 8
+    if not args.max_upload_threads:
+        args.max_upload_threads = 2 * args.upload_threads
+    if not args.max_part_size:
+        args.max_part_size = 4 * args.part_size
+    if not args.codec:
+        args.codec = 'gzip'
+    if args.pipeline_depth is None:
+        args.pipeline_depth = 1
+    if not args.packing:
+        args.packing = 'balanced'
+    if args.full_scan_interval is None:
+        args.full_scan_interval = 3600
+    if args.change_feed:
+        args.change_feed = os.path.abspath(args.change_feed)
+    if args.compress_level is None and args.codec != 'none':
+        args.compress_level = DEFAULT_LEVELS[args.codec]
 
     # Canonicalize paths
     args.tar_directory = os.path.abspath(args.tar_directory)
@@ -287,25 +590,82 @@ def check_inputs(args):
     # Convert min & max sizes to MB
     args.max_tar_size = args.max_tar_size * 2**20
     args.min_tar_size = args.min_tar_size * 2**20
+    args.part_size = args.part_size * 2**20
+    args.max_part_size = args.max_part_size * 2**20
     if args.max_tar_size <= args.min_tar_size:
         sys.exit("--max-tar-size must be greater than --min-tar-size")
+    if args.compress_threads < 1:
+        sys.exit("--compress-threads must be at least 1")
+    try:
+        check_codec_available(args.codec)
+        if args.compress_policy:
+            args.compress_policy = CompressionPolicy.load(os.path.abspath(args.compress_policy))
+        else:
+            args.compress_policy = CompressionPolicy()
+    except (RuntimeError, ValueError, OSError) as e:
+        sys.exit("ERROR: %s" % e)
+    if args.builtin_upload and args.dxpy_upload:
+        sys.exit("--builtin-upload and --dxpy-upload are mutually exclusive")
+    args.upload_agent = not (args.builtin_upload or args.dxpy_upload)
+    try:
+        args.bandwidth_schedule = parse_schedule(args.bandwidth_schedule or [])
+    except ValueError as e:
+        sys.exit("ERROR: %s" % e)
+    if args.bandwidth_schedule and args.dxpy_upload:
+        sys.exit("--bandwidth-schedule cannot be used with --dxpy-upload")
+    if args.bandwidth_schedule and args.stream and not args.builtin_upload:
+        sys.exit("--bandwidth-schedule needs --builtin-upload with --stream")
+    if args.part_size < MIN_PART_SIZE:
+        sys.exit("--part-size must be at least %d MB" % (MIN_PART_SIZE // 2**20))
+    if args.adaptive_upload and args.upload_agent:
+        sys.exit("--adaptive-upload needs --builtin-upload or --dxpy-upload")
+    if args.max_upload_threads < args.upload_threads:
+        sys.exit("--max-upload-threads must be at least --upload-threads")
+    if args.max_part_size < args.part_size:
+        sys.exit("--max-part-size must be at least --part-size")
+    if args.stable_scans is not None and args.stable_scans < 2:
+        sys.exit("--stable-scans must be at least 2")
+    if args.churn_threshold is not None and args.churn_threshold < 1:
+        sys.exit("--churn-threshold must be at least 1")
+    if args.space_budget is not None and args.space_budget < 1:
+        sys.exit("--space-budget must be at least 1 MB")
+    if args.yield_to_writes is not None and args.yield_to_writes <= 0:
+        sys.exit("--yield-to-writes must be above 0")
+
+    args.space_ledger = SpaceLedger(
+        os.path.join(args.tar_directory, LEDGER_FILE),
+        args.space_budget * 2**20 if args.space_budget else None
+    )
+    args.governor = IOGovernor(
+        args.gentle_io, args.yield_to_writes * 2**20 if args.yield_to_writes else None,
+        args.sync_dir
+    )
 
     return args
 
 def read_log(args):
-    """Reads the log file."""
+    """Reads the log from the sync state database, importing the log
+    file into it if the database has not been created yet."""
 
     print('\n--- Reading log file...', file=sys.stderr)
 
-    if os.path.exists(args.log_file):
-        with open(args.log_file, 'r') as logf:
-            return json.load(logf)
-    else:
-        print('Log file not found, returning empty log.', file=sys.stderr)
-        return {'tar_files': {}, 'next_tar_index': 0, 'files': {},
+    if getattr(args, 'state', None) is None:
+        args.state = SyncState(args.log_file + STATE_SUFFIX, args.sync_dir)
+
+    if args.state.is_empty():
+        if os.path.exists(args.log_file):
+            print('Importing log file into %s' % args.state.db_path, file=sys.stderr)
+            with open(args.log_file, 'r') as logf:
+                args.state.import_log(json.load(logf))
+        else:
+            print('Log file not found, returning empty log.', file=sys.stderr)
+            args.state.import_log({
+                'tar_files': {}, 'next_tar_index': 0, 'files': {},
                 'tar_destination': args.tar_destination, 'file_prefix': args.prefix,
                 'sync_dir': args.sync_dir, 'include_patterns': args.include_patterns,
-                'exclude_patterns': args.exclude_patterns}
+                'exclude_patterns': args.exclude_patterns})
+
+    return args.state.load()
 
 def check_log(log, args):
     print('\n--- Checking that log matches inputs', file=sys.stderr)
@@ -339,66 +699,564 @@ def check_log(log, args):
 
     return
 
-def get_files_to_upload(log, args):
+def get_files_to_upload(log, args, scanner=None):
     """Traverses the directory to be synced, and identifies which
     files should be synced. Exclude files which match patterns to exclude.
-    If include_patterns is specified, include only files which match."""
+    If include_patterns is specified, include only files which match.
+    Directories which exclude every path below them are not descended
+    into. With --change-feed, only the files changed since the last
+    invocation are checked where possible. scanner is walked in place
+    of scanning the directory, e.g. a view of a scan shared between
+    lanes (see dir_scan.SharedScan). Returns the stat of each file to
+    sync, keyed on its path."""
 
     print("\n--- Getting files to upload in %s ..." % args.sync_dir, file=sys.stderr)
 
     cur_time = int(time.time())
-    to_upload = []
+    to_upload = {}
+    not_ready = []
+    skipped = {UNCHANGED: [], DEFERRED: []}
+
+    include = PathMatcher(args.include_patterns)
+    exclude = PathMatcher(args.exclude_patterns)
+    closed = None
+
+    if args.change_feed:
+        feed = ChangeFeed(args.change_feed)
+        try:
+            if args.stable_scans:
+                closed = feed.closed_mtimes((log.get('change_feed') or {}).get('seq', 0))
+            feed_upload = read_change_feed(feed, cur_time, include, exclude, log, args, closed)
+            if feed_upload is not None:
+                return feed_upload
+
+            # Changes made whilst scanning are read again next time
+            feed_state, feed_epoch = feed.status()
+            feed_seq = feed.last_seq()
+        finally:
+            feed.close()
+
+    # Always list every directory when finishing, to pick up any files
+    # rewritten in place in directories that were pruned
+    if scanner is None:
+        known_dirs = None
+        if args.prune_unchanged_dirs and not args.finish:
+            known_dirs = args.state.get_dir_scans()
+        scanner = DirScanner(args.sync_dir, known_dirs, skip_dir=exclude.matches_below)
+
+    for dir_path, entries in scanner.walk():
+        if cur_time - scanner.scanned[scanner.relative_path(dir_path)][0] <= args.min_age:
+            scanner.unsettle(dir_path)
+
+        for full_path, entry_stat in entries:
+            status = check_file(full_path, entry_stat, cur_time, include, exclude, log, args,
+                                closed)
+            if status == UPLOAD:
+                to_upload[full_path] = entry_stat
+                scanner.unsettle(dir_path)
+            elif status == NOT_READY:
+                not_ready.append(full_path)
+                scanner.unsettle(dir_path)
+            elif status in skipped:
+                skipped[status].append(entry_stat.st_size)
+
+    args.state.record_dir_scans(scanner.scanned)
+    args.state.save_observations()
+    print_skipped(skipped)
+    if scanner.pruned:
+        print("Skipped listing %d unchanged directories" % scanner.pruned, file=sys.stderr)
+    if scanner.skipped:
+        print("Skipped %d excluded directories" % scanner.skipped, file=sys.stderr)
+
+    if args.change_feed:
+        log['change_feed'] = {'epoch': feed_epoch if feed_state == WATCHING else None,
+                              'seq': feed_seq,
+                              'full_scan': cur_time,
+                              'recheck': [os.path.relpath(f, args.sync_dir)
+                                          for f in not_ready + list(to_upload)]}
+    if args.change_feed or skipped[UNCHANGED]:
+        update_log(log, args)
+    if args.change_feed:
+        feed = ChangeFeed(args.change_feed)
+        try:
+            feed.mark_read(args.log_file, feed_seq)
+        finally:
+            feed.close()
 
-    for root, dirs, files in os.walk(args.sync_dir):
-        for name in dirs + files:
-            full_path = os.path.join(root, name)
-            cur_mtime = os.path.getmtime(full_path)
+    return to_upload
 
-            # Python empty list is false
-            if args.exclude_patterns and full_path_matches_pattern(full_path, args.exclude_patterns):
-                continue
-            if args.include_patterns and not full_path_matches_pattern(full_path, args.include_patterns):
-                continue
+def check_file(full_path, entry_stat, cur_time, include, exclude, log, args, closed=None):
+    """Decides whether a file found is to be synced: SKIP if it is
+    excluded or already synced, NOT_READY if it was modified too
+    recently and may still be being written, UNCHANGED if (with
+    --dedup-content) it was modified but still has the data it was
+    synced with, DEFERRED if it has changed --churn-threshold times
+    already and is left for --finish, otherwise UPLOAD. closed gives
+    the mtime files were seen closed with by the change feed.
+    Directories are only synced when first found."""
+
+    if exclude and exclude.matches(full_path):
+        return SKIP
+    if include and not include.matches(full_path):
+        return SKIP
+
+    synced = log['files'].get(full_path)
+    if synced is not None and stat.S_ISDIR(entry_stat.st_mode):
+        # a directory's mtime changes as files are added to it, but the
+        # tar files only need its entry once, so one still being
+        # written to is not held back as not ready
+        return SKIP
+
+    cur_mtime = entry_stat.st_mtime
+    if cur_time - cur_mtime <= args.min_age and not is_written(full_path, entry_stat, closed, args):
+        return NOT_READY
+
+    if synced is None:
+        return UPLOAD
+    if cur_mtime > synced['mtime']:
+        if args.dedup_content and has_synced_content(full_path, entry_stat, synced):
+            # recorded so it is not read again until next modified
+            log['files'][full_path] = dict(synced, mtime=cur_mtime)
+            return UNCHANGED
+        if (args.churn_threshold and not args.finish
+                and synced.get('changes', 0) >= args.churn_threshold):
+            return DEFERRED
+        return UPLOAD
+
+    return SKIP
+
+def has_synced_content(full_path, entry_stat, synced):
+    """Whether a synced file has the same size and md5 as when it was
+    synced. Only regular files of the same size are read."""
+
+    if (not synced.get('md5') or synced.get('size') != entry_stat.st_size
+            or not stat.S_ISREG(entry_stat.st_mode)):
+        return False
 
-            if cur_time - cur_mtime > args.min_age:
-                if (full_path not in log['files']) or (cur_mtime > log['files'][full_path]['mtime']):
-                    to_upload.append(full_path)
+    try:
+        with open(full_path, 'rb') as f_obj:
+            reader = HashingReader(f_obj)
+            while reader.read(2**20):
+                pass
+    except OSError:
+        return False
+    return reader.md5.hexdigest() == synced['md5']
+
+def print_skipped(skipped):
+    """Reports the files found rewritten with unchanged content or left
+    for --finish, given the sizes of each keyed on outcome."""
+
+    messages = {UNCHANGED: "rewritten with unchanged content",
+                DEFERRED: "changed too often, left for --finish"}
+    for status, sizes in skipped.items():
+        if sizes:
+            print("Skipped %d files (%.1f MB) %s" % (
+                len(sizes), sum(sizes) / 2**20, messages[status]), file=sys.stderr)
+
+def is_written(full_path, entry_stat, closed, args):
+    """With --stable-scans, whether a file modified within --min-age
+    has finished being written: it has been seen unchanged by
+    --stable-scans invocations in a row, or closed after writing with
+    the mtime it has now."""
+
+    if not args.stable_scans:
+        return False
+
+    was_closed = bool(closed) and closed.get(full_path) == entry_stat.st_mtime
+    scans, was_closed = args.state.observe(full_path, entry_stat.st_size, entry_stat.st_mtime,
+                                           was_closed)
+    return was_closed or scans >= args.stable_scans
+
+def read_change_feed(feed, cur_time, include, exclude, log, args, closed=None):
+    """Finds the files to sync from the changes recorded in the change
+    feed since it was last read, along with the files which were not
+    ready to sync last time. Returns None if the sync dir needs a full
+    scan instead, as changes may have been missed."""
+
+    cursor = log.get('change_feed')
+    feed_state, feed_epoch = feed.status()
+
+    if args.finish or cursor is None:
+        return None
+    if feed_state != WATCHING or cursor['epoch'] != feed_epoch:
+        print("Change feed is not complete since the last scan (watcher %s), "
+              "scanning sync dir" % (feed_state or 'not started'), file=sys.stderr)
+        return None
+    if cur_time - cursor['full_scan'] >= args.full_scan_interval:
+        print("Sync dir not scanned for %d seconds, scanning to reconcile change feed" %
+              args.full_scan_interval, file=sys.stderr)
+        return None
+    if cursor['seq'] < feed.deleted_seq():
+        print("Changes since the last read have been deleted from the change feed, "
+              "scanning sync dir", file=sys.stderr)
+        return None
+
+    changes = feed.read(cursor['seq'])
+
+    candidates = set(os.path.join(args.sync_dir, f) for f in cursor.get('recheck', []))
+    for _, path, kind in changes:
+        if kind == RESCAN:
+            print("Change feed may have missed changes in %s, scanning sync dir" % path,
+                  file=sys.stderr)
+            return None
+        candidates.add(path)
+        if kind == TREE:
+            for _, entries in DirScanner(path, skip_dir=exclude.matches_below).walk():
+                candidates.update(full_path for full_path, _ in entries)
+
+    print("Checking %d files from %d changes in change feed" % (len(candidates), len(changes)),
+          file=sys.stderr)
+
+    to_upload = {}
+    not_ready = []
+    skipped = {UNCHANGED: [], DEFERRED: []}
+    for full_path in sorted(candidates):
+        if not full_path.startswith(args.sync_dir + os.sep):
+            continue
+        try:
+            entry_stat = os.lstat(full_path)
+        except FileNotFoundError:
+            continue
+
+        status = check_file(full_path, entry_stat, cur_time, include, exclude, log, args,
+                            closed)
+        if status == UPLOAD:
+            to_upload[full_path] = entry_stat
+        elif status == NOT_READY:
+            not_ready.append(os.path.relpath(full_path, args.sync_dir))
+        elif status in skipped:
+            skipped[status].append(entry_stat.st_size)
+
+    args.state.save_observations()
+    print_skipped(skipped)
+
+    if changes:
+        cursor['seq'] = changes[-1][0]
+    cursor['recheck'] = not_ready + [os.path.relpath(f, args.sync_dir) for f in to_upload]
+    log['change_feed'] = cursor
+    update_log(log, args)
+    feed.mark_read(args.log_file, cursor['seq'])
 
     return to_upload
 
-def full_path_matches_pattern(full_path, patterns_list):
-    for pattern in patterns_list:
-        if re.search(pattern, full_path):
-            return True
-    return False
-
 def split_into_tar_files(files_to_upload, log, args):
-    """Split list so tar files uploaded are not greater than max_tar_size"""
+    """Split list so tar files uploaded are not greater than max_tar_size.
+    With --packing balanced, the files in each directory are kept
+    together and the tar files are near equal in size, and a remainder
+    too small for a tar file of min_tar_size is held back until the
+    next invocation unless finishing."""
 
     print("\n--- Splitting into tar files to upload...", file=sys.stderr)
 
-    tars_to_upload = []
-    current_tar = {"size": 0, "files": []}
-    total_size = 0
-    for f in files_to_upload:
-        fsize = os.path.getsize(f)
-        if current_tar["size"] + fsize > args.max_tar_size:
-            tars_to_upload.append(current_tar)
-            current_tar = {"size": 0, "files": []}
-        current_tar["files"].append(f)
-        current_tar["size"] += fsize
-        total_size += fsize
-    tars_to_upload.append(current_tar)
+    files = [(f, f_stat.st_size, stat.S_ISDIR(f_stat.st_mode))
+             for f, f_stat in files_to_upload.items()]
+    total_size = sum(size for _, size, _ in files)
 
     if total_size < args.min_tar_size:
         print('QUITTING: Size of files to upload is not big ' +
                 'enough to to be uploaded yet. Please run again later or ' +
                 'specify --min-tar-size to be smaller', file=sys.stderr)
-        print(f'Files found to upload: {files_to_upload}', file=sys.stderr)
+        print(f'Files found to upload: {list(files_to_upload)}', file=sys.stderr)
         return []
 
+    if args.packing == 'sequential':
+        tar_paths = pack_sequential(files, args.max_tar_size)
+    else:
+        tar_paths, held_back = pack_balanced(
+            files, args.max_tar_size, args.min_tar_size, args.finish
+        )
+        if held_back:
+            print("Holding back %d files (%.1f MB) until there are enough to "
+                  "fill a tar file" % (len(held_back), sum(
+                      files_to_upload[f].st_size for f in held_back) / 2**20),
+                  file=sys.stderr)
+
+    tars_to_upload = []
+    for paths in tar_paths:
+        stats = dict((f, files_to_upload[f]) for f in paths)
+        tars_to_upload.append({"size": sum(x.st_size for x in stats.values()),
+                               "files": paths, "stats": stats})
+
+    print("Split %d files into %d tar files of %s MB" % (
+        len(files), len(tars_to_upload),
+        ', '.join('%.1f' % (x['size'] / 2**20) for x in tars_to_upload)
+    ), file=sys.stderr)
+
     return tars_to_upload
 
+def get_tar_filename(log, args):
+    """Name of the next tar file to be created."""
+
+    return "%s_%03d%s" % (log['file_prefix'], log['next_tar_index'], EXTENSIONS[args.codec])
+
+def get_tar_destination(args):
+    """Resolve --tar-destination to a platform project and folder,
+    once for every upload made with args."""
+
+    if getattr(args, 'resolved_destination', None) is None:
+        import dxpy.utils.resolver
+        tar_destination_project, tar_destination_folder, _ = dxpy.utils.resolver.resolve_path(args.tar_destination, expected='folder')
+        args.resolved_destination = (tar_destination_project, tar_destination_folder)
+    return args.resolved_destination
+
+def open_tar_file(fileobj, args):
+    """Opens a tar stream writing to the given file object, compressed
+    with --codec on --compress-threads threads. Returns the tar file and
+    its compressor, both of which must be passed to close_tar_file.
+    compressor.start_file must be called before adding each file."""
+
+    compressor = TarCompressor(fileobj, args.codec, args.compress_level,
+                               args.compress_threads, args.compress_policy)
+    return tarfile.open(fileobj=compressor.fileobj, mode='w'), compressor
+
+def close_tar_file(tar_file, compressor):
+    """Finishes a tar stream opened by open_tar_file, returning its
+    compression stats."""
+
+    tar_file.close()
+    compressor.close()
+
+    if compressor.stats:
+        print("\n--- Compression by policy pattern:\n%s" % format_stats(compressor.stats),
+              file=sys.stderr)
+    return compressor.stats
+
+class TarBuildStopped(Exception):
+    """Raised in a tar builder whose pipeline has stopped"""
+
+def check_stopped(stop):
+    """Raises TarBuildStopped if stop (a threading.Event) is set"""
+
+    if stop is not None and stop.is_set():
+        raise TarBuildStopped("tar file build stopped")
+
+class HashingReader():
+    """Reads a file, computing the md5 of the data read from it, and
+    raising TarBuildStopped if stop is set whilst it is read"""
+
+    def __init__(self, fileobj, stop=None):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.stop = stop
+
+    def read(self, size=-1):
+        check_stopped(self.stop)
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+def add_to_tar(tar_file, f_abs, f_rel, f_stat, index=None, governor=None, stop=None):
+    """Adds a file to the tar file with a header built from the stat
+    taken when it was scanned, rather than statting it again, recording
+    where it was written in index if given. The file is read through
+    governor if given (see io_governor.py), raising TarBuildStopped if
+    stop is set whilst it is read. Returns the update to the
+    log's files for it, with the md5 of a regular file's data (computed
+    as it is read into the tar file) and the offset of the data in the
+    uncompressed tar stream."""
+
+    header_offset = tar_file.offset
+    tarinfo = tar_file.tarinfo(f_rel)
+    tarinfo.tarfile = tar_file
+    tarinfo.mode = stat.S_IMODE(f_stat.st_mode)
+    tarinfo.uid = f_stat.st_uid
+    tarinfo.gid = f_stat.st_gid
+    tarinfo.uname = get_user_name(f_stat.st_uid)
+    tarinfo.gname = get_group_name(f_stat.st_gid)
+    tarinfo.mtime = f_stat.st_mtime
+
+    if stat.S_ISREG(f_stat.st_mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = f_stat.st_size
+        with (governor.open(f_abs) if governor else open(f_abs, 'rb')) as f_obj:
+            reader = HashingReader(f_obj, stop)
+            tar_file.addfile(tarinfo, reader)
+        # the data ends the member, padded to a whole block
+        data_blocks = -(-f_stat.st_size // tarfile.BLOCKSIZE)
+        offset = tar_file.offset - data_blocks * tarfile.BLOCKSIZE
+        if index is not None:
+            index.add(f_rel, header_offset, offset, f_stat.st_size)
+        return {'mtime': f_stat.st_mtime, 'size': f_stat.st_size,
+                'md5': reader.md5.hexdigest(), 'offset': offset}
+    elif stat.S_ISDIR(f_stat.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+        tar_file.addfile(tarinfo)
+    elif stat.S_ISLNK(f_stat.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(f_abs)
+        tar_file.addfile(tarinfo)
+    else:
+        tar_file.add(f_abs, arcname=f_rel, recursive=False)
+
+    if index is not None:
+        index.add(f_rel, header_offset)
+    return {'mtime': f_stat.st_mtime, 'size': f_stat.st_size}
+
+@functools.lru_cache(maxsize=None)
+def get_user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ''
+
+@functools.lru_cache(maxsize=None)
+def get_group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ''
+
+def build_tar_file(files_to_upload, tar_full_path, args, stop=None):
+    """Writes the given files to a tar file at tar_full_path, without
+    touching the log. The tar file is written under a temporary name
+    and only moved into place once complete, so an interrupted build
+    never leaves a partial tar file that looks finished. Its index is
+    written next to it first. Space for it is reserved first, so it may
+    hold fewer of the files than given (see reserve_tar_space), and with
+    --gentle-io it is written by a low priority thread. Raises
+    TarBuildStopped if stop (a threading.Event) is set whilst waiting
+    for space or building the tar file, which is then discarded.
+    Returns the log entry for the tar file and the updates to the log's
+    files."""
+
+    print("\n--- Creating tar file %s..." % tar_full_path, file=sys.stderr)
+
+    files_to_upload = reserve_tar_space(files_to_upload, tar_full_path, args, stop)
+    paused = args.governor.paused
+    try:
+        built = args.governor.run(write_tar_file, files_to_upload, tar_full_path, args, stop)
+    except BaseException:
+        args.space_ledger.release(tar_full_path)
+        raise
+    if args.governor.paused > paused:
+        print("Paused reading for %d seconds whilst others wrote to the run's disk" %
+              (args.governor.paused - paused), file=sys.stderr)
+    return built
+
+def reserve_tar_space(files_to_upload, tar_full_path, args, stop=None):
+    """Reserves space in --tar-directory for the tar file of the given
+    files, waiting for space if there is not enough for even the first
+    file (or --min-tar-size), until stop is set. If not all the files
+    fit, returns those that do, and the rest are left for the next
+    sync. With --finish there is no next sync, so space for every file
+    is waited for."""
+
+    file_stats = files_to_upload.get("stats", {})
+    sizes = [(file_stats.get(f_abs) or os.lstat(f_abs)).st_size
+             for f_abs in files_to_upload["files"]]
+
+    tar_size_bound = get_tar_size_bound(sum(sizes), len(sizes))
+    min_size = max(get_tar_size_bound(sizes[0], 1), min(tar_size_bound, args.min_tar_size))
+    if args.finish:
+        min_size = tar_size_bound
+    try:
+        reserved = args.space_ledger.reserve(
+            tar_full_path, tar_size_bound, min_size,
+            paths=(tar_full_path + PARTIAL_SUFFIX, tar_full_path), timeout=SPACE_WAIT,
+            stop=stop
+        )
+    except TimeoutError as e:
+        sys.exit("ERROR: Not enough space to build %s: %s" % (tar_full_path, e))
+    if reserved == 0:
+        raise TarBuildStopped("stopped waiting for space to build %s" % tar_full_path)
+    if reserved >= tar_size_bound:
+        return files_to_upload
+
+    count = 1
+    while (count < len(sizes)
+           and get_tar_size_bound(sum(sizes[:count + 1]), count + 1) <= reserved):
+        count += 1
+    print("Only %.1f MB free in --tar-directory, tarring %d of %d files" %
+          (reserved / 2**20, count, len(sizes)), file=sys.stderr)
+
+    files = files_to_upload["files"][:count]
+    return {'size': sum(sizes[:count]), 'files': files,
+            'stats': dict((f, file_stats[f]) for f in files if f in file_stats)}
+
+def get_tar_size_bound(size, count):
+    """Most bytes a tar file of count files totalling size bytes may
+    take up. Allows for the tar headers and padding of each file, and
+    for incompressible data growing slightly."""
+
+    return int((size + 1536 * (count + 8)) * 1.01)
+
+def write_tar_file(files_to_upload, tar_full_path, args, stop=None):
+    """Writes a tar file for build_tar_file, once space is reserved.
+    If stop is set the partial tar file is removed at the next file or
+    read of one, and TarBuildStopped is raised."""
+
+    tar_start = time.time()
+    partial_path = tar_full_path + PARTIAL_SUFFIX
+    part_size = get_tar_part_size(files_to_upload, args)
+
+    log_updates = {}
+    index = TarIndex(args.codec)
+
+    try:
+        with open(partial_path, 'wb') as tar_fh:
+            hasher = PartHasher(tar_fh, part_size, with_sha256=args.sha256)
+            tar_file, compressor = open_tar_file(hasher, args)
+            file_stats = files_to_upload.get("stats", {})
+            for f_abs in files_to_upload["files"]:
+                check_stopped(stop)
+                f_rel = os.path.relpath(f_abs, args.sync_dir)
+                f_stat = file_stats.get(f_abs) or os.lstat(f_abs)
+                compressor.start_file(f_abs)
+                log_updates[f_abs] = add_to_tar(tar_file, f_abs, f_rel, f_stat, index,
+                                                args.governor, stop)
+            stats = close_tar_file(tar_file, compressor)
+    except TarBuildStopped:
+        print("Stopped building %s, removing it" % tar_full_path, file=sys.stderr)
+        os.remove(partial_path)
+        raise
+    part_md5s, tar_sha256 = hasher.finish()
+
+    index.finish(compressor.writer)
+    index.write(get_index_path(tar_full_path))
+    os.replace(partial_path, tar_full_path)
+    tar_end = time.time()
+
+    tar_entry = {'status': 'tarred',
+                 'size': files_to_upload["size"],
+                 'part_size': part_size,
+                 'part_md5s': part_md5s,
+                 'timestamps': {'tar_start': tar_start,
+                                'tar_end': tar_end}
+                }
+    if tar_sha256:
+        tar_entry['sha256'] = tar_sha256
+    return tar_entry, log_updates, stats
+
+def get_tar_part_size(files_to_upload, args):
+    """Part size the tar file for the given files will be hashed and
+    uploaded in: --part-size (as adjusted by --adaptive-upload), unless
+    the tar file could need more parts than the platform allows."""
+
+    tar_size_bound = get_tar_size_bound(files_to_upload["size"], len(files_to_upload["files"]))
+    return get_upload_part_size(tar_size_bound, get_part_size(args))
+
+def record_tar_file(tar_full_path, tar_entry, log_updates, stats, log, args):
+    """Records a newly built tar file and the files in it in the log."""
+
+    tar_entry['index'] = log['next_tar_index']
+    log['tar_files'][tar_full_path] = tar_entry
+    log['next_tar_index'] += 1
+    record_synced_files(log_updates, tar_entry['index'], log)
+    if stats:
+        log['compression_stats'] = merge_stats(log.get('compression_stats', {}), stats)
+    return update_log(log, args)
+
+def record_synced_files(log_updates, tar_index, log):
+    """Records the files added to a tar file in the log, counting how
+    many times each has been synced again after changing."""
+
+    for filename, update in log_updates.items():
+        update['tar_index'] = tar_index
+        synced = log['files'].get(filename)
+        if synced is not None:
+            update['changes'] = synced.get('changes', 0) + 1
+        log['files'][filename] = update
+
 def create_tar_file(files_to_upload, log, args):
     """Create a tar file containing the given files to be uploaded."""
 
@@ -406,32 +1264,368 @@ def create_tar_file(files_to_upload, log, args):
         print("\n--- No files to upload, skipping tar file creation...", file=sys.stderr)
         return log
 
-    tar_filename = "%s_%03d.tar.gz" % (log['file_prefix'], log['next_tar_index'])
-    tar_full_path = os.path.join(args.tar_directory, tar_filename)
+    tar_full_path = os.path.join(args.tar_directory, get_tar_filename(log, args))
 
-    print("\n--- Creating tar file %s..." % tar_full_path, file=sys.stderr)
+    tar_entry, log_updates, stats = build_tar_file(files_to_upload, tar_full_path, args)
+
+    return record_tar_file(tar_full_path, tar_entry, log_updates, stats, log, args)
+
+def stream_tar_file(files_to_upload, log, args):
+    """Create a tar file containing the given files to be uploaded,
+    streaming it straight to the platform in parts rather than writing
+    it to the local disk."""
+
+    if len(files_to_upload["files"]) == 0:
+        print("\n--- No files to upload, skipping tar file creation...", file=sys.stderr)
+        return log
+
+    tar_filename = get_tar_filename(log, args)
+    tar_destination_project, tar_destination_folder = get_tar_destination(args)
+
+    print("\n--- Streaming tar file %s to %s:%s..." % (tar_filename, tar_destination_project,
+                                                      tar_destination_folder), file=sys.stderr)
+
+    parts = {}
+    def record_part(index, size, part_md5):
+        parts[str(index)] = {'size': size, 'md5': part_md5}
+
+    def check_parts():
+        # md5s are taken of the tar stream as it is written, before it
+        # is cut into parts and sent
+        check_uploaded_parts(tar_filename, writer.file_id, hasher.finish()[0])
 
     tar_start = time.time()
-    tar_file = tarfile.open(tar_full_path, 'w:gz')
+    part_size = get_part_size(args)
+    writer = StreamingPartWriter(tar_filename, tar_destination_project, tar_destination_folder,
+                                 part_size=part_size, max_in_flight=args.upload_threads,
+                                 on_part=record_part, uploader=get_part_uploader(args))
+
+    # Record the open platform file before sending anything, so that an
+    # interrupted stream can be cleaned up by the next invocation
+    log['tar_files'][tar_filename] = {'status': 'streaming',
+                                      'streamed': True,
+                                      'index': log['next_tar_index'],
+                                      'file_id': writer.file_id,
+                                      'project': tar_destination_project,
+                                      'size': files_to_upload["size"],
+                                      'part_size': part_size,
+                                      'parts': dict(parts),
+                                      'timestamps': {'tar_start': tar_start,
+                                                     'upload_start': tar_start}
+                                     }
+    log = update_log(log, args)
 
     log_updates = {}
+    parts_logged = 0
+    index = TarIndex(args.codec)
 
-    for f_abs in files_to_upload["files"]:
-        f_rel = os.path.relpath(f_abs, args.sync_dir)
-        tar_file.add(f_abs, arcname=f_rel, recursive=False)
-        log_updates[f_abs] = {'mtime': os.path.getmtime(f_abs)}
-
-    tar_file.close()
-    tar_end = time.time()
+    try:
+        hasher = PartHasher(writer, part_size, with_sha256=args.sha256)
+        tar_file, compressor = open_tar_file(hasher, args)
+        file_stats = files_to_upload.get("stats", {})
+        for f_abs in files_to_upload["files"]:
+            f_rel = os.path.relpath(f_abs, args.sync_dir)
+            f_stat = file_stats.get(f_abs) or os.lstat(f_abs)
+            compressor.start_file(f_abs)
+            log_updates[f_abs] = add_to_tar(tar_file, f_abs, f_rel, f_stat, index,
+                                            args.governor)
+
+            # Periodically record which parts have been sent
+            if len(parts) - parts_logged >= PARTS_PER_LOG_UPDATE:
+                log['tar_files'][tar_filename]['parts'] = dict(parts)
+                log = update_log(log, args)
+                parts_logged = len(log['tar_files'][tar_filename]['parts'])
+        stats = close_tar_file(tar_file, compressor)
+        dx_file_id = writer.close(before_close=check_parts)
+    except Exception as e:
+        writer.abort()
+        log['tar_files'][tar_filename]['status'] = 'abandoned'
+        log['tar_files'][tar_filename]['parts'] = dict(parts)
+        update_log(log, args)
+        sys.exit("ERROR: Tar file %s was not streamed (%s). Please check log for progress and rerun script" %
+                 (tar_filename, e))
+    upload_end = time.time()
+
+    # nothing is written to --tar-directory when streaming, the index
+    # is uploaded from memory
+    index.finish(compressor.writer)
+
+    entry = log['tar_files'][tar_filename]
+    entry['status'] = 'uploaded'
+    entry['file_id'] = dx_file_id
+    index_file_id = upload_tar_index(tar_filename, tar_destination_project,
+                                     tar_destination_folder, args, index)
+    if index_file_id:
+        entry['index_file_id'] = index_file_id
+    entry['parts'] = parts
+    entry['part_md5s'], tar_sha256 = hasher.finish()
+    if tar_sha256:
+        entry['sha256'] = tar_sha256
+    entry['timestamps']['tar_end'] = upload_end
+    entry['timestamps']['upload_end'] = upload_end
 
-    log['tar_files'][tar_full_path] = {'status': 'tarred',
-                                       'size': files_to_upload["size"],
-                                       'timestamps': {'tar_start': tar_start,
-                                                      'tar_end': tar_end}
-                                      }
     log['next_tar_index'] += 1
-    for filename in log_updates:
-        log['files'][filename] = log_updates[filename]
+    record_synced_files(log_updates, entry['index'], log)
+    if stats:
+        log['compression_stats'] = merge_stats(log.get('compression_stats', {}), stats)
+    return update_log(log, args)
+
+def abandon_streamed_tar_files(log, args):
+    """Marks tar files left mid-stream by an interrupted invocation as
+    abandoned, and removes their partial uploads. The files they
+    contained were never recorded as synced, so will be streamed again
+    in a new tar file."""
+
+    abandoned = False
+    for tar_file in log['tar_files']:
+        if log['tar_files'][tar_file]['status'] == 'streaming':
+            file_id = log['tar_files'][tar_file]['file_id']
+            # files are removed from a project, there being no workspace
+            project = (log['tar_files'][tar_file].get('project')
+                       or get_tar_destination(args)[0])
+            print("Abandoning interrupted stream %s (%s)..." % (tar_file, file_id), file=sys.stderr)
+            try:
+                dxpy.DXFile(file_id, project=project).remove()
+            except dxpy.exceptions.DXError as e:
+                print("WARNING: could not remove partial upload %s: %s" % (file_id, e), file=sys.stderr)
+            log['tar_files'][tar_file]['status'] = 'abandoned'
+            abandoned = True
+
+    if abandoned:
+        log = update_log(log, args)
+    return log
+
+def upload_tar_file(tar_file, tar_destination_project, tar_destination_folder, args,
+                    resume=None, on_progress=None):
+    """Uploads a single tar file, without touching the log. Returns
+    the platform file ID and the upload start and end times. With
+    --builtin-upload or --dxpy-upload the tar file is uploaded in parts:
+    resume gives the progress recorded by an earlier attempt, and
+    on_progress is called with the progress to record (see
+    upload_tar_file_parts)."""
+
+    print("Uploading %s to %s:%s..." % (tar_file, tar_destination_project,
+                                         tar_destination_folder), file=sys.stderr)
+    upload_start = time.time()
+    if not args.upload_agent:
+        dx_file_id = upload_tar_file_parts(tar_file, tar_destination_project, tar_destination_folder,
+                                           args, resume, on_progress)
+    else:
+        opts=''
+        if args.upload_threads:
+            opts += '-u %d ' %args.upload_threads
+        rate = get_rate(args.bandwidth_schedule)
+        if rate:
+            # ua limits only itself, at the rate when the upload starts
+            opts += '--throttle %d ' % rate
+        if args.verbose:
+            opts += '--verbose '
+
+        ua_command = "ua --project %s --folder %s --do-not-compress --wait-on-close --progress %s %s --auth-token %s --chunk-size 25M" % (tar_destination_project, tar_destination_folder, opts, tar_file, args.auth_token)
+        print(ua_command, file=sys.stderr)
+        try:
+            ua_process = subprocess.run(ua_command, shell=True, check=True, stdout=subprocess.PIPE, universal_newlines=True)
+            dx_file_id = ua_process.stdout.strip()
+        except subprocess.CalledProcessError:
+            sys.exit("ERROR: Tar file %s was not uploaded. Please check log for progress and rerun script" % tar_file)
+    upload_end = time.time()
+
+    return dx_file_id, upload_start, upload_end
+
+def upload_tar_file_parts(tar_file, tar_destination_project, tar_destination_folder, args,
+                          resume=None, on_progress=None):
+    """Uploads a tar file in parts, picking up where an earlier attempt
+    left off. resume is the tar file's log entry, holding the file_id,
+    part_size and parts (index -> size and md5) of the platform file
+    an earlier attempt was uploading to. Parts recorded there which the
+    platform also has complete are not sent again. on_progress is
+    called with the file_id, part_size and parts to record in the log
+    when the platform file is opened, periodically as parts complete,
+    and if the upload fails. Returns the platform file ID."""
+
+    upload = None
+    if resume and resume.get('file_id') and resume.get('part_size'):
+        try:
+            state, uploaded = get_uploaded_parts(resume['file_id'])
+        except dxpy.exceptions.DXError as e:
+            sys.exit("ERROR: Could not check progress of %s (%s). Please rerun script" % (tar_file, e))
+
+        if state in ('closing', 'closed'):
+            # the last attempt finished but was not recorded
+            print("%s was already uploaded as %s" % (tar_file, resume['file_id']), file=sys.stderr)
+            dxpy.DXFile(resume['file_id']).wait_on_close()
+            return resume['file_id']
+
+        if state == 'open':
+            parts = dict((index, part) for index, part in resume.get('parts', {}).items()
+                         if uploaded.get(int(index)) == part)
+            upload = {'file_id': resume['file_id'], 'part_size': resume['part_size'], 'parts': parts}
+            print("Resuming upload of %s to %s, %d of %d parts already uploaded" % (
+                tar_file, upload['file_id'], len(parts),
+                get_part_count(os.path.getsize(tar_file), upload['part_size'])), file=sys.stderr)
+        else:
+            print("Platform file %s of an earlier attempt is gone, uploading %s again" % (
+                resume['file_id'], tar_file), file=sys.stderr)
+
+    uploader = get_part_uploader(args)
+    if upload is None:
+        if uploader:
+            dx_file = uploader.new_file(os.path.basename(tar_file), tar_destination_project,
+                                        tar_destination_folder)
+        else:
+            dx_file = dxpy.new_dxfile(name=os.path.basename(tar_file), project=tar_destination_project,
+                                      folder=tar_destination_folder, parents=True)
+        part_size = (resume or {}).get('part_size')
+        if not (part_size and (resume or {}).get('part_md5s')):
+            # built before tar files were hashed as they were written
+            part_size = get_upload_part_size(os.path.getsize(tar_file), get_part_size(args))
+        upload = {'file_id': dx_file.get_id(), 'part_size': part_size, 'parts': {}}
+    elif uploader:
+        dx_file = uploader.open_file(upload['file_id'], tar_destination_project)
+    else:
+        dx_file = dxpy.DXFile(upload['file_id'])
+
+    # Record the open platform file before sending anything, so an
+    # interrupted upload is carried on by the next invocation
+    if on_progress:
+        on_progress(dict(upload, parts=dict(upload['parts'])))
+
+    parts = upload['parts']
+    parts_lock = threading.Lock()
+    parts_logged = [len(parts)]
+
+    # md5 of each part of the tar file as it was built, if it was built
+    # in parts of the size it is being uploaded in
+    part_md5s = None
+    if resume and resume.get('part_md5s') and resume.get('part_size') == upload['part_size']:
+        part_md5s = resume['part_md5s']
+
+    def record_part(index, size, part_md5):
+        if part_md5s and part_md5s[index - 1] != part_md5:
+            raise ValueError("part %d of the tar file has changed on disk since it was built, "
+                             "it must be removed and its files synced again" % index)
+        with parts_lock:
+            parts[str(index)] = {'size': size, 'md5': part_md5}
+            if on_progress and len(parts) - parts_logged[0] >= PARTS_PER_LOG_UPDATE:
+                on_progress(dict(upload, parts=dict(parts)))
+                parts_logged[0] = len(parts)
+
+    try:
+        result = upload_file_parts(tar_file, dx_file, upload['part_size'], threads=args.upload_threads,
+                                   skip=[int(index) for index in parts], on_part=record_part,
+                                   close=False, controller=getattr(args, 'controller', None))
+        if part_md5s:
+            check_uploaded_parts(tar_file, upload['file_id'], part_md5s)
+        dx_file.close(block=True)
+    except Exception as e:
+        if on_progress:
+            with parts_lock:
+                on_progress(dict(upload, parts=dict(parts)))
+        sys.exit("ERROR: Tar file %s was not uploaded (%s). Please check log for progress and rerun script" %
+                 (tar_file, e))
+
+    if on_progress:
+        on_progress(dict(upload, parts=dict(parts)))
+
+    print("Uploaded %s: %s" % (tar_file, format_upload_stats(result)), file=sys.stderr)
+
+    return upload['file_id']
+
+def check_uploaded_parts(tar_file, file_id, part_md5s):
+    """Checks the md5 of each part the platform has of a tar file
+    against those of the tar file as it was built, before the platform
+    file is closed. Raises ValueError if any part is missing or differs."""
+
+    mismatched = find_mismatched_parts(file_id, part_md5s)
+    if mismatched:
+        raise ValueError("parts %s of %s on the platform do not match the tar file built" %
+                         (', '.join(str(x) for x in mismatched), file_id))
+    print("Checked %d parts of %s against the tar file built" % (len(part_md5s), tar_file),
+          file=sys.stderr)
+
+def get_part_uploader(args):
+    """The uploader to send parts with: with --builtin-upload a
+    PartUploader shared by every upload made by this invocation,
+    limited by --bandwidth-schedule, otherwise None to send them with
+    dxpy."""
+
+    if not args.builtin_upload:
+        return None
+    if getattr(args, 'uploader', None) is None:
+        bucket = None
+        if args.bandwidth_schedule:
+            bucket = TokenBucket(os.path.join(args.tar_directory, BUCKET_FILE),
+                                 args.bandwidth_schedule)
+        controller = getattr(args, 'controller', None)
+        threads = controller.max_threads if controller else args.upload_threads
+        args.uploader = PartUploader(threads=threads, bucket=bucket, controller=controller)
+    return args.uploader
+
+def start_upload_controller(log, args):
+    """Sets args.controller to the controller adjusting uploads with
+    --adaptive-upload, carrying on from where the last invocation left
+    the threads and part size, otherwise to None."""
+
+    args.controller = None
+    if args.adaptive_upload:
+        args.controller = UploadController(args.upload_threads, args.part_size,
+                                           args.max_upload_threads, args.max_part_size,
+                                           MIN_PART_SIZE)
+        if log.get('upload_control'):
+            args.controller.set_state(log['upload_control'])
+            print("Carrying on uploads with %d threads and %d MB parts" % (
+                args.controller.threads, args.controller.part_size // 2**20), file=sys.stderr)
+
+def get_part_size(args):
+    """Part size to build and upload new tar files with"""
+
+    if getattr(args, 'controller', None):
+        return args.controller.part_size
+    return args.part_size
+
+def record_upload_progress(tar_file, upload, log, args):
+    """Records the progress of uploading a tar file in parts in the log."""
+
+    log['tar_files'][tar_file].update(upload)
+    return update_log(log, args)
+
+def upload_tar_index(tar_file, tar_destination_project, tar_destination_folder, args,
+                     index=None):
+    """Uploads the index written next to a tar file (see tar_index.py),
+    or the given index from memory for a streamed tar file, returning
+    its platform file ID. Returns None if the tar file has no index (it
+    was built by an earlier version) or the index could not be
+    uploaded, which leaves the tar file usable as a whole."""
+
+    index_path = get_index_path(os.path.join(args.tar_directory, os.path.basename(tar_file)))
+    if index is None and not os.path.exists(index_path):
+        return None
+
+    try:
+        if index is None:
+            dx_file = dxpy.upload_local_file(index_path, project=tar_destination_project,
+                                             folder=tar_destination_folder, parents=True,
+                                             wait_on_close=True)
+        else:
+            dx_file = dxpy.upload_string(index.to_bytes(), name=os.path.basename(index_path),
+                                         project=tar_destination_project,
+                                         folder=tar_destination_folder, parents=True,
+                                         wait_on_close=True)
+    except dxpy.exceptions.DXError as e:
+        print("WARNING: could not upload index %s: %s" % (index_path, e), file=sys.stderr)
+        return None
+    return dx_file.get_id()
+
+def record_upload(tar_file, dx_file_id, upload_start, upload_end, log, args,
+                  index_file_id=None):
+    """Records a tar file as uploaded in the log."""
+
+    log['tar_files'][tar_file]['status'] = 'uploaded'
+    log['tar_files'][tar_file]['file_id'] = dx_file_id
+    if index_file_id:
+        log['tar_files'][tar_file]['index_file_id'] = index_file_id
+    log['tar_files'][tar_file]['timestamps']['upload_start'] = upload_start
+    log['tar_files'][tar_file]['timestamps']['upload_end'] = upload_end
     return update_log(log, args)
 
 def upload_tar_files(log, args):
@@ -439,70 +1633,175 @@ def upload_tar_files(log, args):
 
     print("\n--- Uploading tar files...", file=sys.stderr)
 
-    tar_destination_project, tar_destination_folder, _ = dxpy.utils.resolver.resolve_path(args.tar_destination, expected='folder')
-
     upload_count = 0
-    for tar_file in log['tar_files']:
+    for tar_file in list(log['tar_files']):
         if log['tar_files'][tar_file]['status'] == 'tarred':
-            print("Uploading %s to %s:%s..." % (tar_file, tar_destination_project,
-                                                                 tar_destination_folder), file=sys.stderr)
             upload_count += 1
-            upload_start = time.time()
-            if args.dxpy_upload:
-                dx_file = dxpy.upload_local_file(tar_file, project=tar_destination_project, folder=tar_destination_folder)
-                dx_file_id = dx_file.get_id()
-            else:
-                opts=''
-                if args.upload_threads:
-                    opts += '-u %d ' %args.upload_threads
-                if args.verbose:
-                    opts += '--verbose '
-
-                ua_command = "ua --project %s --folder %s --do-not-compress --wait-on-close --progress %s %s --auth-token %s --chunk-size 25M" % (tar_destination_project, tar_destination_folder, opts, tar_file, args.auth_token)
-                print(ua_command, file=sys.stderr)
-                try:
-                    ua_process = subprocess.run(ua_command, shell=True, check=True, stdout=subprocess.PIPE, universal_newlines=True)
-                    dx_file_id = ua_process.stdout.strip()
-                except subprocess.CalledProcessError:
-                    sys.exit("ERROR: Tar file %s was not uploaded. Please check log for progress and rerun script" % tar_file)
-            upload_end = time.time()
-
-            log['tar_files'][tar_file]['status'] = 'uploaded'
-            log['tar_files'][tar_file]['file_id'] = dx_file_id
-            log['tar_files'][tar_file]['timestamps']['upload_start'] = upload_start
-            log['tar_files'][tar_file]['timestamps']['upload_end'] = upload_end
-            log = update_log(log, args)
+            tar_destination_project, tar_destination_folder = get_tar_destination(args)
+
+            def on_progress(upload, tar_file=tar_file):
+                record_upload_progress(tar_file, upload, log, args)
+
+            dx_file_id, upload_start, upload_end = upload_tar_file(
+                tar_file, tar_destination_project, tar_destination_folder, args,
+                log['tar_files'][tar_file], on_progress)
+            index_file_id = upload_tar_index(tar_file, tar_destination_project,
+                                             tar_destination_folder, args)
+            log = record_upload(tar_file, dx_file_id, upload_start, upload_end, log, args,
+                                index_file_id)
     if upload_count == 0:
         print("\tNo files uploaded...", file=sys.stderr)
     return log
 
+def remove_tar_file(tar_file, log, args):
+    """Removes a single uploaded tar file from the local disk and
+    records it in the log."""
+
+    print("Removing %s..." % tar_file, file=sys.stderr)
+
+    remove_start = time.time()
+    # Streamed tar files were never written locally
+    if not log['tar_files'][tar_file].get('streamed'):
+        os.remove(tar_file)
+    index_path = get_index_path(os.path.join(args.tar_directory, os.path.basename(tar_file)))
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    args.space_ledger.release(tar_file)
+    remove_end = time.time()
+
+    log['tar_files'][tar_file]['status'] = 'removed'
+    log['tar_files'][tar_file]['timestamps']['remove_start'] = remove_start
+    log['tar_files'][tar_file]['timestamps']['remove_end'] = remove_end
+    return update_log(log, args)
+
 def remove_tar_files(log, args):
     """Removes tar files that have been uploaded from the local disk."""
 
     print("\n--- Removing uploaded tar files...", file=sys.stderr)
 
     remove_count = 0
-    for tar_file in log['tar_files']:
+    for tar_file in list(log['tar_files']):
         if log['tar_files'][tar_file]['status'] == 'uploaded':
-            print("Removing %s..." % tar_file, file=sys.stderr)
-
             remove_count += 1
-            remove_start = time.time()
-            os.remove(tar_file)
-            remove_end = time.time()
-
-            log['tar_files'][tar_file]['status'] = 'removed'
-            log['tar_files'][tar_file]['timestamps']['remove_start'] = remove_start
-            log['tar_files'][tar_file]['timestamps']['remove_end'] = remove_end
-            log = update_log(log, args)
+            log = remove_tar_file(tar_file, log, args)
 
     if remove_count == 0:
         print("\tNo files removed...", file=sys.stderr)
 
     return log
 
-def print_all_file_ids(log):
-    """Outputs the file ID of each tar file that has been uploaded."""
+def remove_partial_tar_files(log, args):
+    """Removes tar files left half built by an interrupted invocation.
+    They were never recorded in the log, so the files in them will be
+    tarred again."""
+
+    pattern = os.path.join(args.tar_directory, glob.escape(log['file_prefix']) + '_*' + PARTIAL_SUFFIX)
+    for partial_path in glob.glob(pattern):
+        print("Removing partial tar file %s..." % partial_path, file=sys.stderr)
+        os.remove(partial_path)
+        args.space_ledger.release(partial_path[:-len(PARTIAL_SUFFIX)])
+
+def get_pipeline_depth(args):
+    """Number of built tar files that may wait for upload whilst the
+    next one is built. Bounded by --pipeline-depth and by how many
+    tar files of --max-tar-size the tar directory has free space for,
+    counting the one uploading and the one being built."""
+
+    free_space = shutil.disk_usage(args.tar_directory).free
+    tars_with_space = free_space // args.max_tar_size - 2
+    return max(0, min(args.pipeline_depth, tars_with_space))
+
+def pipeline_tar_files(tars_to_upload, log, args, depth):
+    """Builds and uploads the given tar files as a pipeline, building
+    each tar file in a background thread whilst the previous one is
+    uploaded and removed in this one. At most depth built tar files
+    wait for upload at any time.
+
+    Both threads share the log, so each holds log_lock only whilst
+    recording a step; the long running tar and upload steps run
+    unlocked. Every step is recorded as it completes (tarred, uploaded,
+    removed) exactly as in the sequential path, so if the process is
+    killed the next invocation resumes from the log as usual."""
+
+    print("\n--- Building and uploading %d tar files with pipeline depth %d..." %
+          (len(tars_to_upload), depth), file=sys.stderr)
+
+    tar_destination_project, tar_destination_folder = get_tar_destination(args)
+
+    shared = {'log': log}
+    log_lock = threading.Lock()
+    built = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the uploading thread has stopped, rather than
+        # waiting forever for space in the queue
+        while not stop.is_set():
+            try:
+                built.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def build_all():
+        try:
+            for tar in tars_to_upload:
+                if stop.is_set():
+                    return
+                if len(tar["files"]) == 0:
+                    continue
+                with log_lock:
+                    tar_full_path = os.path.join(args.tar_directory, get_tar_filename(shared['log'], args))
+                tar_entry, log_updates, stats = build_tar_file(tar, tar_full_path, args, stop)
+                with log_lock:
+                    shared['log'] = record_tar_file(tar_full_path, tar_entry, log_updates, stats,
+                                                    shared['log'], args)
+                put(tar_full_path)
+            put(None)
+        except TarBuildStopped:
+            return
+        except BaseException as e:
+            put(e)
+
+    builder = threading.Thread(target=build_all)
+    builder.start()
+
+    try:
+        while True:
+            tar_full_path = built.get()
+            if tar_full_path is None:
+                break
+            if isinstance(tar_full_path, BaseException):
+                sys.exit("ERROR: Failed to build tar file: %s" % tar_full_path)
+
+            def on_progress(upload, tar_full_path=tar_full_path):
+                with log_lock:
+                    shared['log'] = record_upload_progress(tar_full_path, upload, shared['log'], args)
+
+            with log_lock:
+                resume = dict(shared['log']['tar_files'][tar_full_path])
+            dx_file_id, upload_start, upload_end = upload_tar_file(
+                tar_full_path, tar_destination_project, tar_destination_folder, args,
+                resume, on_progress)
+            index_file_id = upload_tar_index(tar_full_path, tar_destination_project,
+                                             tar_destination_folder, args)
+            with log_lock:
+                shared['log'] = record_upload(tar_full_path, dx_file_id, upload_start, upload_end,
+                                              shared['log'], args, index_file_id)
+                shared['log'] = remove_tar_file(tar_full_path, shared['log'], args)
+    finally:
+        # On failure the builder stops waiting for space for the next
+        # tar file, which it would never get if the tar file that
+        # failed to upload holds it, or stops building the tar file it
+        # is on at its next read, discarding it and its reservation
+        stop.set()
+        builder.join()
+
+    return shared['log']
+
+def get_all_file_ids(log):
+    """File ID of each tar file that has been uploaded. Exits if any
+    tar file was not uploaded."""
 
     failed_uploads = 0
     file_ids = []
@@ -513,6 +1812,8 @@ def print_all_file_ids(log):
         elif log['tar_files'][tar_file]['status'] == 'uploaded':
             print('WARNING: %s was uploaded but not removed' % tar_file, file=sys.stderr)
             file_ids.append(log['tar_files'][tar_file]['file_id'])
+        elif log['tar_files'][tar_file]['status'] == 'abandoned':
+            continue
         else:
             print('ERROR: %s was not uploaded' % tar_file, file=sys.stderr)
             failed_uploads += 1
@@ -520,55 +1821,151 @@ def print_all_file_ids(log):
     assert failed_uploads >= 0
 
     if failed_uploads == 0:
-        for file_id in file_ids:
-            print(file_id.strip())
+        return [file_id.strip() for file_id in file_ids]
     elif failed_uploads == 1:
         sys.exit('One file was not successfully uploaded.')
     else:
         sys.exit('%s files were not successfully uploaded.' % failed_uploads)
 
 def write_log(log, log_file):
-    """Writes the log to the log file."""
+    """Writes the log to the log file as JSON. The log is written to a
+    temporary file which then replaces the existing log, so a process
+    killed part way through writing never leaves a corrupt log."""
 
     print('\n--- Writing log file...', file=sys.stderr)
 
-    with open(log_file, 'w') as logf:
+    tmp_log_file = log_file + '.tmp'
+    with open(tmp_log_file, 'w') as logf:
         json.dump(log, logf)
+        logf.flush()
+        os.fsync(logf.fileno())
+    os.replace(tmp_log_file, log_file)
+
+def export_log(args):
+    """Writes the full log, as stored in the sync state database, to
+    the log file"""
+
+    write_log(args.state.export_log(), args.log_file)
+
+def export_manifest(log, args):
+    """Writes the manifest of every file synced (see manifest.py) next
+    to the log file, for uploading alongside the tar files."""
+
+    tar_file_ids = {}
+    for tar_file, entry in log['tar_files'].items():
+        if entry['status'] in ('uploaded', 'removed'):
+            tar_file_ids[entry.get('index', get_tar_index(tar_file))] = entry['file_id']
+
+    def rows():
+        for full_path, entry in args.state.iter_files():
+            yield dict(entry, path=os.path.relpath(full_path, args.sync_dir),
+                       tar_file_id=tar_file_ids.get(entry.get('tar_index')))
+
+    manifest_path = get_manifest_path(args.log_file)
+    count = write_manifest(manifest_path, rows())
+    print("\n--- Wrote manifest of %d files to %s" % (count, manifest_path), file=sys.stderr)
 
 def update_log(log, args):
-    """Write current state of logs"""
+    """Commit the changes made to the log since the last update"""
 
-    write_log(log, args.log_file)
-    return read_log(args)
+    if getattr(args, 'controller', None):
+        log['upload_control'] = args.controller.get_state()
+    args.state.commit(log)
+    return log
 
-def main():
-    """Main function."""
+def set_security_context(auth_token):
+    """Authenticates platform requests with the given token. If dxpy
+    has not been imported yet it picks the token up from its
+    environment variable when it is."""
 
-    args = parse_args()
+    security_context = {'auth_token_type': 'Bearer', 'auth_token': auth_token}
+    if is_loaded(dxpy):
+        dxpy.set_security_context(security_context)
+    else:
+        os.environ['DX_SECURITY_CONTEXT'] = json.dumps(security_context)
 
-    print('\nUser Input:\n%s\n' % args, file=sys.stderr)
+class SyncEngine():
+    """Syncs a directory into the platform in-process, as an invocation
+    of this script does, keeping between syncs what each invocation
+    would otherwise set up again: the checked inputs, the log and its
+    database (with its cache of scanned directories), the resolved tar
+    destination, and the uploader with its open connections. Errors
+    exit as the script does, after which the engine should be closed
+    and a new one started, which reads the log afresh.
 
-    args = check_inputs(args)
+    args are as returned by parse_args. sync may be called any number
+    of times, each time syncing what has changed since the last."""
 
-    log = read_log(args)
+    def __init__(self, args):
+        self.args = check_inputs(args)
+        self.log = read_log(self.args)
+        check_log(self.log, self.args)
+        start_upload_controller(self.log, self.args)
 
-    check_log(log, args)
+        set_security_context(self.args.auth_token)
 
-    files_to_upload = get_files_to_upload(log, args)
+    def sync(self, scanner=None):
+        """Syncs the directory, returning the file ID of every tar file
+        uploaded so far. scanner is walked, if given, rather than
+        scanning the directory (see get_files_to_upload)."""
 
-    tars_to_upload = split_into_tar_files(files_to_upload, log, args)
+        args = self.args
+        log = abandon_streamed_tar_files(self.log, args)
 
-    for tar in tars_to_upload:
-        log = create_tar_file(tar, log, args)
-        log = upload_tar_files(log, args)
-        log = remove_tar_files(log, args)
+        files_to_upload = get_files_to_upload(log, args, scanner)
+
+        tars_to_upload = split_into_tar_files(files_to_upload, log, args)
 
-    # Run through upload & remove in case last invocation was interrupted
-    if len(tars_to_upload) == 0:
+        # Run through upload & remove in case last sync was interrupted
+        remove_partial_tar_files(log, args)
         log = upload_tar_files(log, args)
         log = remove_tar_files(log, args)
 
-    print_all_file_ids(log)
+        if args.stream:
+            for tar in tars_to_upload:
+                log = stream_tar_file(tar, log, args)
+                log = remove_tar_files(log, args)
+        else:
+            depth = get_pipeline_depth(args)
+            if depth > 0 and len(tars_to_upload) > 1:
+                log = pipeline_tar_files(tars_to_upload, log, args, depth)
+            else:
+                for tar in tars_to_upload:
+                    log = create_tar_file(tar, log, args)
+                    log = upload_tar_files(log, args)
+                    log = remove_tar_files(log, args)
+
+        if args.finish:
+            export_log(args)
+            export_manifest(log, args)
+
+        self.log = log
+        return get_all_file_ids(log)
+
+    def close(self):
+        """Closes the log database and upload connections."""
+
+        if getattr(self.args, 'uploader', None) is not None:
+            self.args.uploader.session.close()
+        if self.args.state is not None:
+            self.args.state.close()
+            self.args.state = None
+
+def main():
+    """Main function."""
+
+    args = parse_args()
+
+    print('\nUser Input:\n%s\n' % args, file=sys.stderr)
+
+    engine = SyncEngine(args)
+    try:
+        file_ids = engine.sync()
+    finally:
+        engine.close()
+
+    for file_id in file_ids:
+        print(file_id)
 
 if __name__ == '__main__':
     main()
@@ -10,15 +10,21 @@ import time
 import dxpy
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor, wait
 from math import ceil
 from pathlib import Path
-from shutil import disk_usage
+from shutil import disk_usage, which
 from typing import Union
 import csv
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "."))
 
+from change_feed import ChangeWatcher, watch_unsupported
+from dir_scan import SharedScan
+from dx_sync_directory import SyncEngine, parse_args as parse_sync_args
+from manifest import get_manifest_path
 from notify import Slack, CheckCycles
+from path_matcher import PathMatcher
 
 # Uploads an Illumina run directory (HiSeq 2500, HiSeq X, NextSeq)
 # If for use with a MiSeq, users MUST change the config files to include and NOT specify the -l argument
@@ -32,6 +38,20 @@ from notify import Slack, CheckCycles
 #
 # By "synchronize" we mean that each invocation of dx_sync_directory.py will create a TAR
 # archive of all files in the run directory modified since the last invocation.
+#
+# Each lane is synced in this process by a SyncEngine from dx_sync_directory.py, kept
+# between syncs so that its log, scan cache and upload connections stay warm, rather
+# than by running the script afresh every interval.
+#
+# With --parallel-lanes, that many lanes are synced at once on a pool of threads,
+# sharing the upload and compress threads between them. Each lane has its own log,
+# and once the run completes each lane's upload sentinel record is closed as soon as
+# that lane has finished syncing. The run directory is walked once per sync for all
+# lanes, each lane being handed the files of its own lane and the config files.
+
+# Config files every lane is given (only if lanes are specified)
+CONFIG_FILES = ["RTAConfiguration.xml", "RunInfo.xml", "RunParameters.xml",
+    "config.xml", "s.locs"]
 
 def parse_args():
     """Parse the command-line arguments and canonicalize file path arguments"""
@@ -61,6 +81,10 @@ def parse_args():
             choices=[2, 8], help="Upload BCL files sorted by lane. Use this " +
             "option if you plan to run BCL conversion parallelized by lane. " +
             "Not applicable to single lane machines.")
+    parser.add_argument("--parallel-lanes", metavar="<int>", type=int,
+            default=1, help="With --num-lanes, the number of lanes synced " +
+            "at once. The upload and compress threads are shared between " +
+            "them, as is any --bandwidth-schedule (default %(default)s)")
     parser.add_argument("-m", "--min-age", metavar="<seconds>", type=int,
             default=1000, help="Minimum age (in seconds) of files to be " +
             "tarred and uploaded.")
@@ -104,6 +128,81 @@ def parse_args():
             help="An optional list of regex patterns to exclude.")
     parser.add_argument("-n", "--novaseq", dest="novaseq", action='store_true',
             help="If Novaseq is used, this parameter has to be used.")
+    parser.add_argument("--compress-threads", metavar="<int>", type=int,
+            default=1, help="Number of threads to gzip each TAR archive on " +
+            "(default %(default)s)")
+    parser.add_argument("--codec", choices=["gzip", "zstd", "none"],
+            default="gzip", help="Compression applied to TAR archives " +
+            "(default %(default)s)")
+    parser.add_argument("--compress-level", metavar="<int>", type=int,
+            help="Compression level for files that are compressed")
+    parser.add_argument("--compress-policy", metavar="<filepath>",
+            help="JSON file of [<regex>, \"store\"|\"compress\"] pairs " +
+            "deciding which files are compressed in TAR archives")
+    parser.add_argument("--pipeline-depth", metavar="<int>", type=int,
+            default=1, help="Number of built TAR archives that may wait to " +
+            "be uploaded whilst the next is built, bounded by free space in " +
+            "--temp-dir. 0 tars and uploads each archive in turn " +
+            "(default %(default)s)")
+    parser.add_argument("--packing", choices=["balanced", "sequential"],
+            default="balanced", help="How files are split into TAR archives: " +
+            "\"balanced\" keeps each lane / cycle directory together in near " +
+            "equal archives, holding back files too few to fill an archive of " +
+            "--min-size until the next sync; \"sequential\" fills each archive " +
+            "in turn (default %(default)s)")
+    parser.add_argument("--stable-scans", metavar="<int>", type=int,
+            help="Upload files modified within --min-age once this many " +
+            "syncs in a row have seen them unchanged, or (with --watch) " +
+            "once they have been closed after writing")
+    parser.add_argument("--churn-threshold", metavar="<int>", type=int,
+            help="Leave files which have been uploaded again after changing " +
+            "this many times (e.g. InterOp files rewritten every cycle) for " +
+            "the final sync, rather than adding them to yet another archive")
+    parser.add_argument("--space-budget", metavar="<MB>", type=int,
+            help="Most space (in MB) that archives being built or waiting " +
+            "for upload may take up in the temp directory, shared by every " +
+            "upload using it. Space is always reserved within the free disk " +
+            "space before an archive is built")
+    parser.add_argument("--gentle-io", action="store_true",
+            help="Build archives without getting in the way of the " +
+            "instrument: read files without keeping them in the page cache, " +
+            "and build and compress archives at a low CPU and I/O priority")
+    parser.add_argument("--yield-to-writes", metavar="<MB/s>", type=float,
+            help="Pause reading files into archives whilst other processes " +
+            "write to the run directory's disk faster than this")
+    parser.add_argument("--dedup-content", action="store_true",
+            help="Check files modified since they were uploaded against the " +
+            "md5 they were uploaded with, and only upload them again if " +
+            "their data has changed")
+    parser.add_argument("--prune-unchanged-dirs", action="store_true",
+            help="Skip listing directories in which everything has been " +
+            "uploaded and nothing added or removed since the last scan. " +
+            "The whole run folder is still scanned when the run completes.")
+    parser.add_argument("--watch", action="store_true",
+            help="Watch the run directory with inotify, so that each sync " +
+            "only checks the files changed since the last one rather than " +
+            "scanning the whole run directory. Ignored on NFS and other " +
+            "network file systems, which are always scanned.")
+    parser.add_argument("--full-scan-interval", metavar="<seconds>", type=int,
+            default=3600, help="With --watch, scan the whole run directory " +
+            "at least this often to pick up any changes the watcher missed " +
+            "(default %(default)s)")
+    parser.add_argument("--adaptive-upload", action="store_true",
+            help="Adjust the number of parts uploaded at once and the part " +
+            "size as uploads run, from the throughput of each part and the " +
+            "errors hit")
+    parser.add_argument("--max-upload-threads", metavar="<int>", type=int,
+            help="With --adaptive-upload, the most parts uploaded at once " +
+            "(default twice --upload-threads)")
+    parser.add_argument("--max-part-size", metavar="<MB>", type=int,
+            help="With --adaptive-upload, the largest part size (default 100)")
+    parser.add_argument("--bandwidth-schedule", metavar="<HH:MM-HH:MM=Mbit/s>",
+            nargs="*", help="Limit the rate TAR archives are uploaded at " +
+            "during each window of the day given, shared by every upload " +
+            "using the same --temp-dir, e.g. 07:00-19:00=200")
+    parser.add_argument("--stream", action="store_true",
+            help="Stream TAR archives straight to DNAnexus as they are " +
+            "created, without writing them to --temp-dir first.")
     parser.add_argument(
         "--sequencer_id", default="",
         help=(
@@ -113,6 +212,13 @@ def parse_args():
         )
     )
 
+    parser.add_argument("--sha256", action="store_true",
+            help="Record the sha256 of each TAR archive in the log, as well " +
+            "as the md5 of each part uploads are checked against")
+    parser.add_argument("--builtin-upload", action="store_true",
+            help="Upload TAR archives with the built in uploader instead of " +
+            "the Upload Agent (ua)")
+
     # Mutually exclusive inputs for verbose loggin (UA) vs dxpy upload
     upload_debug_group = parser.add_mutually_exclusive_group(required=False)
     upload_debug_group.add_argument("--dxpy-upload", "-d", action="store_true",
@@ -149,6 +255,11 @@ def parse_args():
             "--min-size input must be less than --max-size", send=False, run=''
         )
 
+    if args.parallel_lanes < 1:
+        raise_error(
+            "--parallel-lanes input must be at least 1", send=False, run=''
+        )
+
     return args
 
 
@@ -215,29 +326,16 @@ def check_input(args):
                 send=False, run=''
             )
 
-    if not args.dxpy_upload:
+    # dx_sync_directory.py is imported from the folder containing this
+    # script, so it need not be checked for here
+    if not (args.builtin_upload or args.dxpy_upload):
         print_stderr("Checking if ua is in $PATH")
-        try:
-            sub.check_call(['ua', '--version'],
-                    stdout=open(os.devnull, 'w'), close_fds=True)
-        except sub.CalledProcessError:
+        if which('ua') is None:
             raise_error(
                 "Upload agent executable 'ua' was not found in the $PATH",
                 send=False, run=''
             )
 
-    try:
-        # We assume that dx_sync_directory is located in the same folder as this script
-        # This is resolved by absolute path of invocation
-        sub.check_call(['python3', '{curr_dir}/dx_sync_directory.py'.format(curr_dir=sys.path[0]), '-h'],
-                stdout=open(os.devnull, 'w'), close_fds=True)
-    except sub.CalledProcessError:
-        raise_error(
-            "dx_sync_directory.py not found. Please run incremental " +
-            "upload from the directory containing incremental_upload.py "+
-            "and dx_sync_directory.py", send=False, run=''
-    )
-
 
 def get_run_id(run_dir, sequencer):
     runinfo_xml = run_dir + "/RunInfo.xml"
@@ -267,25 +365,6 @@ def get_target_folder(base, lane):
         return base.rstrip("/") + "/" + lane
 
 
-def run_command_with_retry(my_num_retries, my_command, run_dir):
-    for trys in range(my_num_retries):
-        print_stderr("Running (Try %d of %d): %s" %
-                (trys, my_num_retries, my_command))
-        try:
-            process = sub.run(my_command, check=True, stdout=sub.PIPE, universal_newlines=True)
-            output = process.stdout.strip()
-            return output
-        except sub.CalledProcessError as e:
-            print_stderr("Failed to run `%s`, retrying (Try %s)" %
-                    (" ".join(my_command), trys))
-        time.sleep(10)
-
-    raise_error(
-        "Number of retries exceed %d. Please check logs to troubleshoot issues." % my_num_retries,
-        send=True, run=Path(run_dir).name
-        )
-
-
 def raise_error(msg, send, run):
     """
     Prints error message and exit, and also optionally send a notification
@@ -339,31 +418,122 @@ def upload_single_file(filepath, project, folder, properties):
         return None
 
 
-def run_sync_dir(lane, args, finish=False):
-    # Set list of config files to include (only if lanes are specified)
-    CONFIG_FILES = ["RTAConfiguration.xml", "RunInfo.xml", "RunParameters.xml",
-        "config.xml", "s.locs"]
-    lane_num = lane["lane"]
+def get_exclude_patterns(args):
+    """Patterns of files not to upload for any lane"""
+    # Copy the user's patterns, so that those added here are not added
+    # to args again on every call
+    exclude_patterns = list(args.exclude_patterns or [])
 
-    # Set lane specific patterns to include IF uploading by lane
-    include_patterns = []
-    if not lane_num == "all":
-        include_patterns = CONFIG_FILES
-        include_patterns.append("s_" + lane_num + "_")
     # If upload_thumbnails is specified, upload thumbnails
-    if not args.exclude_patterns:
-        args.exclude_patterns = []
-
-    exclude_patterns = args.exclude_patterns
-
     if not args.upload_thumbnails:
         exclude_patterns.append("Images")
 
     if args.samplesheet_delay:
         exclude_patterns.append("SampleSheet.csv")
 
-    invocation = ["python3", "{curr_dir}/dx_sync_directory.py".format(curr_dir=sys.path[0])]
-    invocation.extend(["--log-file", lane["log_path"]])
+    return list(dict.fromkeys(exclude_patterns))
+
+
+def start_change_watcher(args, run_id):
+    """
+    Start watching the run directory for changes, returning the watcher
+    or None if the run directory cannot be watched and has to be scanned
+    """
+    reason = watch_unsupported(args.run_dir)
+    if reason:
+        print_stderr("Not watching run directory, scanning instead: %s" % reason)
+        return None
+
+    feed_path = os.path.join(args.log_dir, "run." + run_id + ".changes.db")
+    skip_dir = PathMatcher(get_exclude_patterns(args)).matches_below
+    watcher = ChangeWatcher(args.run_dir, feed_path, skip_dir=skip_dir)
+
+    if not watcher.start_watching():
+        print_stderr("%s, scanning run directory instead" % watcher.error)
+        return None
+
+    print_stderr("Watching run directory for changes, recording them in %s" % feed_path)
+    return watcher
+
+
+def start_shared_scan(lanes, args, finish=False):
+    """Scan of the run directory shared by the lanes, routing the files
+    of each lane to it and the config files to every lane. The final
+    sync lists every directory, as each lane's own scan would."""
+    routes = dict((lane["prefix"], PathMatcher([get_lane_pattern(lane)]).matches)
+                  for lane in lanes)
+    return SharedScan(args.run_dir, routes, shared=PathMatcher(CONFIG_FILES).matches,
+                      skip_dir=PathMatcher(get_exclude_patterns(args)).matches_below,
+                      prune=args.prune_unchanged_dirs and not finish)
+
+
+def get_lane_pattern(lane):
+    return "s_" + lane["lane"] + "_"
+
+
+def run_sync_dir(lane, args, finish=False, scan=None):
+    """Sync a lane, returning the file IDs of its uploaded tar files.
+    The lane's engine is kept for the next sync, unless its arguments
+    change (e.g. for the final sync) or a sync fails, when a new one is
+    started which reads the log afresh. Given a shared scan, the lane
+    walks its view of it rather than scanning the run directory."""
+    sync_args = get_sync_dir_args(lane, args, finish)
+
+    for trys in range(args.retries):
+        print_stderr("Syncing %s (Try %d of %d)" % (lane["prefix"], trys, args.retries))
+        try:
+            if lane.get("engine_args") != sync_args:
+                close_sync_engine(lane)
+                lane["engine"] = SyncEngine(parse_sync_args(sync_args))
+                lane["engine_args"] = sync_args
+            file_ids = lane["engine"].sync(scan.view(lane["prefix"]) if scan else None)
+            if finish:
+                close_sync_engine(lane)
+            return file_ids
+        except (Exception, SystemExit) as e:
+            print_stderr("Failed to sync %s (%s), retrying (Try %s)" %
+                    (lane["prefix"], e, trys))
+            close_sync_engine(lane)
+        time.sleep(10)
+
+    raise_error(
+        "Number of retries exceed %d. Please check logs to troubleshoot issues." % args.retries,
+        send=True, run=Path(args.run_dir).name
+        )
+
+
+def sync_lanes(pool, lanes, sync):
+    """Call sync with each lane on the pool, waiting for every lane to
+    finish before raising the first error (including the SystemExit of
+    a lane which ran out of retries)"""
+    futures = [pool.submit(sync, lane) for lane in lanes]
+    wait(futures)
+    for future in futures:
+        future.result()
+
+
+def share_threads(threads, workers):
+    """Threads each of the lanes synced at once may use"""
+    return max(1, threads // workers)
+
+
+def close_sync_engine(lane):
+    if lane.get("engine") is not None:
+        lane["engine"].close()
+    lane["engine"] = None
+    lane["engine_args"] = None
+
+
+def get_sync_dir_args(lane, args, finish=False):
+    """Arguments of dx_sync_directory.py to sync a lane with"""
+    # Set lane specific patterns to include IF uploading by lane
+    include_patterns = []
+    if not lane["lane"] == "all":
+        include_patterns = CONFIG_FILES + [get_lane_pattern(lane)]
+    include_patterns = list(dict.fromkeys(include_patterns))
+    exclude_patterns = get_exclude_patterns(args)
+
+    invocation = ["--log-file", lane["log_path"]]
     invocation.extend(["--tar-destination", args.project + ":" + lane["remote_folder"]])
     invocation.extend(["--tar-directory", args.temp_dir])
     invocation.extend(["--include-patterns"])
@@ -372,23 +542,111 @@ def run_sync_dir(lane, args, finish=False):
     invocation.extend(exclude_patterns)
     invocation.extend(["--min-tar-size", str(args.min_size)])
     invocation.extend(["--max-tar-size", str(args.max_size)])
-    invocation.extend(["--upload-threads", str(args.upload_threads)])
+    invocation.extend(["--upload-threads", str(share_threads(args.upload_threads, args.lane_workers))])
+    invocation.extend(["--compress-threads", str(share_threads(args.compress_threads, args.lane_workers))])
+    invocation.extend(["--codec", args.codec])
+    invocation.extend(["--pipeline-depth", str(args.pipeline_depth)])
+    invocation.extend(["--packing", args.packing])
+    if args.compress_level is not None:
+        invocation.extend(["--compress-level", str(args.compress_level)])
+    if args.compress_policy:
+        invocation.extend(["--compress-policy", args.compress_policy])
     invocation.extend(["--prefix", lane["prefix"]])
     invocation.extend(["--auth-token", args.api_token])
     if args.verbose:
         invocation.append("--verbose")
     if args.dxpy_upload:
         invocation.append("--dxpy-upload")
+    if args.builtin_upload:
+        invocation.append("--builtin-upload")
+    if args.sha256:
+        invocation.append("--sha256")
+    if args.adaptive_upload:
+        invocation.append("--adaptive-upload")
+        if args.max_upload_threads:
+            invocation.extend(["--max-upload-threads",
+                               str(share_threads(args.max_upload_threads, args.lane_workers))])
+        if args.max_part_size:
+            invocation.extend(["--max-part-size", str(args.max_part_size)])
+    if args.bandwidth_schedule:
+        invocation.append("--bandwidth-schedule")
+        invocation.extend(args.bandwidth_schedule)
+    if args.stream:
+        invocation.append("--stream")
+    if args.prune_unchanged_dirs:
+        invocation.append("--prune-unchanged-dirs")
+    if args.dedup_content:
+        invocation.append("--dedup-content")
+    if args.change_feed:
+        invocation.extend(["--change-feed", args.change_feed])
+        invocation.extend(["--full-scan-interval", str(args.full_scan_interval)])
     if finish:
         invocation.append("--finish")
     else:
         invocation.extend(["--min-age", str(args.min_age)])
+        if args.stable_scans:
+            invocation.extend(["--stable-scans", str(args.stable_scans)])
+        if args.churn_threshold:
+            invocation.extend(["--churn-threshold", str(args.churn_threshold)])
+    if args.space_budget:
+        invocation.extend(["--space-budget", str(args.space_budget)])
+    if args.gentle_io:
+        invocation.append("--gentle-io")
+    if args.yield_to_writes:
+        invocation.extend(["--yield-to-writes", str(args.yield_to_writes)])
     invocation.append(args.run_dir)
 
-    output = run_command_with_retry(
-        args.retries, invocation, args.run_dir
-    )
-    return output.split()
+    return invocation
+
+
+def finish_lane(lane, args, run_id, local_sample_sheet, halt_downstream, scan=None):
+    """Sync a lane for the last time, upload its log and manifest, and
+    close its upload sentinel record with the details of its upload"""
+    file_ids = run_sync_dir(lane, args, finish=True, scan=scan)
+    record = lane["dxrecord"]
+    properties = record.get_properties()
+    lane["log_file_id"] = upload_single_file(lane["log_path"], args.project,
+                                             lane["remote_folder"], properties)
+    lane["manifest_file_id"] = upload_single_file(get_manifest_path(lane["log_path"]),
+                                                  args.project, lane["remote_folder"], properties)
+    print(f"all file ids: {file_ids}")
+    for file_id in file_ids:
+        print(f"record: {record}")
+        print(f"file id: {file_id}")
+        print(f"project: {args.project}")
+        print(f"properties: {properties}")
+        dxpy.get_handler(file_id, project=args.project).set_properties(properties)
+    details = {
+        'run_id': run_id,
+        'lanes': lane["lane"],
+        'upload_thumbnails': str(args.upload_thumbnails).lower(),
+        'dnanexus_path': args.project + ":" + lane["remote_folder"],
+        'tar_file_ids': file_ids
+        }
+
+    # Upload sample sheet here, if samplesheet-delay specified
+    if args.samplesheet_delay and local_sample_sheet and not halt_downstream:
+        lane["samplesheet_file_id"] = upload_single_file(
+            os.path.join(args.run_dir, local_sample_sheet),
+            args.project,
+            lane["remote_folder"],
+            properties
+        )
+
+    # ID to singly uploaded file (when uploaded successfully)
+    if lane.get("log_file_id"):
+        details.update({'log_file_id': lane["log_file_id"]})
+    if lane.get("manifest_file_id"):
+        details.update({'manifest_file_id': lane["manifest_file_id"]})
+    if lane.get("runinfo_file_id"):
+        details.update({'runinfo_file_id': lane["runinfo_file_id"]})
+    if lane.get("samplesheet_file_id"):
+        details.update({'samplesheet_file_id': lane["samplesheet_file_id"]})
+
+    record.set_details(details)
+
+    record.close()
+    print_stderr("Run %s, lane %s successfully streamed" % (run_id, lane["lane"]))
 
 
 def termination_file_exists(run_dir, novaseq):
@@ -704,6 +962,22 @@ def main():
     seconds_to_wait = (dxpy.utils.normalize_timedelta(args.run_duration) / 1000 * args.intervals_to_wait)
     print_stderr("Maximum allowable time for run to complete: %d seconds." %seconds_to_wait)
 
+    # Watch for changes between syncs, rather than scanning every time
+    watcher = None
+    if args.watch:
+        watcher = start_change_watcher(args, run_id)
+    args.change_feed = watcher.feed_path if watcher else None
+
+    # Sync up to --parallel-lanes lanes at once, sharing threads between them
+    lanes_to_sync = [lane for lane in lane_info if not lane["uploaded"]]
+    args.lane_workers = min(args.parallel_lanes, len(lanes_to_sync))
+    pool = ThreadPoolExecutor(max_workers=args.lane_workers)
+
+    # Walk the run directory once per sync for all lanes
+    scan = None
+    if args.num_lanes:
+        scan = start_shared_scan(lanes_to_sync, args)
+
     initial_start_time = time.time()
     # While loop waiting for RTAComplete.txt or RTAComplete.xml
     while not termination_file_exists(args.run_dir, args.novaseq):
@@ -716,12 +990,10 @@ def main():
                 send=True, run=run_id
                 )
 
-        # Loop through all lanes in run directory
-        for lane in lane_info:
-            lane_num = lane["lane"]
-            if lane["uploaded"]:
-               continue
-            run_sync_dir(lane, args)
+        # Sync all lanes in run directory
+        if scan:
+            scan.reset()
+        sync_lanes(pool, lanes_to_sync, lambda lane: run_sync_dir(lane, args, scan=scan))
 
         # Wait at least the minimum time interval before running the loop again
         cur_time = time.time()
@@ -730,50 +1002,18 @@ def main():
             print_stderr("Sleeping for %d seconds" % (int(args.sync_interval - diff)))
             time.sleep(int(args.sync_interval - diff))
 
-    # Final synchronization, upload data, set details
-    for lane in lane_info:
-        if lane["uploaded"]:
-            continue
-        file_ids = run_sync_dir(lane, args, finish=True)
-        record = lane["dxrecord"]
-        properties = record.get_properties()
-        lane["log_file_id"] = upload_single_file(lane["log_path"], args.project,
-                                         lane["remote_folder"], properties)
-        print(f"all file ids: {file_ids}")
-        for file_id in file_ids:
-            print(f"record: {record}")
-            print(f"file id: {file_id}")
-            print(f"project: {args.project}")
-            print(f"properties: {properties}")
-            dxpy.get_handler(file_id, project=args.project).set_properties(properties)
-        details = {
-            'run_id': run_id,
-            'lanes': lane["lane"],
-            'upload_thumbnails': str(args.upload_thumbnails).lower(),
-            'dnanexus_path': args.project + ":" + lane["remote_folder"],
-            'tar_file_ids': file_ids
-            }
-
-        # Upload sample sheet here, if samplesheet-delay specified
-        if args.samplesheet_delay and local_sample_sheet and not halt_downstream:
-            lane["samplesheet_file_id"] = upload_single_file(
-                os.path.join(args.run_dir, local_sample_sheet),
-                args.project,
-                lane["remote_folder"],
-                properties
-            )
-
-        # ID to singly uploaded file (when uploaded successfully)
-        if lane.get("log_file_id"):
-            details.update({'log_file_id': lane["log_file_id"]})
-        if lane.get("runinfo_file_id"):
-            details.update({'runinfo_file_id': lane["runinfo_file_id"]})
-        if lane.get("samplesheet_file_id"):
-            details.update({'samplesheet_file_id': lane["samplesheet_file_id"]})
-
-        record.set_details(details)
-
-        record.close()
+    # The final sync always scans the whole run directory
+    if watcher:
+        watcher.stop()
+        args.change_feed = None
+    if scan:
+        scan = start_shared_scan(lanes_to_sync, args, finish=True)
+
+    # Final synchronization, each lane's record closed as soon as it is done
+    sync_lanes(pool, lanes_to_sync,
+               lambda lane: finish_lane(lane, args, run_id, local_sample_sheet,
+                                        halt_downstream, scan))
+    pool.shutdown()
 
     print_stderr("Run %s successfully streamed!" % (run_id))
 
@@ -0,0 +1,258 @@
+"""
+Called from dx_sync_directory.py to keep tar files from being built at
+the expense of the instrument, when uploading from the instrument's own
+control PC or from storage it shares.
+
+Reading every CBCL file through the page cache evicts the instrument
+software's working set, so source files are read with a sequential
+readahead hint and the pages read are dropped from the cache behind the
+reader (posix_fadvise). Tar files are built in a worker thread at a low
+CPU (nice) and I/O (best effort, lowest level) priority, which the
+threads compressing its blocks inherit, so the instrument's own work is
+scheduled first. On Linux both priorities apply to a single thread,
+leaving the threads uploading tar files as they were.
+
+Reading can also yield to the instrument's writes: the write rate of
+the disk holding the run directory is sampled from /proc/diskstats, and
+whilst it is above a limit reading pauses, for at most MAX_PAUSE
+seconds at a time so that a steady stream of writes does not stop the
+sync altogether. Run directories on network file systems have no local
+disk to sample, so are never paused for. This process' own writes
+(/proc/self/io) are counted when they are made but reach the disk
+later, as the page cache is written back, so the disk's writes are put
+down to this process until they have covered its own.
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+import time
+
+
+# ioprio_set syscall numbers, by machine
+IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'armv7l': 314, 'ppc64le': 273}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+
+# Priorities the tar building thread is lowered to
+WORKER_NICE = 19
+WORKER_IO_LEVEL = 7
+
+# Bytes read from a file between dropping the pages read from the cache
+DROP_CHUNK = 8 * 2**20
+
+# Seconds between samples of the disk's write rate, and at most paused
+# for in one go whilst it is above the limit
+SAMPLE_SECONDS = 1.0
+MAX_PAUSE = 60
+
+
+def set_thread_priority(nice=WORKER_NICE, io_level=WORKER_IO_LEVEL) -> bool:
+    """
+    Lower the CPU and I/O priority of the calling thread (and threads it
+    goes on to start). Priorities are never raised, as only root may.
+    Returns False if the I/O priority could not be set (e.g. not Linux).
+    """
+    # on Linux, who=0 is the calling thread rather than the process
+    if os.getpriority(os.PRIO_PROCESS, 0) < nice:
+        os.setpriority(os.PRIO_PROCESS, 0, nice)
+
+    syscall = IOPRIO_SET.get(platform.machine())
+    if syscall is None:
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    ioprio = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | io_level
+    return libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, ioprio) == 0
+
+
+def get_disk_written(device) -> int:
+    """Bytes written to a block device (major, minor) since boot, None
+    if it is not listed in /proc/diskstats"""
+    try:
+        with open('/proc/diskstats') as fh:
+            for line in fh:
+                fields = line.split()
+                if (int(fields[0]), int(fields[1])) == device:
+                    return int(fields[9]) * 512
+    except OSError:
+        pass
+    return None
+
+
+def get_own_written() -> int:
+    """Bytes this process has caused to be written to storage"""
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class WriteRateMonitor():
+    """
+    Samples the rate other processes write to the disk holding a path.
+
+    Parameters
+    ----------
+    path : str
+        path on the disk to monitor
+    clock : callable
+        returns the current time, time.monotonic by default
+    """
+    def __init__(self, path, clock=time.monotonic) -> None:
+        st_dev = os.stat(path).st_dev
+        self.device = (os.major(st_dev), os.minor(st_dev))
+        self.clock = clock
+        self.last = self._sample()
+        # own bytes written not yet seen written to the disk
+        self.unflushed = 0
+
+
+    def is_available(self) -> bool:
+        """Whether the path is on a local disk whose writes are counted"""
+        return self.last[1] is not None
+
+
+    def get_rate(self) -> float:
+        """Bytes per second written by others since the last call"""
+        sample = self._sample()
+        elapsed = sample[0] - self.last[0]
+        written = sample[1] - self.last[1]
+        self.unflushed += sample[2] - self.last[2]
+        own = min(written, self.unflushed)
+        self.unflushed -= own
+        self.last = sample
+        return (written - own) / elapsed if elapsed > 0 else 0
+
+
+    def _sample(self) -> tuple:
+        return self.clock(), get_disk_written(self.device), get_own_written()
+
+
+class IOGovernor():
+    """
+    Governs how tar files are built: the priority of the thread
+    building them, and how source files are read.
+
+    Parameters
+    ----------
+    gentle : bool
+        drop source files from the page cache as they are read and
+        build tar files at a low CPU and I/O priority
+    write_limit : float
+        optional bytes per second written to the run directory's disk
+        by others, above which reading pauses
+    sync_dir : str
+        run directory being synced
+    clock : callable
+        returns the current time, time.monotonic by default
+    sleep : callable
+        waits a number of seconds, time.sleep by default
+    """
+    def __init__(self, gentle=False, write_limit=None, sync_dir=None,
+                 clock=time.monotonic, sleep=time.sleep) -> None:
+        self.gentle = gentle
+        self.write_limit = write_limit
+        self.clock = clock
+        self.sleep = sleep
+        self.paused = 0.0
+
+        self.monitor = None
+        if write_limit:
+            monitor = WriteRateMonitor(sync_dir, clock)
+            if monitor.is_available():
+                self.monitor = monitor
+        self.next_sample = 0
+
+
+    def open(self, path):
+        """Open a source file to be read into a tar file"""
+        if not self.gentle and self.monitor is None:
+            return open(path, 'rb')
+        return GovernedReader(open(path, 'rb'), self)
+
+
+    def run(self, func, *args):
+        """
+        Call func with args, in a thread of its own at a low priority
+        if gentle. Returns what func returns, and raises what it raises.
+        """
+        if not self.gentle:
+            return func(*args)
+
+        outcome = {}
+
+        def target():
+            try:
+                set_thread_priority()
+                outcome['result'] = func(*args)
+            except BaseException as e:
+                outcome['error'] = e
+
+        worker = threading.Thread(target=target, name='tar-builder')
+        worker.start()
+        worker.join()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+
+    def wait_for_writes(self) -> None:
+        """Pause whilst others write to the run directory's disk faster
+        than the limit, sampling the rate at most every SAMPLE_SECONDS"""
+        if self.monitor is None or self.clock() < self.next_sample:
+            return
+
+        paused = 0
+        while self.monitor.get_rate() > self.write_limit and paused < MAX_PAUSE:
+            self.sleep(SAMPLE_SECONDS)
+            paused += SAMPLE_SECONDS
+        self.paused += paused
+        self.next_sample = self.clock() + SAMPLE_SECONDS
+
+
+class GovernedReader():
+    """Reads a source file for an IOGovernor, hinting sequential access
+    and dropping the pages read from the page cache if gentle, and
+    yielding to writes to the disk"""
+    def __init__(self, fileobj, governor) -> None:
+        self.fileobj = fileobj
+        self.governor = governor
+        self.offset = 0
+        self.dropped = 0
+        if governor.gentle:
+            os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+    def __enter__(self) -> 'GovernedReader':
+        return self
+
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+    def read(self, size=-1) -> bytes:
+        self.governor.wait_for_writes()
+        data = self.fileobj.read(size)
+        self.offset += len(data)
+        if self.offset - self.dropped >= DROP_CHUNK:
+            self._drop()
+        return data
+
+
+    def close(self) -> None:
+        self._drop()
+        self.fileobj.close()
+
+
+    def _drop(self) -> None:
+        if self.governor.gentle and self.offset > self.dropped:
+            os.posix_fadvise(self.fileobj.fileno(), self.dropped,
+                             self.offset - self.dropped, os.POSIX_FADV_DONTNEED)
+        self.dropped = self.offset
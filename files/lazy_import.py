@@ -0,0 +1,41 @@
+"""
+Called from the other scripts to defer importing their heaviest
+dependencies (dxpy, requests, bs4) until they are first used.
+
+Each sync interval and monitoring cron tick starts a new Python process,
+and importing these modules costs more than the rest of its startup
+together. A lazily imported module is bound to its name as usual, but
+is only executed the first time one of its attributes is looked up, so
+a sync which finds nothing to upload never imports dxpy at all.
+
+Usage:
+
+    dxpy = lazy_import('dxpy')
+"""
+import importlib.util
+import sys
+import types
+
+
+def lazy_import(name) -> types.ModuleType:
+    """
+    Import a module which is only executed when first used. Returns the
+    module itself if it has already been imported.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '%s'" % name, name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def is_loaded(module) -> bool:
+    """Whether a module has been executed, without executing it"""
+    # a lazy module turns into a plain module once executed
+    return type(module) is types.ModuleType
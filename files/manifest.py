@@ -0,0 +1,76 @@
+"""
+Called from dx_sync_directory.py to write the manifest of a synced
+directory, and from reconcile.py to read the manifests uploaded.
+
+The manifest lists every file synced with its size, mtime and md5 (as
+computed while it was tarred), the tar file it is in and the offset of
+its data within the uncompressed tar stream. It is a gzipped, tab
+separated file with a header line, small enough to download in place of
+the tar files it describes.
+"""
+import gzip
+import os
+import re
+
+
+MANIFEST_SUFFIX = '.manifest.tsv.gz'
+
+COLUMNS = ('path', 'size', 'mtime', 'md5', 'tar_index', 'tar_file_id', 'offset')
+
+# Columns converted from text when read
+INT_COLUMNS = ('size', 'tar_index', 'offset')
+FLOAT_COLUMNS = ('mtime',)
+
+
+def get_manifest_path(log_file) -> str:
+    """Path of the manifest written alongside the given log file"""
+    return os.path.splitext(log_file)[0] + MANIFEST_SUFFIX
+
+
+def get_tar_index(tar_name) -> int:
+    """Index of a tar file from its name (<prefix>_<index>.tar...)"""
+    match = re.search(r'_(\d+)\.tar', os.path.basename(tar_name))
+    return int(match.group(1)) if match else None
+
+
+def write_manifest(path, rows) -> int:
+    """
+    Write the manifest from an iterable of dicts keyed on COLUMNS,
+    returning the number of rows written. The manifest is written to a
+    temporary file which then replaces any existing one.
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    with gzip.open(tmp_path, 'wt', newline='') as fh:
+        fh.write('#' + '\t'.join(COLUMNS) + '\n')
+        for row in rows:
+            fh.write('\t'.join(format_value(row.get(column)) for column in COLUMNS) + '\n')
+            count += 1
+    os.replace(tmp_path, path)
+
+    return count
+
+
+def format_value(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        # repr round trips exactly, so mtimes compare equal when read
+        return repr(value)
+    return str(value)
+
+
+def read_manifest(fileobj):
+    """Yield a dict for each row of a manifest read from a binary file object"""
+    with gzip.open(fileobj, 'rt', newline='') as fh:
+        columns = fh.readline().lstrip('#').rstrip('\n').split('\t')
+        for line in fh:
+            row = dict(zip(columns, line.rstrip('\n').split('\t')))
+            for column, value in row.items():
+                if value == '':
+                    row[column] = None
+                elif column in INT_COLUMNS:
+                    row[column] = int(value)
+                elif column in FLOAT_COLUMNS:
+                    row[column] = float(value)
+            yield row
@@ -37,10 +37,32 @@ CONFIG_DEFAULT = {
     "run_length": "24h",
     "n_seq_intervals": 2,
     "n_upload_threads": 8,
+    "n_compress_threads": 1,
+    "codec": "gzip",
+    "pipeline_depth": 1,
+    "packing": "balanced",
+    "compress_level": '',
+    "compress_policy": '',
     "downstream_input": '',
     "n_streaming_threads": 1,
     "delay_sample_sheet_upload": False,
-    "novaseq": False
+    "novaseq": False,
+    "stream_upload": False,
+    "builtin_upload": False,
+    "tar_sha256": False,
+    "bandwidth_schedule": "",
+    "adaptive_upload": False,
+    "max_upload_threads": '',
+    "max_part_size": '',
+    "prune_unchanged_dirs": False,
+    "watch_run_dir": False,
+    "full_scan_interval": 3600,
+    "stable_scans": 0,
+    "dedup_content": False,
+    "churn_threshold": 0,
+    "space_budget": 0,
+    "gentle_io": False,
+    "yield_to_writes": 0
 }
 
 # Base folder in which the RUN folders are deposited
@@ -418,12 +440,66 @@ def _trigger_streaming_upload(folder, config):
                "-D", config['run_length'],
                "-I", config['n_seq_intervals'],
                "-u", config['n_upload_threads'],
+               "--compress-threads", config['n_compress_threads'],
+               "--codec", config['codec'],
+               "--pipeline-depth", config['pipeline_depth'],
+               "--packing", config['packing'],
                "--sequencer_id", f"\'{config['sequencer_id']}\'",
                "--verbose"]
 
     if config['novaseq']:
         command += ['-n']
 
+    if config['stream_upload']:
+        command += ['--stream']
+
+    if config['builtin_upload']:
+        command += ['--builtin-upload']
+
+    if config['tar_sha256']:
+        command += ['--sha256']
+
+    if config['adaptive_upload']:
+        command += ['--adaptive-upload']
+        if config['max_upload_threads'] != '':
+            command += ['--max-upload-threads', config['max_upload_threads']]
+        if config['max_part_size'] != '':
+            command += ['--max-part-size', config['max_part_size']]
+
+    if config['bandwidth_schedule'] != '':
+        command += ['--bandwidth-schedule'] + config['bandwidth_schedule'].split()
+
+    if config['stable_scans']:
+        command += ['--stable-scans', config['stable_scans']]
+
+    if config['prune_unchanged_dirs']:
+        command += ['--prune-unchanged-dirs']
+
+    if config['dedup_content']:
+        command += ['--dedup-content']
+
+    if config['churn_threshold']:
+        command += ['--churn-threshold', config['churn_threshold']]
+
+    if config['space_budget']:
+        command += ['--space-budget', config['space_budget']]
+
+    if config['gentle_io']:
+        command += ['--gentle-io']
+
+    if config['yield_to_writes']:
+        command += ['--yield-to-writes', config['yield_to_writes']]
+
+    if config['watch_run_dir']:
+        command += ['--watch', '--full-scan-interval', config['full_scan_interval']]
+
+    if config['compress_level'] != '':
+        command += ["--compress-level", config['compress_level']]
+
+    if config['compress_policy'] != '':
+        command += ["--compress-policy", os.path.abspath(
+            os.path.expanduser(config['compress_policy']))]
+
     if config['exclude'] != '':
         command += ["-x", config['exclude']]
 
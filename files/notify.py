@@ -9,11 +9,12 @@ Jethro Rainford
 import os
 import re
 import sys
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
 
-from bs4 import BeautifulSoup as bs
+from lazy_import import lazy_import
+
+# only needed to send a message or read RunInfo.xml
+bs4 = lazy_import('bs4')
+requests = lazy_import('requests')
 
 
 class Slack():
@@ -66,6 +67,9 @@ class Slack():
             sys.stderr
         )
 
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import Retry
+
         http = requests.Session()
         retries = Retry(
             total=5,
@@ -150,7 +154,7 @@ class CheckCycles():
         with open(runinfo) as fh:
             contents = fh.read()
 
-        bs_data = bs(contents, 'xml')
+        bs_data = bs4.BeautifulSoup(contents, 'xml')
         reads = bs_data.find_all('Read')
         cycle_count = sum([int(x.get('NumCycles')) for x in reads])
 
@@ -0,0 +1,564 @@
+"""
+Called from dx_sync_directory.py to upload data to the platform in parts.
+
+StreamingPartWriter uploads data as it is produced, without first
+writing it to a local file. The data written is cut into parts of a
+fixed size in memory, and each part is uploaded to an open platform
+file by a small pool of threads. Only a bounded number of parts are
+held in memory at any one time.
+
+upload_file_parts uploads a local file in parts, skipping any parts
+already uploaded to the platform file by an earlier, interrupted
+attempt, so that a retry only sends what is missing.
+
+Both send parts through either dxpy (one request per part, through
+dxpy's own retry logic) or a PartUploader: an in-process uploader
+which sends parts from a pool of threads over a single keep-alive HTTP
+session, retrying each part on its own, at a rate limited by a shared
+bandwidth bucket if given one (see bandwidth.py). The PartUploader
+takes the place of the Upload Agent (ua), without a process per tar
+file or the auth token on a command line.
+
+PartHasher computes the md5 of each part of a tar file as it is written,
+so the parts on the platform can be checked against the tar file as it
+was built without reading it back (find_mismatched_parts).
+"""
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hashlib import md5, sha256
+
+from lazy_import import lazy_import
+
+dxpy = lazy_import('dxpy')
+requests = lazy_import('requests')
+
+
+# Platform limits on file parts, every part other than the last must
+# be at least MIN_PART_SIZE bytes, and a file may have at most MAX_PARTS
+MIN_PART_SIZE = 5 * 2**20
+MAX_PARTS = 10000
+
+
+class StreamingPartWriter():
+    """
+    Write-only file object that uploads everything written to it as
+    the parts of a new platform file.
+
+    Parameters
+    ----------
+    name : str
+        name of the file to create on the platform
+    project : str
+        ID of project to create the file in
+    folder : str
+        folder in the project to create the file in
+    part_size : int
+        size (in bytes) of each uploaded part, except the last
+    max_in_flight : int
+        maximum number of parts held in memory waiting to be uploaded
+    on_part : callable
+        optional function called with (index, size, md5) as each part
+        completes, used to record upload progress
+    uploader : PartUploader
+        optional uploader to send parts with, instead of dxpy
+    """
+    def __init__(
+        self, name, project, folder, part_size, max_in_flight=4, on_part=None,
+        uploader=None
+    ) -> None:
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(
+                f"Part size must be at least {MIN_PART_SIZE} bytes, "
+                f"got {part_size}"
+            )
+
+        self.part_size = part_size
+        self.on_part = on_part
+        self.bytes_written = 0
+
+        self._buffer = bytearray()
+        self._next_index = 1
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._closed = False
+
+        if uploader:
+            self.dx_file = uploader.new_file(name, project, folder)
+        else:
+            self.dx_file = dxpy.new_dxfile(
+                name=name, project=project, folder=folder, parents=True
+            )
+        self.file_id = self.dx_file.get_id()
+
+
+    def writable(self) -> bool:
+        return True
+
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+
+    def write(self, data) -> int:
+        """
+        Buffer the given data, uploading a part each time the buffer
+        holds at least part_size bytes. Blocks while max_in_flight parts
+        are already waiting to be uploaded.
+        """
+        if self._closed:
+            raise ValueError("write to closed StreamingPartWriter")
+
+        self._buffer += data
+        self.bytes_written += len(data)
+
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(part)
+
+        return len(data)
+
+
+    def close(self, before_close=None) -> str:
+        """
+        Upload any remaining buffered data as the final part, wait for
+        all parts to finish uploading and close the platform file.
+
+        Parameters
+        ----------
+        before_close : callable
+            optional function called once every part has uploaded and
+            before the file is closed, which may raise to leave the file
+            open, used to check the parts uploaded
+
+        Returns
+        -------
+        str
+            ID of the uploaded platform file
+        """
+        if self._closed:
+            return self.file_id
+
+        if self._buffer or self._next_index == 1:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        self._closed = True
+        self._pool.shutdown(wait=True)
+
+        # raise the first error hit by any part, leaving the file open
+        # so that the caller can decide what to do with it
+        for future in self._futures:
+            future.result()
+
+        if before_close:
+            before_close()
+
+        self.dx_file.close(block=True)
+
+        return self.file_id
+
+
+    def abort(self) -> None:
+        """
+        Stop uploading and remove the partially uploaded file from
+        the platform.
+        """
+        self._closed = True
+        self._pool.shutdown(wait=True)
+
+        try:
+            self.dx_file.remove()
+        except dxpy.exceptions.DXError as e:
+            print(
+                f"Failed to remove partially uploaded file {self.file_id}: {e}",
+                file=sys.stderr
+            )
+
+
+    def _submit(self, part) -> None:
+        """Queue a part for upload once a slot is free"""
+        if self._next_index > MAX_PARTS:
+            raise ValueError(
+                f"Stream exceeds the maximum of {MAX_PARTS} parts, increase "
+                "the part size"
+            )
+
+        # surface upload errors as early as possible rather than
+        # carrying on streaming into a file that will never close
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+
+        self._slots.acquire()
+        future = self._pool.submit(self._upload_part, part, self._next_index)
+        self._futures.append(future)
+        self._next_index += 1
+
+
+    def _upload_part(self, part, index) -> None:
+        try:
+            self.dx_file.upload_part(part, index=index)
+
+            if self.on_part:
+                self.on_part(index, len(part), md5(part).hexdigest())
+        finally:
+            self._slots.release()
+
+
+def get_part_count(size, part_size) -> int:
+    """Number of parts a file of size bytes is uploaded in"""
+    return max(1, math.ceil(size / part_size))
+
+
+def get_upload_part_size(size, part_size) -> int:
+    """
+    The given part size, increased if needed so that a file of size
+    bytes fits in MAX_PARTS parts
+    """
+    return max(part_size, MIN_PART_SIZE, math.ceil(size / MAX_PARTS))
+
+
+def get_uploaded_parts(file_id) -> tuple:
+    """
+    State of a platform file and the parts of it which have finished
+    uploading, as {index: {'size', 'md5'}}. The state is None if the
+    file no longer exists.
+    """
+    try:
+        desc = dxpy.api.file_describe(
+            file_id, {'fields': {'state': True, 'parts': True}}
+        )
+    except dxpy.exceptions.ResourceNotFound:
+        return None, {}
+
+    parts = {}
+    for index, part in (desc.get('parts') or {}).items():
+        if part.get('state') == 'complete':
+            parts[int(index)] = {'size': part.get('size'), 'md5': part.get('md5')}
+
+    return desc.get('state'), parts
+
+
+def upload_file_parts(
+    path, dx_file, part_size, threads=4, skip=(), on_part=None, close=True,
+    controller=None
+) -> dict:
+    """
+    Upload a local file as the parts of an open platform file and
+    close it.
+
+    Parameters
+    ----------
+    path : str
+        path of the local file
+    dx_file : dxpy.DXFile
+        open platform file to upload to
+    part_size : int
+        size (in bytes) of each part, except the last
+    threads : int
+        number of parts uploaded at once, each held in memory whilst
+        it uploads
+    skip : iterable
+        indices of parts already uploaded, which are not sent again
+    on_part : callable
+        optional function called with (index, size, md5) as each part
+        completes, used to record upload progress, which may raise to
+        fail the part
+    close : bool
+        close the platform file once every part has uploaded
+    controller : upload_control.UploadController
+        optional controller setting the number of parts uploaded at
+        once in place of threads, which is told how long each part took
+
+    Returns
+    -------
+    dict
+        file_id, the bytes and parts sent, the seconds taken in all and
+        the seconds each part took to upload keyed by index
+    """
+    start = time.time()
+    n_parts = get_part_count(os.path.getsize(path), part_size)
+    if n_parts > MAX_PARTS:
+        raise ValueError(
+            f"{path} exceeds the maximum of {MAX_PARTS} parts, increase "
+            "the part size"
+        )
+
+    part_seconds = {}
+
+    def upload_part(index):
+        with open(path, 'rb') as fh:
+            part = os.pread(fh.fileno(), part_size, (index - 1) * part_size)
+        part_start = time.time()
+        dx_file.upload_part(part, index=index)
+        part_seconds[index] = time.time() - part_start
+        if controller:
+            controller.record_part(len(part), part_seconds[index])
+        if on_part:
+            on_part(index, len(part), md5(part).hexdigest())
+        return len(part)
+
+    def get_threads():
+        return controller.threads if controller else max(1, threads)
+
+    skip = set(skip)
+    to_send = [index for index in range(1, n_parts + 1) if index not in skip]
+    sent = 0
+    max_workers = controller.max_threads if controller else get_threads()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        for index in to_send:
+            while len(pending) >= get_threads():
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # raise the first error hit by any part, leaving the file
+                # open so that a later attempt can carry on from here
+                sent += sum(future.result() for future in done)
+            pending.add(pool.submit(upload_part, index))
+        sent += sum(future.result() for future in pending)
+
+    if close:
+        dx_file.close(block=True)
+
+    return {'file_id': dx_file.get_id(), 'bytes': sent, 'parts': len(to_send),
+            'seconds': time.time() - start, 'part_seconds': part_seconds}
+
+
+def find_mismatched_parts(file_id, part_md5s) -> list:
+    """
+    Indices of the parts of a platform file which are missing, or whose
+    md5 does not match the given md5 of each part in order, along with
+    any parts beyond the last expected
+    """
+    _, uploaded = get_uploaded_parts(file_id)
+
+    mismatched = [
+        index for index, part_md5 in enumerate(part_md5s, 1)
+        if uploaded.get(index, {}).get('md5') != part_md5
+    ]
+    mismatched.extend(
+        index for index in sorted(uploaded) if index > len(part_md5s)
+    )
+
+    return mismatched
+
+
+class PartHasher():
+    """
+    Write-through file object which computes the md5 of each part of
+    part_size bytes written through it, and optionally the sha256 of
+    everything written.
+
+    Parameters
+    ----------
+    fileobj : file object
+        file object written to
+    part_size : int
+        size (in bytes) of each part hashed, except the last
+    with_sha256 : bool
+        also compute the sha256 of the whole file
+    """
+    def __init__(self, fileobj, part_size, with_sha256=False) -> None:
+        self.fileobj = fileobj
+        self.part_size = part_size
+        self.part_md5s = []
+        self.bytes_written = 0
+
+        self._part = md5()
+        self._part_written = 0
+        self._sha256 = sha256() if with_sha256 else None
+
+
+    def writable(self) -> bool:
+        return True
+
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+
+    def write(self, data) -> int:
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+        if self._sha256:
+            self._sha256.update(data)
+
+        view = memoryview(data)
+        while len(view):
+            take = min(len(view), self.part_size - self._part_written)
+            self._part.update(view[:take])
+            self._part_written += take
+            view = view[take:]
+            if self._part_written == self.part_size:
+                self.part_md5s.append(self._part.hexdigest())
+                self._part = md5()
+                self._part_written = 0
+
+        return len(data)
+
+
+    def finish(self) -> tuple:
+        """
+        The md5 of each part, including a final partial (or, for an
+        empty file, empty) part, and the sha256 of the whole file if
+        it was asked for
+        """
+        if self._part_written or not self.part_md5s:
+            self.part_md5s.append(self._part.hexdigest())
+            self._part = md5()
+            self._part_written = 0
+
+        return (
+            self.part_md5s, self._sha256.hexdigest() if self._sha256 else None
+        )
+
+
+def format_upload_stats(result) -> str:
+    """One line summary of the result of upload_file_parts"""
+    if not result['parts']:
+        return "no parts sent"
+    latencies = sorted(result['part_seconds'].values())
+    return "%.1f MB in %d parts in %.1fs (%.1f MB/s), part upload median %.2fs, max %.2fs" % (
+        result['bytes'] / 2**20, result['parts'], result['seconds'],
+        result['bytes'] / 2**20 / max(result['seconds'], 1e-6),
+        latencies[len(latencies) // 2], latencies[-1]
+    )
+
+
+class PartUploader():
+    """
+    Uploads file parts to the platform from many threads at once, over
+    a shared pool of keep-alive HTTP connections.
+
+    For each part an upload URL is requested from the API, and the part
+    is sent to it. A failure to send the part, including the URL
+    expiring, is retried with a new URL after a backoff, up to retries
+    times. API calls are retried by dxpy.
+
+    Parameters
+    ----------
+    threads : int
+        number of threads that will upload at once, the size of the
+        connection pool
+    retries : int
+        number of times each part is retried before giving up
+    api : module
+        API to call, dxpy.api by default; anything with file_new,
+        file_upload, file_close, file_describe and
+        project_remove_objects functions taking the same arguments
+    session : requests.Session
+        optional session to send parts with
+    bucket : bandwidth.TokenBucket
+        optional bucket limiting the rate parts are sent at
+    controller : upload_control.UploadController
+        optional controller told of each failed attempt at a part
+    """
+    def __init__(
+        self, threads=8, retries=5, api=None, session=None, timeout=(60, 600),
+        bucket=None, controller=None
+    ) -> None:
+        self.retries = retries
+        self.bucket = bucket
+        self.controller = controller
+        self.timeout = timeout
+        self.api = api or dxpy.api
+
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max(1, threads), max_retries=0
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+
+    def new_file(self, name, project, folder) -> 'UploadFile':
+        """Create a new open platform file to upload parts to"""
+        file_id = self.api.file_new({
+            'name': name, 'project': project, 'folder': folder, 'parents': True
+        })['id']
+        return UploadFile(self, file_id, project)
+
+
+    def open_file(self, file_id, project=None) -> 'UploadFile':
+        """An existing open platform file to upload more parts to"""
+        return UploadFile(self, file_id, project)
+
+
+    def upload_part(self, file_id, data, index) -> None:
+        """Upload one part, retrying with a fresh upload URL on failure"""
+        request = {'index': index, 'size': len(data), 'md5': md5(data).hexdigest()}
+
+        for attempt in range(self.retries + 1):
+            try:
+                upload = self.api.file_upload(file_id, request)
+                body = self.bucket.throttle(data) if self.bucket else data
+                response = self.session.put(
+                    upload['url'], data=body, headers=upload.get('headers', {}),
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+                return
+            except requests.RequestException as e:
+                if self.controller:
+                    response = getattr(e, 'response', None)
+                    self.controller.record_error(
+                        response.status_code if response is not None else None
+                    )
+                if attempt == self.retries:
+                    raise
+                delay = min(2 ** attempt, 60)
+                print(
+                    f"Part {index} of {file_id} failed ({e}), retrying in {delay}s",
+                    file=sys.stderr
+                )
+                time.sleep(delay)
+
+
+    def close_file(self, file_id, block=True, poll=2) -> None:
+        """Close a platform file, waiting until it is closed if block"""
+        self.api.file_close(file_id, {})
+        while block:
+            state = self.api.file_describe(file_id, {'fields': {'state': True}})['state']
+            if state == 'closed':
+                return
+            time.sleep(poll)
+
+
+class UploadFile():
+    """
+    An open platform file uploaded to with a PartUploader, with the
+    subset of the dxpy.DXFile interface used here
+    """
+    def __init__(self, uploader, file_id, project=None) -> None:
+        self.uploader = uploader
+        self.file_id = file_id
+        self.project = project
+
+
+    def get_id(self) -> str:
+        return self.file_id
+
+
+    def upload_part(self, data, index) -> None:
+        self.uploader.upload_part(self.file_id, data, index)
+
+
+    def close(self, block=False) -> None:
+        self.uploader.close_file(self.file_id, block=block)
+
+
+    def remove(self) -> None:
+        self.uploader.api.project_remove_objects(
+            self.project, {'objects': [self.file_id]}
+        )
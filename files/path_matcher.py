@@ -0,0 +1,144 @@
+"""
+Called from dx_sync_directory.py to test paths against the include and
+exclude patterns.
+
+All of the patterns are combined into a single compiled regex, so each
+path is searched once rather than once per pattern. Patterns which are
+plain strings (e.g. 'Images', 's_1_') or end anchored plain strings
+(e.g. '\\.cbcl$') are tested with `in` / str.endswith instead, which is
+much cheaper than a regex search.
+
+A pattern matching a directory's path also matches every path below
+it, unless it depends on what follows the match (end anchors, word
+boundaries, lookarounds). Directories matched by an exclude pattern
+that does not are skipped without being listed.
+"""
+import re
+
+
+# Regex syntax that makes whether a pattern matches depend on the text
+# after the match, so a match on a directory may not carry over to the
+# paths below it
+PREFIX_UNSAFE = ('$', '\\Z', '\\b', '\\B', '(?')
+
+# Characters with special meaning in a regex outside a character class
+SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+
+
+def literal_text(pattern) -> str:
+    """
+    The string a pattern matches if it is a plain string (possibly with
+    escaped punctuation, e.g. 'SampleSheet\\.csv'), otherwise None
+    """
+    text = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            if char.isalnum():
+                # a class such as \d or \s
+                return None
+            text.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in SPECIAL_CHARS:
+            return None
+        else:
+            text.append(char)
+
+    if escaped:
+        return None
+
+    return ''.join(text)
+
+
+def is_prefix_safe(pattern) -> bool:
+    """True if a match on a path is also a match on every path below it"""
+    return not any(syntax in pattern for syntax in PREFIX_UNSAFE)
+
+
+def can_combine(pattern) -> bool:
+    """
+    False for patterns that change meaning when joined with others
+    into one regex, as group numbers shift and inline flags must lead
+    """
+    return '(?' not in pattern and not re.search(r'\\[1-9]', pattern)
+
+
+class CompiledPatterns():
+    """A list of patterns compiled to test each path in one pass"""
+    def __init__(self, patterns) -> None:
+        substrings = []
+        suffixes = []
+        combined = []
+        self.regexes = []
+        for pattern in patterns:
+            text = literal_text(pattern)
+            if text is not None:
+                substrings.append(text)
+                continue
+
+            if pattern.endswith('$') and not pattern.endswith('\\$'):
+                text = literal_text(pattern[:-1])
+                if text is not None:
+                    suffixes.append(text)
+                    continue
+
+            if can_combine(pattern):
+                combined.append(pattern)
+            else:
+                self.regexes.append(re.compile(pattern))
+
+        if combined:
+            self.regexes.insert(0, re.compile('|'.join('(?:%s)' % x for x in combined)))
+
+        self.substrings = tuple(substrings)
+        self.suffixes = tuple(suffixes)
+
+
+    def search(self, path) -> bool:
+        for text in self.substrings:
+            if text in path:
+                return True
+
+        if self.suffixes and path.endswith(self.suffixes):
+            return True
+
+        for regex in self.regexes:
+            if regex.search(path):
+                return True
+
+        return False
+
+
+class PathMatcher():
+    """
+    Tests whether a path matches (re.search) any of a list of patterns
+
+    Parameters
+    ----------
+    patterns : list
+        regex patterns, duplicates are ignored
+    """
+    def __init__(self, patterns) -> None:
+        self.patterns = list(dict.fromkeys(patterns or []))
+        self._all = CompiledPatterns(self.patterns)
+        self._prefix_safe = CompiledPatterns(
+            [x for x in self.patterns if is_prefix_safe(x)]
+        )
+
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+
+    def matches(self, path) -> bool:
+        return self._all.search(path)
+
+
+    def matches_below(self, dir_path) -> bool:
+        """
+        True if every path below the given directory is certain to match,
+        so that an excluded directory need not be listed
+        """
+        return self._prefix_safe.search(dir_path)
@@ -0,0 +1,206 @@
+"""
+Called from dx_sync_directory.py to gzip tar files on multiple cores.
+
+In the style of pigz, the data written is cut into fixed size blocks
+which are compressed independently on a thread pool (zlib releases the
+GIL whilst compressing). Each block is written out as a complete gzip
+member, in order, and the concatenated members form a standard gzip
+stream that gunzip, `tar xzf` and Python's gzip module all read.
+
+As every block is independent, the compression level can be changed
+part way through the stream (e.g. to store already compressed files),
+and the bytes written can be tagged to collect compression ratios.
+Where each block starts in both streams is recorded, so that any part
+of the uncompressed stream can later be read by decompressing only the
+blocks covering it (see tar_index.py).
+"""
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Size (in bytes) of each independently compressed block. Larger blocks
+# compress slightly better as each member starts with an empty window
+DEFAULT_BLOCK_SIZE = 2**20
+
+# Amount of each stored block that is test compressed, to record what
+# compressing it would have saved
+PROBE_SIZE = 2**16
+
+
+def compress_block(data, level) -> bytes:
+    """Compress data as a single, complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter():
+    """
+    Write-only file object gzipping everything written to it across
+    a pool of threads and writing the result to another file object.
+
+    Parameters
+    ----------
+    fileobj : file object
+        writable file object to write the gzip stream to
+    threads : int
+        number of threads to compress on
+    level : int
+        gzip compression level
+    block_size : int
+        size (in bytes) of each independently compressed block
+    """
+    # level at which data is stored rather than compressed
+    store_level = 0
+
+    def __init__(
+        self, fileobj, threads, level=9, block_size=DEFAULT_BLOCK_SIZE
+    ) -> None:
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stats = {}
+        # (uncompressed offset, compressed offset) of each block written
+        self.blocks = []
+        self._blocks_in = 0
+
+        self._tag = None
+        self._buffer = bytearray()
+        self._segments = deque()
+        self._pending = deque()
+        # keep enough blocks queued for every thread to stay busy, but
+        # no more, so memory use is bounded
+        self._max_pending = 2 * threads
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._closed = False
+
+
+    def compress(self, data, level) -> bytes:
+        """Compress one block, overridden for other codecs"""
+        return compress_block(data, level)
+
+
+    def writable(self) -> bool:
+        return True
+
+
+    def tell(self) -> int:
+        """Position in the uncompressed stream"""
+        return self.bytes_in
+
+
+    def set_level(self, level, tag=None) -> None:
+        """
+        Compress data written from now on at the given level, tagging
+        it for the compression stats. Ends the current block early if
+        the level changes.
+        """
+        if level != self.level and self._buffer:
+            self._cut_block(len(self._buffer))
+
+        self.level = level
+        self._tag = tag
+
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed %s" % type(self).__name__)
+
+        if not data:
+            return 0
+
+        self._buffer += data
+        self.bytes_in += len(data)
+
+        if self._segments and self._segments[-1][0] == self._tag:
+            self._segments[-1][1] += len(data)
+        else:
+            self._segments.append([self._tag, len(data)])
+
+        while len(self._buffer) >= self.block_size:
+            self._cut_block(self.block_size)
+
+        return len(data)
+
+
+    def close(self) -> None:
+        """Compress any remaining data and write out all blocks"""
+        if self._closed:
+            return
+
+        if self._buffer or self.bytes_in == 0:
+            self._cut_block(len(self._buffer))
+
+        while self._pending:
+            self._write_next()
+
+        self._closed = True
+        self._pool.shutdown(wait=True)
+
+
+    def _cut_block(self, size) -> None:
+        """Submit the first size bytes of the buffer as a block"""
+        block = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        # split off the tags covering this block
+        segments = []
+        remaining = size
+        while remaining and self._segments:
+            tag, length = self._segments[0]
+            if length <= remaining:
+                segments.append((tag, length))
+                self._segments.popleft()
+                remaining -= length
+            else:
+                segments.append((tag, remaining))
+                self._segments[0][1] -= remaining
+                remaining = 0
+
+        if len(self._pending) >= self._max_pending:
+            self._write_next()
+
+        self._pending.append((
+            self._pool.submit(self._compress_block, block, self.level),
+            segments
+        ))
+
+
+    def _compress_block(self, block, level) -> tuple:
+        """Compress a block, test compressing the start of it if stored"""
+        probe_in = probe_out = 0
+        if level == self.store_level and block:
+            probe = block[:PROBE_SIZE]
+            probe_in = len(probe)
+            probe_out = len(zlib.compress(probe, 1))
+
+        return self.compress(block, level), probe_in, probe_out
+
+
+    def _write_next(self) -> None:
+        """Write out the oldest block, waiting for it to be compressed"""
+        future, segments = self._pending.popleft()
+        member, probe_in, probe_out = future.result()
+        block_size = sum(length for _, length in segments)
+
+        self.blocks.append((self._blocks_in, self.bytes_out))
+        self._blocks_in += block_size
+
+        self.fileobj.write(member)
+        self.bytes_out += len(member)
+
+        # share the compressed size between the tags in the block in
+        # proportion to how much of the block each one wrote
+        for tag, length in segments:
+            if tag is None:
+                continue
+            share = length / block_size
+            tag_stats = self.stats.setdefault(tag, {
+                'bytes_in': 0, 'bytes_out': 0, 'probe_in': 0, 'probe_out': 0
+            })
+            tag_stats['bytes_in'] += length
+            tag_stats['bytes_out'] += round(len(member) * share)
+            tag_stats['probe_in'] += round(probe_in * share)
+            tag_stats['probe_out'] += round(probe_out * share)
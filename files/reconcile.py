@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+Checks a local run directory against the manifests uploaded alongside
+its tar files (see manifest.py), without downloading any tar file.
+
+Every file in the run directory is compared on size and mtime (and with
+--check-md5, on md5) against the manifests found in the remote runs
+folder, and every tar file the manifests refer to is checked to be
+closed in the project. Each discrepancy is printed as a tab separated
+line of its kind and the path, and the exit code is 1 if there were any.
+
+Usage:
+
+    python3 reconcile.py --project project-xxxx --folder /<run_id>/runs <run_dir>
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import stat
+import sys
+
+import dxpy
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "."))
+
+from dir_scan import DirScanner
+from manifest import MANIFEST_SUFFIX, read_manifest
+from path_matcher import PathMatcher
+
+# Kinds of discrepancy found
+MISSING = 'missing'             # local file in no manifest
+CHANGED = 'changed'             # size or mtime differ from the manifest
+MD5_MISMATCH = 'md5_mismatch'   # local data differs from the manifest
+REMOTE_ONLY = 'remote_only'     # in a manifest but not found locally
+TAR_MISSING = 'tar_missing'     # tar file holding it not closed in the project
+KINDS = (MISSING, CHANGED, MD5_MISMATCH, REMOTE_ONLY, TAR_MISSING)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check a local run directory against the manifests of '
+        'its uploaded tar files, without downloading them.'
+    )
+    parser.add_argument('--project', '-p', required=True, metavar='<project-id>',
+                        help='Project the run was uploaded to')
+    parser.add_argument('--folder', '-f', required=True, metavar='<folder>',
+                        help='Remote runs folder of the run, searched with its '
+                        'subfolders for manifests (e.g. /<run_id>/runs)')
+    parser.add_argument('--exclude-patterns', '-x', metavar='<regex>', nargs='*',
+                        default=[], help='Local files matching any of these '
+                        'patterns are not expected to have been uploaded')
+    parser.add_argument('--check-md5', action='store_true',
+                        help='Also compare the md5 of each local file with the '
+                        'manifest, reading every file')
+    parser.add_argument('run_dir', metavar='<directory>', help='Local run directory')
+
+    args = parser.parse_args()
+    args.run_dir = os.path.abspath(args.run_dir)
+    return args
+
+
+def find_manifests(project, folder) -> list:
+    """IDs of the closed manifest files in folder and its subfolders"""
+    return [
+        result['id'] for result in dxpy.find_data_objects(
+            classname='file', state='closed', name='*' + MANIFEST_SUFFIX,
+            name_mode='glob', project=project, folder=folder, recurse=True
+        )
+    ]
+
+
+def find_closed_files(project, folder) -> set:
+    """IDs of the closed files in folder and its subfolders"""
+    return set(
+        result['id'] for result in dxpy.find_data_objects(
+            classname='file', state='closed', project=project, folder=folder,
+            recurse=True
+        )
+    )
+
+
+def load_manifests(file_ids, project) -> dict:
+    """Rows of the given manifests keyed on path"""
+    rows = {}
+    for file_id in file_ids:
+        with dxpy.open_dxfile(file_id, project=project, mode='rb') as fh:
+            data = io.BytesIO(fh.read())
+        for row in read_manifest(data):
+            rows[row['path']] = row
+
+    return rows
+
+
+def get_md5(path) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(2**20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def reconcile(run_dir, manifest, closed_files, exclude=None, check_md5=False) -> dict:
+    """
+    Compare the run directory with the manifest rows keyed on path.
+
+    Returns
+    -------
+    dict
+        paths (relative to run_dir) of each kind of discrepancy in KINDS
+    """
+    exclude = exclude or PathMatcher([])
+    found = dict((kind, []) for kind in KINDS)
+    seen = set()
+
+    scanner = DirScanner(run_dir, skip_dir=exclude.matches_below)
+    for _, entries in scanner.walk():
+        for full_path, f_stat in entries:
+            if exclude and exclude.matches(full_path):
+                continue
+            path = scanner.relative_path(full_path)
+            row = manifest.get(path)
+            if row is None:
+                found[MISSING].append(path)
+                continue
+            seen.add(path)
+
+            if row['tar_file_id'] not in closed_files:
+                found[TAR_MISSING].append(path)
+
+            if stat.S_ISDIR(f_stat.st_mode):
+                # a directory's mtime changes as files are added to it
+                continue
+            if row['size'] != f_stat.st_size or row['mtime'] != f_stat.st_mtime:
+                found[CHANGED].append(path)
+            elif check_md5 and row['md5'] and get_md5(full_path) != row['md5']:
+                found[MD5_MISMATCH].append(path)
+
+    found[REMOTE_ONLY] = sorted(set(manifest) - seen)
+
+    return found
+
+
+def main():
+    args = parse_args()
+
+    manifest_ids = find_manifests(args.project, args.folder)
+    if not manifest_ids:
+        sys.exit("ERROR: No manifests found in %s:%s" % (args.project, args.folder))
+
+    manifest = load_manifests(manifest_ids, args.project)
+    closed_files = find_closed_files(args.project, args.folder)
+    print("Read %d manifests listing %d files" % (len(manifest_ids), len(manifest)),
+          file=sys.stderr)
+
+    found = reconcile(args.run_dir, manifest, closed_files,
+                      PathMatcher(args.exclude_patterns), args.check_md5)
+
+    for kind in KINDS:
+        for path in found[kind]:
+            print("%s\t%s" % (kind, path))
+
+    summary = ', '.join('%d %s' % (len(found[kind]), kind) for kind in KINDS if found[kind])
+    if summary:
+        sys.exit("Run directory does not match the upload: %s" % summary)
+
+    print("Run directory matches the upload", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Called from dx_sync_directory.py to share the space in the tar directory
+between every sync on the host writing tar files to it, so that several
+runs uploading at once do not fill the disk and all fail together.
+
+Before a tar file is built its estimated size is reserved in a small
+ledger file kept in the tar directory, locked with fcntl so every thread
+and process using it sees the same reservations. A reservation is only
+granted if the free space on the disk, less the part of every other
+reservation not yet written, covers it (and if a budget is set, if the
+reservations together stay within it). When less is available the tar
+file is built smaller, from as many of its files as fit, and when not
+even that much is available the builder waits for other tar files to be
+uploaded and removed, which releases their reservations.
+
+Reservations held by processes which have exited are dropped, as the
+tar files they left behind are already counted in the free space.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import time
+
+
+LEDGER_FILE = 'dx_streaming_upload.space'
+
+# Bytes always left free on the disk, for logs and tar indexes
+HEADROOM = 64 * 2**20
+
+# Seconds between checks for space whilst waiting for a reservation
+POLL_SECONDS = 10
+
+
+def is_running(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+def get_written(paths) -> int:
+    """Bytes written so far to the largest of the given files"""
+    written = 0
+    for path in paths:
+        try:
+            written = max(written, os.path.getsize(path))
+        except OSError:
+            continue
+    return written
+
+
+class SpaceLedger():
+    """
+    Reservations of space in a directory, shared through a ledger file
+    by everything using the same path.
+
+    Parameters
+    ----------
+    path : str
+        ledger file, created if needed, in the directory space is
+        reserved in
+    budget : int
+        optional most bytes that may be reserved at once
+    clock : callable
+        returns the current time, time.time by default
+    sleep : callable
+        waits a number of seconds, time.sleep by default
+    disk_free : callable
+        returns the free bytes on the ledger's disk, by default from
+        shutil.disk_usage
+    """
+    def __init__(self, path, budget=None, clock=time.time, sleep=time.sleep,
+                 disk_free=None) -> None:
+        self.path = path
+        self.budget = budget
+        self.clock = clock
+        self.sleep = sleep
+        self.disk_free = disk_free or (
+            lambda: shutil.disk_usage(os.path.dirname(path)).free
+        )
+
+
+    def reserve(self, key, size, min_size, paths=(), timeout=3600, stop=None) -> int:
+        """
+        Reserve up to size bytes under key, replacing any reservation
+        already held under it, waiting until at least min_size bytes
+        are available. paths are the files the space is taken up by as
+        they are written. Returns the bytes reserved, or 0 if stop (a
+        threading.Event) is set before they are. Raises TimeoutError if
+        min_size bytes are not available within timeout seconds.
+        """
+        min_size = min(min_size, size)
+        give_up = self.clock() + timeout
+
+        while True:
+            if stop is not None and stop.is_set():
+                return 0
+            with self._locked() as (fd, reservations):
+                reservations.pop(key, None)
+                granted = min(size, self._get_available(reservations))
+                if granted >= min_size:
+                    reservations[key] = {'size': granted, 'pid': os.getpid(),
+                                         'paths': list(paths)}
+                    self._write(fd, reservations)
+                    return granted
+
+            if self.clock() >= give_up:
+                raise TimeoutError(
+                    "%d bytes not available in %s after %d seconds" %
+                    (min_size, os.path.dirname(self.path), timeout)
+                )
+            self.sleep(POLL_SECONDS)
+
+
+    def release(self, key) -> None:
+        """Release the reservation held under key, if any"""
+        with self._locked() as (fd, reservations):
+            if reservations.pop(key, None) is not None:
+                self._write(fd, reservations)
+
+
+    def get_reserved(self) -> dict:
+        """Bytes reserved under each key"""
+        with self._locked() as (_, reservations):
+            return dict((key, entry['size']) for key, entry in reservations.items())
+
+
+    def _get_available(self, reservations) -> int:
+        unwritten = 0
+        reserved = 0
+        for entry in reservations.values():
+            written = get_written(entry['paths'])
+            unwritten += max(0, entry['size'] - written)
+            reserved += max(entry['size'], written)
+
+        available = self.disk_free() - unwritten - HEADROOM
+        if self.budget is not None:
+            available = min(available, self.budget - reserved)
+        return max(0, available)
+
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the ledger file locked, yielding it and its reservations
+        held by running processes"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(fd, os.fstat(fd).st_size, 0)
+                reservations = json.loads(data)['reservations']
+            except (ValueError, KeyError, TypeError):
+                # new or unreadable ledger
+                reservations = {}
+
+            yield fd, dict(
+                (key, entry) for key, entry in reservations.items()
+                if is_running(entry['pid'])
+            )
+        finally:
+            os.close(fd)
+
+
+    def _write(self, fd, reservations) -> None:
+        data = json.dumps({'reservations': reservations}).encode()
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, data, 0)
@@ -0,0 +1,480 @@
+"""
+Called from dx_sync_directory.py to store the sync log in SQLite.
+
+The sync log used to be a single JSON file, rewritten and re-parsed in
+full after every tar, upload and remove. As the files map has an entry
+for every file in the run (hundreds of thousands on a NovaSeq X), this
+did O(files) work per step. Here the log lives in a SQLite database:
+
+    - meta: the top level keys of the log (sync_dir, file_prefix...)
+    - tar_files: one row per tar file, holding its JSON entry
+    - dirs: each directory path relative to sync_dir, stored once,
+      with its mtime and whether it was settled at the last scan
+    - files: one row per file keyed on (dir, name), so each path is
+      stored relative to sync_dir with its directory interned, with
+      the md5 of the file, where it is in which tar file and how many
+      times it has been synced again after changing
+    - observed: the size and mtime of each file too recently modified
+      to sync when last seen, and how many invocations in a row have
+      seen it unchanged (see --stable-scans)
+
+Each update commits just what changed in one transaction, so the log is
+always consistent, and the log can be exported to the original JSON
+format (e.g. for uploading alongside the tar files).
+"""
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tar_files (
+    name TEXT PRIMARY KEY,
+    entry TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime REAL,
+    settled INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    dir_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    tar_index INTEGER,
+    offset INTEGER,
+    changes INTEGER,
+    PRIMARY KEY (dir_id, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS observed (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    scans INTEGER NOT NULL,
+    closed INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+
+# Keys of a file's log entry other than mtime, stored in the columns of
+# the same name and left out of the entry when not set
+FILE_KEYS = ('size', 'md5', 'tar_index', 'offset', 'changes')
+
+# Keys of the log held in their own tables rather than in meta
+TABLE_KEYS = ('tar_files', 'files')
+
+# Number of directories whose file entries are held in memory. Files
+# are looked up a directory at a time as the sync dir is walked, so
+# reading whole directories saves a query per file
+DIR_CACHE_SIZE = 64
+
+# Number of directories read at once, by id. Directories are interned
+# in the order they are first scanned or synced, which the next scan
+# mostly walks them in, so this saves a query per directory
+DIR_BATCH_SIZE = 32
+
+
+class SyncState():
+    """
+    SQLite database holding the sync log of one directory.
+
+    Parameters
+    ----------
+    db_path : str
+        path of the database file, created if it does not exist
+    sync_dir : str
+        absolute path of the directory being synced, which file paths
+        are stored relative to
+    """
+    def __init__(self, db_path, sync_dir) -> None:
+        self.db_path = db_path
+        self.sync_dir = sync_dir.rstrip(os.sep)
+        self._prefix_len = len(self.sync_dir) + 1
+
+        # the connection may be used from the tar building thread as
+        # well as the main thread, callers serialise access
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        self._dir_ids = self._load_dir_ids()
+        self._dir_cache = OrderedDict()
+        self._meta = {}
+        self._tar_files = {}
+        self._last_observed = None
+        self._observed = {}
+
+
+    def is_empty(self) -> bool:
+        """True if no log has been stored yet"""
+        return self.conn.execute("SELECT 1 FROM meta LIMIT 1").fetchone() is None
+
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+    def load(self) -> dict:
+        """
+        Load the log, in the same shape as the JSON log except that
+        'files' is a FileIndex which reads from the database on demand.
+        """
+        log = dict(
+            (key, json.loads(value)) for key, value in
+            self.conn.execute("SELECT key, value FROM meta")
+        )
+        log['tar_files'] = dict(
+            (name, json.loads(entry)) for name, entry in
+            self.conn.execute("SELECT name, entry FROM tar_files ORDER BY rowid")
+        )
+        log['files'] = FileIndex(self)
+
+        # remember what was loaded, so commit only writes changed entries
+        self._meta = dict(
+            self.conn.execute("SELECT key, value FROM meta")
+        )
+        self._tar_files = dict(
+            (name, json.dumps(entry)) for name, entry in log['tar_files'].items()
+        )
+
+        return log
+
+
+    def commit(self, log) -> None:
+        """
+        Write everything changed in the log since it was loaded or last
+        committed, in a single transaction.
+        """
+        files = log['files']
+
+        try:
+            self._commit(log, files)
+        except sqlite3.Error:
+            # directories interned and entries cached as written in the
+            # rolled back transaction
+            self._dir_ids = self._load_dir_ids()
+            self._meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+            self._tar_files = dict(self.conn.execute("SELECT name, entry FROM tar_files"))
+            raise
+
+        if isinstance(files, FileIndex):
+            files.clear_pending()
+
+
+    def _commit(self, log, files) -> None:
+        with self.conn:
+            changed_meta = []
+            for key, value in log.items():
+                if key in TABLE_KEYS:
+                    continue
+                value = json.dumps(value)
+                if self._meta.get(key) != value:
+                    changed_meta.append((key, value))
+                    self._meta[key] = value
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                changed_meta
+            )
+
+            changed_tars = []
+            for name, entry in log['tar_files'].items():
+                entry = json.dumps(entry)
+                if self._tar_files.get(name) != entry:
+                    changed_tars.append((name, entry))
+                    self._tar_files[name] = entry
+            self.conn.executemany(
+                "INSERT INTO tar_files (name, entry) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET entry = excluded.entry",
+                changed_tars
+            )
+
+            if isinstance(files, FileIndex):
+                pending = files.pending
+            else:
+                # a plain dict, as when importing a JSON log
+                pending = files
+            rows = [self._key(path) + (entry['mtime'],) +
+                    tuple(entry.get(key) for key in FILE_KEYS)
+                    for path, entry in pending.items()]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (dir_id, name, mtime, %s) "
+                "VALUES (?, ?, ?, %s)" % (
+                    ', '.join(FILE_KEYS), ', '.join('?' for _ in FILE_KEYS)
+                ), rows
+            )
+
+        for row in rows:
+            if row[0] in self._dir_cache:
+                self._dir_cache[row[0]][row[1]] = make_entry(row[2:])
+
+
+    def import_log(self, log) -> None:
+        """Store a log read from a JSON log file"""
+        self.commit(log)
+
+
+    def export_log(self) -> dict:
+        """The log in its original JSON form, with absolute file paths"""
+        log = self.load()
+        log['files'] = dict(log['files'].items())
+        return log
+
+
+    def relative_path(self, full_path) -> str:
+        return full_path[self._prefix_len:]
+
+
+    def _load_dir_ids(self) -> dict:
+        return dict(
+            (path, dir_id) for dir_id, path in
+            self.conn.execute("SELECT id, path FROM dirs")
+        )
+
+
+    def _dir_entries(self, dir_id) -> dict:
+        """Log entry of each file in a directory, keyed on name"""
+        entries = self._dir_cache.get(dir_id)
+        if entries is not None:
+            self._dir_cache.move_to_end(dir_id)
+            return entries
+
+        batch = dict((batch_id, {}) for batch_id in range(dir_id, dir_id + DIR_BATCH_SIZE))
+        for row in self.conn.execute(
+            "SELECT dir_id, name, mtime, %s FROM files WHERE dir_id BETWEEN ? AND ?" %
+            ', '.join(FILE_KEYS), (dir_id, dir_id + DIR_BATCH_SIZE - 1)
+        ):
+            batch[row[0]][row[1]] = make_entry(row[2:])
+        for batch_id, batch_entries in batch.items():
+            if batch_id not in self._dir_cache:
+                self._dir_cache[batch_id] = batch_entries
+        while len(self._dir_cache) > DIR_CACHE_SIZE:
+            self._dir_cache.popitem(last=False)
+
+        return batch[dir_id]
+
+
+    def _key(self, full_path, create=True) -> tuple:
+        """
+        Split an absolute path into its (dir_id, name) key, interning
+        the directory. Returns None for the dir_id of an unknown
+        directory if create is False.
+        """
+        dir_path, _, name = self.relative_path(full_path).rpartition(os.sep)
+
+        dir_id = self._dir_ids.get(dir_path)
+        if dir_id is None and create:
+            dir_id = self.conn.execute(
+                "INSERT INTO dirs (path) VALUES (?)", (dir_path,)
+            ).lastrowid
+            self._dir_ids[dir_path] = dir_id
+
+        return dir_id, name
+
+
+    def get_file(self, full_path) -> dict:
+        """Log entry of the given file, or None if not synced"""
+        dir_id, name = self._key(full_path, create=False)
+        if dir_id is None:
+            return None
+
+        return self._dir_entries(dir_id).get(name)
+
+
+    def get_dir_files(self, dir_path) -> dict:
+        """
+        Log entry of each synced file in the directory at the given
+        absolute path, keyed on name. The entries are shared with later
+        lookups, so must not be modified.
+        """
+        dir_id = self._dir_ids.get(self.relative_path(dir_path))
+        if dir_id is None:
+            return {}
+
+        return self._dir_entries(dir_id)
+
+
+    def iter_files(self):
+        """Yield (absolute path, entry) for every synced file"""
+        rows = self.conn.execute(
+            "SELECT dirs.path, files.name, files.mtime, %s "
+            "FROM files JOIN dirs ON files.dir_id = dirs.id" %
+            ', '.join('files.' + key for key in FILE_KEYS)
+        )
+        for row in rows:
+            yield os.path.join(self.sync_dir, row[0], row[1]), make_entry(row[2:])
+
+
+    def get_dir_scans(self) -> dict:
+        """(mtime, settled) of each directory at the last scan"""
+        return dict(
+            (path, (mtime, bool(settled))) for path, mtime, settled in
+            self.conn.execute(
+                "SELECT path, mtime, settled FROM dirs WHERE mtime IS NOT NULL"
+            )
+        )
+
+
+    def record_dir_scans(self, scanned) -> None:
+        """
+        Store the (mtime, settled) of each directory scanned, keyed on
+        path relative to sync_dir
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO dirs (path, mtime, settled) VALUES (?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, "
+                "settled = excluded.settled",
+                [(path, mtime, int(settled))
+                 for path, (mtime, settled) in scanned.items()]
+            )
+        self._dir_ids = self._load_dir_ids()
+
+
+    def observe(self, full_path, size, mtime, closed=False) -> tuple:
+        """
+        Record seeing a file with the given size and mtime, and whether
+        it was seen closed with that mtime. Returns (scans, closed): the
+        number of invocations in a row, this one included, which have
+        seen the file unchanged, and whether it has been seen closed
+        since it last changed.
+        """
+        if self._last_observed is None:
+            self._last_observed = dict(
+                (row[0], row[1:]) for row in
+                self.conn.execute("SELECT path, size, mtime, scans, closed FROM observed")
+            )
+
+        rel_path = self.relative_path(full_path)
+        last = self._observed.get(rel_path)
+        if last is None:
+            # not seen yet by this invocation
+            last = self._last_observed.get(rel_path)
+            if last is not None:
+                last = last[:2] + (last[2] + 1, last[3])
+
+        if last is not None and last[:2] == (size, mtime):
+            scans, closed = last[2], bool(last[3]) or closed
+        else:
+            scans = 1
+
+        self._observed[rel_path] = (size, mtime, scans, int(closed))
+        return scans, closed
+
+
+    def save_observations(self) -> None:
+        """
+        Store the files observed by this invocation in place of those
+        observed by the last, so files synced or gone are forgotten
+        """
+        if self._last_observed is None:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM observed")
+            self.conn.executemany(
+                "INSERT INTO observed (path, size, mtime, scans, closed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(path,) + row for path, row in self._observed.items()]
+            )
+        # the next scan, by this process or another, counts from these
+        self._last_observed = self._observed
+        self._observed = {}
+
+
+    def count_files(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+def make_entry(row) -> dict:
+    """Log entry of a file from its (mtime, *FILE_KEYS) columns"""
+    entry = {'mtime': row[0]}
+    for key, value in zip(FILE_KEYS, row[1:]):
+        if value is not None:
+            entry[key] = value
+    return entry
+
+
+class FileIndex():
+    """
+    The 'files' map of the log, keyed on absolute path as in the JSON
+    log. Reads come from the database, writes are held until the next
+    SyncState.commit. Files are never removed from the log, so only
+    the lookups, writes and iteration of a dict are provided.
+    """
+    def __init__(self, state) -> None:
+        self.state = state
+        self.pending = {}
+
+        # entries of the directory last looked in, as files are looked
+        # up a directory at a time as the sync dir is walked
+        self._dir_path = None
+        self._dir_files = None
+
+
+    def __getitem__(self, full_path) -> dict:
+        entry = self._lookup(full_path)
+        if entry is None:
+            raise KeyError(full_path)
+        return entry
+
+
+    def get(self, full_path, default=None) -> dict:
+        entry = self._lookup(full_path)
+        if entry is None:
+            return default
+        return entry
+
+
+    def __contains__(self, full_path) -> bool:
+        return self._lookup(full_path) is not None
+
+
+    def __setitem__(self, full_path, entry) -> None:
+        self.pending[full_path] = entry
+
+
+    def __iter__(self):
+        for full_path, _ in self.items():
+            yield full_path
+
+
+    def items(self):
+        seen = set()
+        for full_path, entry in self.pending.items():
+            seen.add(full_path)
+            yield full_path, entry
+        for full_path, entry in self.state.iter_files():
+            if full_path not in seen:
+                yield full_path, entry
+
+
+    def __len__(self) -> int:
+        return self.state.count_files() + sum(
+            1 for full_path in self.pending
+            if self.state.get_file(full_path) is None
+        )
+
+
+    def clear_pending(self) -> None:
+        """Drop the writes held, once SyncState.commit has written them"""
+        self.pending.clear()
+        self._dir_path = None
+
+
+    def _lookup(self, full_path) -> dict:
+        entry = self.pending.get(full_path)
+        if entry is not None:
+            return entry
+
+        dir_path, _, name = full_path.rpartition(os.sep)
+        if dir_path != self._dir_path:
+            self._dir_files = self.state.get_dir_files(dir_path)
+            self._dir_path = dir_path
+        return self._dir_files.get(name)
@@ -0,0 +1,235 @@
+"""
+Called from dx_sync_directory.py to choose how tar files are compressed.
+
+A codec (gzip, zstd or none) is selected per run, and a policy table
+keyed on file path patterns decides, per file, whether its contents are
+compressed or stored as is. Most of the bytes in a run directory are
+CBCL / BCL files which are already compressed, so storing them saves
+the CPU time spent squeezing out ~1% whilst XML, InterOp and log files
+are still compressed.
+"""
+import json
+import re
+import zlib
+
+from pgzip import ParallelGzipWriter, DEFAULT_BLOCK_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODECS = ('gzip', 'zstd', 'none')
+
+EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+    'none': '.tar'
+}
+
+DEFAULT_LEVELS = {
+    'gzip': 9,
+    'zstd': 3
+}
+
+STORE = 'store'
+COMPRESS = 'compress'
+
+# Default policy, the first pattern matching the full path of a file
+# decides what happens to it, files matching none are compressed
+DEFAULT_POLICY = [
+    [r'\.cbcl$', STORE],
+    [r'\.bcl\.gz$', STORE],
+    [r'\.bcl\.bgzf$', STORE],
+    [r'\.(gz|bgzf|zst|bz2|zip)$', STORE],
+    [r'\.(jpe?g|png)$', STORE],
+    [r'\.xml$', COMPRESS],
+    [r'/InterOp/', COMPRESS],
+    [r'\.(log|txt|csv|tsv|json)$', COMPRESS]
+]
+
+# Tag used in the compression stats for files matching no pattern
+UNMATCHED = '*'
+
+
+class ParallelZstdWriter(ParallelGzipWriter):
+    """
+    ParallelGzipWriter writing independent zstd frames, which form a
+    standard zstd stream when concatenated.
+    """
+    # negative levels trade ratio for speed, this one is close to I/O
+    # bound for data that will not compress anyway
+    store_level = -5
+
+    def compress(self, data, level) -> bytes:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class CompressionPolicy():
+    """
+    Table of (regex pattern, action) pairs deciding whether each file
+    added to a tar is compressed or stored.
+
+    Parameters
+    ----------
+    rules : list
+        list of [pattern, action] pairs, action is 'store' or 'compress'
+    """
+    def __init__(self, rules=None) -> None:
+        if rules is None:
+            rules = DEFAULT_POLICY
+
+        self.rules = []
+        for pattern, action in rules:
+            if action not in (STORE, COMPRESS):
+                raise ValueError(
+                    f"Invalid action '{action}' for pattern '{pattern}' in "
+                    f"compression policy, expected '{STORE}' or '{COMPRESS}'"
+                )
+            self.rules.append((pattern, re.compile(pattern), action))
+
+
+    @classmethod
+    def load(cls, policy_file) -> 'CompressionPolicy':
+        """Read a policy from a JSON file of [pattern, action] pairs"""
+        with open(policy_file) as fh:
+            return cls(json.load(fh))
+
+
+    def classify(self, full_path) -> tuple:
+        """
+        Find the rule for the given file
+
+        Returns
+        -------
+        str
+            pattern matched, used to tag the compression stats
+        str
+            action to take, 'store' or 'compress'
+        """
+        for pattern, regex, action in self.rules:
+            if regex.search(full_path):
+                return pattern, action
+
+        return UNMATCHED, COMPRESS
+
+
+class TarCompressor():
+    """
+    Compresses a tar stream with the chosen codec, switching between
+    compressing and storing as each file is added according to policy.
+
+    Parameters
+    ----------
+    fileobj : file object
+        writable file object to write the compressed stream to
+    codec : str
+        one of CODECS
+    level : int
+        compression level for files to be compressed
+    threads : int
+        number of threads to compress on
+    policy : CompressionPolicy
+        policy deciding which files are stored
+    """
+    def __init__(self, fileobj, codec, level, threads, policy) -> None:
+        self.codec = codec
+        self.level = level
+        self.policy = policy
+
+        if codec == 'none':
+            # the tar stream is written as is
+            self.writer = None
+            self.fileobj = fileobj
+        else:
+            if codec == 'zstd':
+                check_codec_available(codec)
+                writer_class = ParallelZstdWriter
+            else:
+                writer_class = ParallelGzipWriter
+
+            self.writer = writer_class(
+                fileobj, threads=threads, level=level,
+                block_size=DEFAULT_BLOCK_SIZE
+            )
+            self.fileobj = self.writer
+
+
+    def start_file(self, full_path) -> None:
+        """Called before each file is added to the tar stream"""
+        if not self.writer:
+            return
+
+        pattern, action = self.policy.classify(full_path)
+        if action == STORE:
+            self.writer.set_level(self.writer.store_level, tag=pattern)
+        else:
+            self.writer.set_level(self.level, tag=pattern)
+
+
+    def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+
+
+    @property
+    def stats(self) -> dict:
+        """Bytes in and out of the compressor per policy pattern"""
+        if not self.writer:
+            return {}
+        return self.writer.stats
+
+
+def check_codec_available(codec) -> None:
+    """Raise an error if the module needed for a codec is missing"""
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError(
+            "The zstd codec requires the zstandard Python package, install "
+            "it with `pip install zstandard`"
+        )
+
+
+def decompress_block(data, codec) -> bytes:
+    """
+    Decompress one independently compressed block of a tar file written
+    with the given codec (a gzip member or zstd frame)
+    """
+    if codec == 'none':
+        return data
+    if codec == 'zstd':
+        check_codec_available(codec)
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompress(data, 31)
+
+
+def merge_stats(total, stats) -> dict:
+    """Add the compression stats of one tar file to a running total"""
+    for tag, tag_stats in stats.items():
+        total_stats = total.setdefault(tag, {})
+        for key, value in tag_stats.items():
+            total_stats[key] = total_stats.get(key, 0) + value
+
+    return total
+
+
+def format_stats(stats) -> str:
+    """
+    Format compression stats as a table, giving for each pattern the
+    ratio achieved and, for stored data, the ratio a fast compress of a
+    sample of it would have achieved
+    """
+    lines = [f"{'pattern':<30}{'MB in':>10}{'ratio':>8}{'probe':>8}"]
+    for tag, tag_stats in sorted(stats.items()):
+        bytes_in = tag_stats.get('bytes_in', 0)
+        if not bytes_in:
+            continue
+        ratio = tag_stats.get('bytes_out', 0) / bytes_in
+        probe = '-'
+        if tag_stats.get('probe_in'):
+            probe = f"{tag_stats['probe_out'] / tag_stats['probe_in']:.3f}"
+        lines.append(
+            f"{tag:<30}{bytes_in / 2**20:>10.1f}{ratio:>8.3f}{probe:>8}"
+        )
+
+    return '\n'.join(lines)
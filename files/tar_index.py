@@ -0,0 +1,217 @@
+"""
+Called from dx_sync_directory.py to write an index of each tar file as
+it is built, and by anything needing a few files from an uploaded tar
+file, to read them without downloading the whole tar file.
+
+The index records where each member's header and data start in the
+uncompressed tar stream. For a compressed tar file it also records
+where each block starts in both the uncompressed and compressed stream;
+as each block is compressed independently (see pgzip.py), a member is
+read by fetching only the compressed bytes of the blocks covering its
+data, with a ranged read, and decompressing them alone.
+
+The index is gzipped JSON, uploaded next to the tar file it describes
+as <tar file name>.index.json.gz:
+
+    {
+        "version": 1,
+        "codec": "gzip",
+        "compressed_size": <size of a compressed tar file>,
+        "blocks": [[<uncompressed offset>, <compressed offset>], ...],
+        "members": [[<name>, <header offset>, <data offset>, <size>], ...]
+    }
+
+The data offset is null for members without data (directories, links).
+
+Usage:
+
+    index = fetch_index(index_file_id)
+    data = fetch_member(tar_file_id, index, 'Data/Intensities/s.locs')
+"""
+import bisect
+import gzip
+import io
+import json
+import os
+
+from lazy_import import lazy_import
+from tar_codecs import decompress_block
+
+dxpy = lazy_import('dxpy')
+
+
+INDEX_SUFFIX = '.index.json.gz'
+
+VERSION = 1
+
+
+def get_index_path(tar_path) -> str:
+    """Path of the index written next to the given tar file"""
+    return tar_path + INDEX_SUFFIX
+
+
+class TarIndex():
+    """
+    Offsets of the members of one tar file, and of its blocks if it is
+    compressed.
+
+    Parameters
+    ----------
+    codec : str
+        codec the tar file is compressed with, one of tar_codecs.CODECS
+    members : list
+        [name, header offset, data offset, size] of each member
+    blocks : list
+        [uncompressed offset, compressed offset] of each block
+    compressed_size : int
+        size of a compressed tar file, where the last block ends
+    """
+    def __init__(self, codec, members=None, blocks=None, compressed_size=None) -> None:
+        self.codec = codec
+        self.members = members or []
+        self.blocks = blocks or []
+        self.compressed_size = compressed_size
+        self._by_name = None
+
+
+    def add(self, name, header_offset, data_offset=None, size=0) -> None:
+        """Record a member added to the tar file"""
+        self.members.append([name, header_offset, data_offset, size])
+        self._by_name = None
+
+
+    def finish(self, writer) -> None:
+        """
+        Record the blocks of the finished tar file from the writer that
+        compressed it, None if it is uncompressed
+        """
+        if writer is not None:
+            self.blocks = [list(block) for block in writer.blocks]
+            self.compressed_size = writer.bytes_out
+
+
+    def write(self, path) -> None:
+        """
+        Write the index to path. The index is written to a temporary
+        file which then replaces any existing one.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+
+    def to_bytes(self) -> bytes:
+        """The index as written to a file, gzipped JSON"""
+        return gzip.compress(json.dumps({
+            'version': VERSION,
+            'codec': self.codec,
+            'compressed_size': self.compressed_size,
+            'blocks': self.blocks,
+            'members': self.members
+        }, separators=(',', ':')).encode())
+
+
+    @classmethod
+    def read(cls, fileobj) -> 'TarIndex':
+        """Read an index from a binary file object"""
+        with gzip.open(fileobj, 'rt') as fh:
+            index = json.load(fh)
+        if index.get('version') != VERSION:
+            raise ValueError("unsupported tar index version %s" % index.get('version'))
+        return cls(index['codec'], index['members'], index['blocks'],
+                   index['compressed_size'])
+
+
+    def get_member(self, name) -> list:
+        """[name, header offset, data offset, size] of a member, raises KeyError if absent"""
+        if self._by_name is None:
+            self._by_name = dict((member[0], member) for member in self.members)
+        return self._by_name[name]
+
+
+    def get_range(self, name) -> tuple:
+        """
+        Compressed bytes to read for the data of a member
+
+        Returns
+        -------
+        int, int
+            start and end (exclusive) in the tar file of the bytes to read
+        list
+            offsets of the blocks read, relative to start, for
+            decompressing them one at a time
+        int
+            offset of the member's data in the decompressed bytes
+        """
+        _, _, data_offset, size = self.get_member(name)
+        if data_offset is None:
+            raise ValueError("%s has no data in the tar file" % name)
+
+        if not self.blocks:
+            # uncompressed, read the data as is
+            return data_offset, data_offset + size, [0], 0
+
+        starts = [block[0] for block in self.blocks]
+        first = bisect.bisect_right(starts, data_offset) - 1
+        last = max(bisect.bisect_left(starts, data_offset + size) - 1, first)
+
+        start = self.blocks[first][1]
+        if last + 1 < len(self.blocks):
+            end = self.blocks[last + 1][1]
+        else:
+            end = self.compressed_size
+        offsets = [block[1] - start for block in self.blocks[first:last + 1]]
+
+        return start, end, offsets, data_offset - self.blocks[first][0]
+
+
+def read_member(index, name, read_range) -> bytes:
+    """
+    Read the data of one member of a tar file
+
+    Parameters
+    ----------
+    index : TarIndex
+        index of the tar file
+    name : str
+        name of the member, its path relative to the synced directory
+    read_range : callable
+        called with a start and end (exclusive) offset, returns those
+        bytes of the tar file
+    """
+    _, _, _, size = index.get_member(name)
+    if size == 0:
+        return b''
+
+    start, end, offsets, skip = index.get_range(name)
+    data = read_range(start, end)
+
+    blocks = []
+    for i, offset in enumerate(offsets):
+        block_end = offsets[i + 1] if i + 1 < len(offsets) else len(data)
+        blocks.append(decompress_block(data[offset:block_end], index.codec))
+
+    return b''.join(blocks)[skip:skip + size]
+
+
+def dx_range_reader(file_id, project=None):
+    """read_range for read_member reading a closed platform file"""
+    dx_file = dxpy.DXFile(file_id, project=project)
+
+    def read_range(start, end):
+        dx_file.seek(start)
+        return dx_file.read(end - start)
+
+    return read_range
+
+
+def fetch_index(index_file_id, project=None) -> TarIndex:
+    """Download and read the index of an uploaded tar file"""
+    with dxpy.open_dxfile(index_file_id, project=project, mode='rb') as fh:
+        return TarIndex.read(io.BytesIO(fh.read()))
+
+
+def fetch_member(tar_file_id, index, name, project=None) -> bytes:
+    """Read the data of one member of an uploaded tar file"""
+    return read_member(index, name, dx_range_reader(tar_file_id, project))
@@ -0,0 +1,137 @@
+"""
+Called from dx_sync_directory.py to decide which files go in which tar
+file.
+
+'sequential' packing fills each tar file in scan order until the next
+file would take it over the maximum size, leaving a long tail of small,
+uneven tar files and often a tiny final one.
+
+'balanced' packing keeps the files of each directory (e.g. a lane /
+cycle directory) together and spreads the directories across as few
+tar files as will hold them, largest first onto the emptiest tar file,
+so that the tar files come out near equal in size. Part way through a
+run, a remainder too small to fill a tar file of min_tar_size is held
+back to be sent with the next files found rather than being sent on
+its own.
+"""
+import math
+import os
+
+
+PACKING = ('balanced', 'sequential')
+
+
+def pack_sequential(files, max_size) -> list:
+    """
+    Split files, a list of (path, size, is_dir) in scan order, into
+    lists of paths no larger than max_size in order
+    """
+    tars = [[]]
+    tar_size = 0
+    for path, size, _ in files:
+        if tar_size + size > max_size and tars[-1]:
+            tars.append([])
+            tar_size = 0
+        tars[-1].append(path)
+        tar_size += size
+
+    return tars
+
+
+def group_by_dir(files, max_size) -> list:
+    """
+    Group files by the directory they are in, with each directory itself
+    leading its own group. Groups larger than max_size are cut into
+    pieces. Returns a list of (size, first index, paths) in scan order.
+    """
+    groups = {}
+    for index, (path, size, is_dir) in enumerate(files):
+        key = path if is_dir else os.path.dirname(path)
+        group = groups.setdefault(key, [0, index, []])
+        group[0] += size
+        group[2].append((path, size))
+
+    pieces = []
+    for size, index, members in groups.values():
+        if size <= max_size:
+            pieces.append((size, index, [path for path, _ in members]))
+            continue
+
+        # cut into the fewest near equal pieces which each fit
+        n_pieces = math.ceil(size / max_size)
+        sizes = dict(members)
+        for piece in pack_sequential(
+            [(path, size, False) for path, size in members],
+            max(size / n_pieces, max(sizes.values()))
+        ):
+            pieces.append((sum(sizes[path] for path in piece), index, piece))
+            index += 1e-6
+
+    return pieces
+
+
+def fill_bins(pieces, n_bins, max_size) -> tuple:
+    """
+    Place pieces, largest first, on whichever of n_bins holds least,
+    skipping any that would take it over max_size. Returns the bins
+    as [size, pieces] and the pieces left over.
+    """
+    bins = [[0, []] for _ in range(n_bins)]
+    left_over = []
+    for piece in sorted(pieces, key=lambda x: (-x[0], x[1])):
+        emptiest = min(bins, key=lambda x: x[0])
+        if emptiest[0] + piece[0] > max_size and emptiest[1]:
+            left_over.append(piece)
+            continue
+        emptiest[0] += piece[0]
+        emptiest[1].append(piece)
+
+    return bins, left_over
+
+
+def pack_balanced(files, max_size, min_size, finishing) -> tuple:
+    """
+    Pack files, a list of (path, size, is_dir) in scan order, into near
+    equal tar files of at most max_size, keeping each directory's files
+    together where they fit.
+
+    Returns
+    -------
+    list
+        lists of paths for each tar file, in scan order
+    list
+        paths held back until the next invocation
+    """
+    pieces = group_by_dir(files, max_size)
+    total = sum(size for size, _, _ in pieces)
+    if not pieces:
+        return [], []
+
+    n_full = int(total // max_size)
+    remainder = total - n_full * max_size
+
+    held_back = []
+    if not finishing and n_full and remainder < min_size:
+        # fill as many tar files as the files found fill, the rest will
+        # go with the next files found
+        bins, left_over = fill_bins(pieces, n_full, max_size)
+        held_back = [path for piece in left_over for path in piece[2]]
+    else:
+        # spread across as few tar files as will hold everything
+        n_bins = max(1, math.ceil(total / max_size))
+        while True:
+            bins, left_over = fill_bins(pieces, n_bins, max_size)
+            if not left_over:
+                break
+            n_bins += 1
+
+    # keep scan order within and across tar files
+    tars = []
+    for _, bin_pieces in bins:
+        if not bin_pieces:
+            continue
+        bin_pieces.sort(key=lambda x: x[1])
+        tars.append((bin_pieces[0][1], [path for piece in bin_pieces for path in piece[2]]))
+    tars.sort(key=lambda x: x[0])
+
+    return [paths for _, paths in tars], held_back
@@ -0,0 +1,164 @@
+"""
+Called from dx_sync_directory.py to adjust how many parts are uploaded
+at once, and the size of the parts tar files are cut into, as uploads
+run (--adaptive-upload), rather than fixing both for every site.
+
+Adjustments follow AIMD (additive increase, multiplicative decrease),
+as TCP does for its congestion window. Completed parts are measured in
+windows of as many parts as there are threads uploading:
+
+  - a part throttled (HTTP 429), hitting a server error (5xx) or
+    failing to connect halves the threads and the part size straight
+    away, at most once a window
+  - a window slower than the one before by more than DROP, just after
+    an increase, takes the increase back: the link is already full
+  - any other window adds a thread, or once at the most threads
+    allowed, a step to the part size
+
+Each decision is printed to stderr with the throughput that led to it.
+The part size only applies to tar files built after it changes, as the
+parts of a tar file are hashed as it is written.
+"""
+import sys
+import threading
+import time
+
+
+# Fall in throughput after an increase taken to mean the link is full
+DROP = 0.1
+
+# HTTP statuses taken to mean the platform or link is overloaded
+CONGESTION_STATUSES = (429, 500, 502, 503, 504)
+
+
+class UploadController():
+    """
+    Parameters
+    ----------
+    threads : int
+        number of parts to upload at once to start with
+    part_size : int
+        part size (in bytes) to start with
+    min_threads, max_threads : int
+        bounds of the number of parts uploaded at once
+    min_part_size, max_part_size : int
+        bounds of the part size, which is stepped by min_part_size
+    clock : callable
+        returns the current time, time.time by default
+    """
+    def __init__(
+        self, threads, part_size, max_threads, max_part_size, min_part_size,
+        min_threads=1, clock=time.time
+    ) -> None:
+        self.min_threads = min_threads
+        self.max_threads = max(max_threads, min_threads)
+        self.min_part_size = min_part_size
+        self.max_part_size = max(max_part_size, min_part_size)
+        self.threads = min(max(threads, self.min_threads), self.max_threads)
+        self.part_size = min(max(part_size, self.min_part_size), self.max_part_size)
+        self.clock = clock
+        self.decisions = 0
+
+        self._lock = threading.Lock()
+        self._last_rate = None
+        self._last_change = None
+        self._start_window()
+
+
+    def get_state(self) -> dict:
+        """Threads and part size to carry over to the next invocation"""
+        return {'threads': self.threads, 'part_size': self.part_size}
+
+
+    def set_state(self, state) -> None:
+        """Start from the threads and part size of an earlier invocation"""
+        with self._lock:
+            self.threads = min(max(state.get('threads', self.threads), self.min_threads),
+                               self.max_threads)
+            self.part_size = min(max(state.get('part_size', self.part_size),
+                                     self.min_part_size), self.max_part_size)
+
+
+    def record_part(self, size, seconds) -> None:
+        """Record a part of size bytes uploaded in the given seconds"""
+        with self._lock:
+            self._bytes += size
+            self._parts += 1
+            self._part_seconds += seconds
+            if self._parts >= self.threads:
+                self._decide()
+
+
+    def record_error(self, status=None) -> None:
+        """
+        Record a failed attempt at a part, with its HTTP status or None
+        if no response was received
+        """
+        with self._lock:
+            self._errors += 1
+            if status is not None and status not in CONGESTION_STATUSES:
+                return
+            if not self._decreased:
+                self._decreased = True
+                reason = "HTTP %s" % status if status else "connection failure"
+                self._change(
+                    max(self.threads // 2, self.min_threads),
+                    max(self.part_size // 2, self.min_part_size),
+                    reason
+                )
+                self._last_change = None
+                self._last_rate = None
+
+
+    def _start_window(self) -> None:
+        self._window_start = self.clock()
+        self._bytes = 0
+        self._parts = 0
+        self._part_seconds = 0
+        self._errors = 0
+        self._decreased = False
+
+
+    def _decide(self) -> None:
+        """Adjust at the end of a window of parts"""
+        elapsed = max(self.clock() - self._window_start, 1e-6)
+        rate = self._bytes / elapsed
+        reason = "%.1f MB/s over %d parts, %d failed attempts" % (
+            rate / 2**20, self._parts, self._errors
+        )
+
+        if self._decreased:
+            # already halved during this window
+            pass
+        elif (self._last_change and self._last_rate
+              and rate < self._last_rate * (1 - DROP)):
+            threads, part_size = self._last_change
+            self._change(threads, part_size, reason + ", slower than %.1f MB/s" % (
+                self._last_rate / 2**20))
+            self._last_change = None
+        elif self.threads < self.max_threads:
+            self._last_change = (self.threads, self.part_size)
+            self._change(self.threads + 1, self.part_size, reason)
+        elif self.part_size < self.max_part_size:
+            self._last_change = (self.threads, self.part_size)
+            self._change(self.threads, min(self.part_size + self.min_part_size,
+                                           self.max_part_size), reason)
+        else:
+            self._last_change = None
+
+        self._last_rate = rate
+        self._start_window()
+
+
+    def _change(self, threads, part_size, reason) -> None:
+        if (threads, part_size) == (self.threads, self.part_size):
+            return
+        print(
+            "Upload control: %d -> %d threads, %d -> %d MB parts (%s)" % (
+                self.threads, threads, self.part_size // 2**20,
+                part_size // 2**20, reason
+            ), file=sys.stderr
+        )
+        self.threads = threads
+        self.part_size = part_size
+        self.decisions += 1
@@ -5,6 +5,12 @@ sys.path.append(
     os.path.abspath(os.path.join(os.path.realpath(__file__), "../../"))
 )
 
+# the modules in files/ import their siblings, as the scripts put files/
+# on the path, so each can also be tested on its own
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.realpath(__file__), "../../files"))
+)
+
 TEST_DATA_DIR = (
     os.path.join(os.path.dirname(__file__), 'test_data')
 )
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import time
+import unittest
+
+from files import bandwidth as bw
+
+
+def local_time(hour, minute):
+    """Seconds since the epoch of the given local time of day"""
+    return time.mktime((2024, 1, 1, hour, minute, 0, 0, 0, -1))
+
+
+class TestGetRate(unittest.TestCase):
+    """
+    Tests for bandwidth.parse_schedule and bandwidth.get_rate
+
+    Functions parse the windows of a schedule and give the rate of the
+    window a time falls in
+    """
+    def test_rate_of_window(self):
+        """
+        Test that times in a window get its rate, including a window
+        wrapping past midnight, and other times are uncapped
+        """
+        schedule = bw.parse_schedule(['07:00-19:00=200', '22:00-02:00=8'])
+
+        with self.subTest('day window'):
+            assert bw.get_rate(schedule, local_time(12, 0)) == 25e6
+
+        with self.subTest('window end not included'):
+            assert bw.get_rate(schedule, local_time(19, 0)) is None
+
+        with self.subTest('window wrapping midnight'):
+            assert bw.get_rate(schedule, local_time(1, 30)) == 1e6
+            assert bw.get_rate(schedule, local_time(23, 0)) == 1e6
+
+
+    def test_bad_windows_rejected(self):
+        """Test that badly formed windows raise ValueError"""
+        for window in ('07:00-19:00', '7-19=200', '07:60-19:00=200', '07:00-19:00=0'):
+            with self.subTest('window accepted', window=window):
+                with self.assertRaises(ValueError):
+                    bw.parse_schedule([window])
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Tests for bandwidth.TokenBucket
+
+    Bucket shared through a file limits the rate data is taken at by
+    everything using the file
+    """
+    def setUp(self):
+        self.now = local_time(12, 0)
+        self.slept = []
+        fh = tempfile.NamedTemporaryFile(delete=False)
+        fh.close()
+        self.path = fh.name
+        self.addCleanup(os.remove, self.path)
+
+
+    def make_bucket(self, windows=('00:00-24:00=80',)):
+        return bw.TokenBucket(
+            self.path, bw.parse_schedule(windows), clock=lambda: self.now,
+            sleep=self.slept.append
+        )
+
+
+    def test_rate_shared_through_file(self):
+        """
+        Test that buckets on the same file draw on the same tokens, so
+        that the second waits out the debt left by the first
+        """
+        first, second = self.make_bucket(), self.make_bucket()
+
+        # a full bucket holds one second at 10 MB/s
+        with self.subTest('full bucket waited on'):
+            assert first.take(10e6) == 0
+
+        with self.subTest('wrong wait for debt'):
+            assert second.take(20e6) == 2.0
+
+        self.now += 1
+        with self.subTest('debt not carried over'):
+            assert first.take(10e6) == 2.0
+
+        with self.subTest('waits not slept'):
+            assert self.slept == [2.0, 2.0]
+
+
+    def test_uncapped_outside_windows(self):
+        """Test that nothing is waited for outside every window"""
+        bucket = self.make_bucket(['00:00-01:00=1'])
+
+        assert bucket.take(10**9) == 0
+
+
+    def test_reader_takes_as_read(self):
+        """
+        Test that a throttled reader gives back the data, taking from
+        the bucket in quanta as it is read
+        """
+        data = os.urandom(bw.QUANTUM * 2 + 10)
+        taken = []
+        bucket = self.make_bucket()
+        bucket.take = taken.append
+        reader = bucket.throttle(data)
+
+        read = b''.join(iter(lambda: reader.read(8192), b''))
+
+        with self.subTest('data not read back'):
+            assert read == data and len(reader) == len(data)
+
+        with self.subTest('wrong quanta taken'):
+            assert taken == [bw.QUANTUM, bw.QUANTUM, 10]
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import mock_open, patch
+
+from files import change_feed as cf
+
+
+class TestWatchUnsupported(unittest.TestCase):
+    """
+    Tests for change_feed.watch_unsupported
+
+    Function finds the file system of a directory from /proc/mounts,
+    refusing to watch network file systems
+    """
+    mounts = (
+        "/dev/sda1 / ext4 rw 0 0\n"
+        "server:/export /mnt/seq nfs4 rw 0 0\n"
+    )
+
+    @patch('files.change_feed.sys.platform', 'linux')
+    @patch('files.change_feed.os.path.realpath', side_effect=lambda x: x)
+    def test_nfs_not_watched(self, _):
+        """
+        Test that a directory on an NFS mount is not watched, whilst
+        one on the root file system is
+        """
+        with patch('builtins.open', mock_open(read_data=self.mounts)):
+            with self.subTest('NFS directory watched'):
+                assert 'nfs4' in cf.watch_unsupported('/mnt/seq/run')
+
+            with self.subTest('local directory not watched'):
+                assert cf.watch_unsupported('/data/run') is None
+
+
+class TestChangeWatcher(unittest.TestCase):
+    """
+    Tests for change_feed.ChangeWatcher
+
+    Watcher records files written and directories created below the
+    watched directory in the change feed
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, 'run')
+        os.makedirs(os.path.join(self.run_dir, 'Data'))
+        self.feed_path = os.path.join(self.tmp_dir, 'changes.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def wait_for_changes(self, feed, count):
+        for _ in range(50):
+            changes = feed.read(0)
+            if len(changes) >= count:
+                return changes
+            time.sleep(0.1)
+        return feed.read(0)
+
+
+    @unittest.skipIf(cf.watch_unsupported(tempfile.gettempdir()), 'inotify unavailable')
+    def test_changes_recorded(self):
+        """
+        Test that files closed after writing, files moved into place
+        and new directories are all recorded, with the mtime of files
+        """
+        watcher = cf.ChangeWatcher(self.run_dir, self.feed_path)
+        assert watcher.start_watching(timeout=10), watcher.error
+        self.addCleanup(watcher.stop)
+
+        written = os.path.join(self.run_dir, 'Data', 'RunInfo.xml')
+        with open(written, 'w') as fh:
+            fh.write('info')
+        moved = os.path.join(self.run_dir, 'Data', 'moved.cbcl')
+        with open(os.path.join(self.tmp_dir, 'tmp.cbcl'), 'w') as fh:
+            fh.write('data')
+        os.rename(os.path.join(self.tmp_dir, 'tmp.cbcl'), moved)
+        new_dir = os.path.join(self.run_dir, 'Logs')
+        os.mkdir(new_dir)
+
+        feed = cf.ChangeFeed(self.feed_path)
+        self.addCleanup(feed.close)
+        changes = [(path, kind) for _, path, kind in self.wait_for_changes(feed, 3)]
+
+        with self.subTest('feed not watching'):
+            assert feed.status()[0] == cf.WATCHING
+
+        with self.subTest('wrong changes recorded'):
+            assert changes == [
+                (written, cf.CHANGED), (moved, cf.CHANGED), (new_dir, cf.TREE)
+            ]
+
+        with self.subTest('mtimes files were closed with not recorded'):
+            assert feed.closed_mtimes(0) == {
+                written: os.stat(written).st_mtime, moved: os.stat(moved).st_mtime
+            }
+
+        watcher.stop()
+
+        with self.subTest('feed not stopped'):
+            assert feed.status()[0] == cf.STOPPED
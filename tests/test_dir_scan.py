@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from files import dir_scan as ds
+
+
+class TestDirScanner(unittest.TestCase):
+    """
+    Tests for dir_scan.DirScanner
+
+    Scanner lists every directory below the sync dir, statting each
+    entry once, and skips settled directories that have not changed
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for lane in ('L001', 'L002'):
+            for cycle in ('C1.1', 'C2.1'):
+                cycle_dir = os.path.join(self.tmp_dir, 'BaseCalls', lane, cycle)
+                os.makedirs(cycle_dir)
+                for tile in ('1', '2'):
+                    open(os.path.join(cycle_dir, f'{lane}_{tile}.cbcl'), 'w').close()
+        open(os.path.join(self.tmp_dir, 'RunInfo.xml'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_entries_match_os_walk(self):
+        """
+        Test that the same entries are found in the same order as
+        os.walk, with stats matching os.lstat
+        """
+        expected = []
+        for root, dirs, files in os.walk(self.tmp_dir):
+            expected.extend(os.path.join(root, name) for name in dirs + files)
+
+        found = []
+        for _, entries in ds.DirScanner(self.tmp_dir).walk():
+            for full_path, entry_stat in entries:
+                found.append(full_path)
+                with self.subTest('stat differs', path=full_path):
+                    assert entry_stat.st_mtime == os.lstat(full_path).st_mtime
+
+        assert found == expected
+
+
+    def test_unchanged_settled_dirs_skipped(self):
+        """
+        Test that settled directories with unchanged mtimes are not
+        listed, but a new file in a directory below one is found
+        """
+        scanner = ds.DirScanner(self.tmp_dir)
+        list(scanner.walk())
+        known_dirs = scanner.scanned
+
+        new_file = os.path.join(self.tmp_dir, 'BaseCalls', 'L002', 'C2.1', 'L002_3.cbcl')
+        open(new_file, 'w').close()
+
+        scanner = ds.DirScanner(self.tmp_dir, known_dirs)
+        listed = dict(scanner.walk())
+
+        with self.subTest('unchanged dirs listed'):
+            assert list(listed) == [os.path.dirname(new_file)]
+
+        with self.subTest('new file not found'):
+            assert new_file in [path for path, _ in listed[os.path.dirname(new_file)]]
+
+
+class TestSharedScan(unittest.TestCase):
+    """
+    Tests for dir_scan.SharedScan
+
+    Scan walks the directory once for every route, routing entries to
+    each route's view and shared entries to every view
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for lane in ('1', '2'):
+            cycle_dir = os.path.join(self.tmp_dir, 'BaseCalls', 'L00' + lane, 'C1.1')
+            os.makedirs(cycle_dir)
+            open(os.path.join(cycle_dir, f's_{lane}_1.bcl'), 'w').close()
+        open(os.path.join(self.tmp_dir, 'RunInfo.xml'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def make_scan(self, prune=False):
+        routes = dict((lane, lambda path, lane=lane: f's_{lane}_' in path) for lane in ('1', '2'))
+        return ds.SharedScan(self.tmp_dir, routes, shared=lambda path: 'RunInfo' in path,
+                             prune=prune)
+
+
+    def test_entries_routed_from_one_walk(self):
+        """
+        Test that the directory is listed once for both views, each
+        seeing every directory with only its own and the shared files
+        """
+        scan = self.make_scan()
+        listed = {}
+        with patch('files.dir_scan.os.scandir', wraps=os.scandir) as mock_scandir:
+            for lane in ('1', '2'):
+                listed[lane] = dict(scan.view(lane).walk())
+
+        with self.subTest('directory listed for each view'):
+            assert mock_scandir.call_count == len(listed['1'])
+
+        with self.subTest('directories not passed to every view'):
+            assert list(listed['1']) == list(listed['2'])
+
+        for lane in ('1', '2'):
+            found = sorted(os.path.basename(path) for entries in listed[lane].values()
+                           for path, _ in entries)
+            with self.subTest('wrong entries routed', lane=lane):
+                assert found == ['RunInfo.xml', f's_{lane}_1.bcl']
+
+
+    def test_settled_dirs_pruned_once_every_view_walked(self):
+        """
+        Test that unchanged directories are only pruned once every view
+        has walked the last scan, and stay listed if any unsettled them
+        """
+        scan = self.make_scan(prune=True)
+        list(scan.view('1').walk())
+        scan.reset()
+
+        with self.subTest('pruned before every view walked'):
+            assert len(dict(scan.view('1').walk())) == 6
+
+        view = scan.view('2')
+        list(view.walk())
+        view.unsettle(os.path.join(self.tmp_dir, 'BaseCalls', 'L002', 'C1.1'))
+        scan.reset()
+        listed = dict(scan.view('1').walk())
+
+        with self.subTest('settled dirs not pruned'):
+            assert list(listed) == [os.path.join(self.tmp_dir, 'BaseCalls', 'L002', 'C1.1')]
@@ -0,0 +1,891 @@
+import argparse
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from files import change_feed as cf
+from files import dx_sync_directory as dsd
+from files.space_ledger import HEADROOM, LEDGER_FILE, SpaceLedger
+from files.tar_index import INDEX_SUFFIX, TarIndex
+
+
+def make_args(sync_dir, tmp_dir, **kwargs):
+    """Build validated arguments as dx_sync_directory.py would parse them"""
+    args = argparse.Namespace(
+        sync_dir=sync_dir, tar_destination='project-xxxx:/runs',
+        log_file=os.path.join(tmp_dir, 'sync.log'), prefix='run.TEST.lane.all',
+        tar_directory=os.path.join(tmp_dir, 'tars'), min_tar_size=None,
+        max_tar_size=None, include_patterns=None, exclude_patterns=None,
+        part_size=None, pipeline_depth=None, packing=None, finish=True,
+        min_age=None, stable_scans=None, prune_unchanged_dirs=False, change_feed=None,
+        full_scan_interval=None, stream=False, compress_threads=None,
+        codec=None, compress_level=None, compress_policy=None,
+        upload_threads=None, adaptive_upload=False, max_upload_threads=None,
+        max_part_size=None, bandwidth_schedule=None, builtin_upload=False,
+        sha256=False, dxpy_upload=False, dedup_content=False, churn_threshold=None,
+        space_budget=None, gentle_io=False, yield_to_writes=None, verbose=False,
+        auth_token='token'
+    )
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+
+    os.makedirs(args.tar_directory, exist_ok=True)
+
+    return dsd.check_inputs(args)
+
+
+def write_file(path, size, mtime=1e9):
+    """Write a file of random bytes with an old mtime"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(os.urandom(size))
+    os.utime(path, (mtime, mtime))
+
+
+class SyncDirTestCase(unittest.TestCase):
+    """Creates a run directory and tar directory for each test"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, 'run')
+        os.mkdir(self.run_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestPipelineTarFiles(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.pipeline_tar_files
+
+    Function builds tar files in a background thread whilst uploading
+    and removing the previous ones
+    """
+    @patch('files.dx_sync_directory.get_tar_destination',
+           return_value=('project-xxxx', '/runs'))
+    @patch('files.dx_sync_directory.upload_tar_index', return_value='file-index')
+    @patch('files.dx_sync_directory.upload_tar_file')
+    def test_all_tars_built_uploaded_and_removed(self, mock_upload, _, __):
+        """
+        Test that every tar is recorded as removed with its file ID
+        and no tar files are left on disk
+        """
+        mock_upload.side_effect = lambda path, *a: (
+            'file-' + os.path.basename(path), 0, 1
+        )
+        for i in range(4):
+            write_file(os.path.join(self.run_dir, f'C{i}.1', 'L001_1.cbcl'), 1024)
+
+        args = make_args(self.run_dir, self.tmp_dir)
+        log = dsd.read_log(args)
+        tars = [
+            {'size': 1024, 'files': [os.path.join(self.run_dir, f'C{i}.1', 'L001_1.cbcl')]}
+            for i in range(4)
+        ]
+
+        log = dsd.pipeline_tar_files(tars, log, args, depth=2)
+
+        with self.subTest('not all tars uploaded'):
+            assert mock_upload.call_count == 4
+
+        with self.subTest('tars not all recorded as removed'):
+            assert [x['status'] for x in log['tar_files'].values()] == ['removed'] * 4
+
+        with self.subTest('index file IDs not recorded'):
+            assert [x['index_file_id'] for x in log['tar_files'].values()] == ['file-index'] * 4
+
+        with self.subTest('files not recorded'):
+            assert len(log['files']) == 4
+
+        with self.subTest('tar files left on disk'):
+            assert os.listdir(args.tar_directory) == [LEDGER_FILE]
+
+        with self.subTest('space not released'):
+            assert args.space_ledger.get_reserved() == {}
+
+
+    @patch('files.dx_sync_directory.get_tar_destination',
+           return_value=('project-xxxx', '/runs'))
+    @patch('files.dx_sync_directory.upload_tar_file')
+    def test_failed_upload_leaves_log_resumable(self, mock_upload, _):
+        """
+        Test that when an upload fails the built tars stay recorded as
+        tarred for the next invocation to upload
+        """
+        mock_upload.side_effect = SystemExit('upload failed')
+        for i in range(2):
+            write_file(os.path.join(self.run_dir, f'C{i}.1', 'L001_1.cbcl'), 1024)
+
+        args = make_args(self.run_dir, self.tmp_dir)
+        log = dsd.read_log(args)
+        tars = [
+            {'size': 1024, 'files': [os.path.join(self.run_dir, f'C{i}.1', 'L001_1.cbcl')]}
+            for i in range(2)
+        ]
+
+        with self.assertRaises(SystemExit):
+            dsd.pipeline_tar_files(tars, log, args, depth=1)
+
+        log = dsd.read_log(args)
+        for tar_file, entry in log['tar_files'].items():
+            with self.subTest('tar not left tarred', tar_file=tar_file):
+                assert entry['status'] == 'tarred'
+                assert os.path.exists(tar_file)
+
+
+    @patch('files.dx_sync_directory.get_tar_destination',
+           return_value=('project-xxxx', '/runs'))
+    @patch('files.dx_sync_directory.upload_tar_file')
+    def test_failed_upload_stops_wait_for_space(self, mock_upload, _):
+        """
+        Test that when an upload fails the builder stops waiting for the
+        space held by the tar file that failed, rather than waiting until
+        it gives up
+        """
+        mock_upload.side_effect = SystemExit('upload failed')
+        for i in range(2):
+            write_file(os.path.join(self.run_dir, f'C{i}.1', 'L001_1.cbcl'), 1024)
+
+        args = make_args(self.run_dir, self.tmp_dir)
+        now = [0]
+
+        def sleep(seconds):
+            now[0] += seconds
+            time.sleep(0.001)
+
+        # room for one tar file at a time
+        args.space_ledger = SpaceLedger(args.space_ledger.path, budget=20000,
+                                        clock=lambda: now[0], sleep=sleep)
+        log = dsd.read_log(args)
+        tars = [
+            {'size': 1024, 'files': [os.path.join(self.run_dir, f'C{i}.1', 'L001_1.cbcl')]}
+            for i in range(2)
+        ]
+
+        with self.assertRaises(SystemExit):
+            dsd.pipeline_tar_files(tars, log, args, depth=1)
+
+        with self.subTest('waited until giving up'):
+            assert now[0] < dsd.SPACE_WAIT
+
+        with self.subTest('second tar file built'):
+            assert len(dsd.read_log(args)['tar_files']) == 1
+
+
+class TestGetFilesToUpload(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.get_files_to_upload
+
+    Function scans the sync dir for files not yet synced, optionally
+    skipping directories in which everything was already synced
+    """
+    def test_settled_dirs_pruned_until_finish(self):
+        """
+        Test that a synced cycle directory is not listed again, so a
+        file rewritten in place in it is only found when finishing,
+        whilst new files in other directories are still found
+        """
+        cycle_file = os.path.join(self.run_dir, 'C1.1', 'L001_1.cbcl')
+        write_file(cycle_file, 1024)
+        os.utime(os.path.dirname(cycle_file), (1e9, 1e9))
+
+        args = make_args(self.run_dir, self.tmp_dir, finish=False,
+                         min_age=0, prune_unchanged_dirs=True)
+        log = dsd.read_log(args)
+        for full_path, f_stat in dsd.get_files_to_upload(log, args).items():
+            log['files'][full_path] = {'mtime': f_stat.st_mtime}
+        log = dsd.update_log(log, args)
+
+        # directories are settled by the first scan after their files sync
+        with self.subTest('synced file found again'):
+            assert dsd.get_files_to_upload(log, args) == {}
+
+        # rewritten in place, which leaves the directory mtime alone
+        os.utime(cycle_file, (2e9 - 1, 1.5e9))
+        new_file = os.path.join(self.run_dir, 'C2.1', 'L001_1.cbcl')
+        write_file(new_file, 1024)
+        os.utime(os.path.dirname(new_file), (1e9, 1e9))
+
+        with self.subTest('settled dir not pruned'):
+            assert list(dsd.get_files_to_upload(log, args)) == [
+                os.path.join(self.run_dir, 'C2.1'), new_file
+            ]
+
+        args.finish = True
+        with self.subTest('rewritten file not found on finish'):
+            assert cycle_file in dsd.get_files_to_upload(log, args)
+
+
+    def test_synced_dir_being_written_not_held_back(self):
+        """
+        Test that a synced directory still being written to is skipped
+        rather than held back as not ready, so its parent settles
+        """
+        cycle_dir = os.path.join(self.run_dir, 'C1.1')
+        os.makedirs(cycle_dir)
+        os.utime(self.run_dir, (1e9, 1e9))
+
+        args = make_args(self.run_dir, self.tmp_dir, finish=False, min_age=1000)
+        log = dsd.read_log(args)
+        log['files'][cycle_dir] = {'mtime': 1e9}
+        cur_time = int(time.time())
+
+        with self.subTest('synced dir being written not skipped'):
+            assert dsd.check_file(cycle_dir, os.lstat(cycle_dir), cur_time, None, None,
+                                  log, args) == dsd.SKIP
+
+        dsd.get_files_to_upload(log, args)
+
+        with self.subTest('parent of synced dir not settled'):
+            assert args.state.get_dir_scans()[''] == (1e9, True)
+
+
+    def test_stable_files_found_before_min_age(self):
+        """
+        Test that with --stable-scans a recently modified file is found
+        once it has been seen unchanged by that many scans, and not
+        after it changes again
+        """
+        path = os.path.join(self.run_dir, 'RunInfo.xml')
+        write_file(path, 10, mtime=time.time() - 10)
+
+        args = make_args(self.run_dir, self.tmp_dir, finish=False,
+                         min_age=1000, stable_scans=2)
+        log = dsd.read_log(args)
+
+        with self.subTest('file found on first sight'):
+            assert dsd.get_files_to_upload(log, args) == {}
+
+        args.state.close()
+        args.state = None
+        log = dsd.read_log(args)
+        with self.subTest('unchanged file not found'):
+            assert list(dsd.get_files_to_upload(log, args)) == [path]
+
+        args.state.close()
+        args.state = None
+        log = dsd.read_log(args)
+        write_file(path, 20, mtime=time.time() - 5)
+        with self.subTest('changed file found'):
+            assert dsd.get_files_to_upload(log, args) == {}
+
+
+    def test_rewritten_files_with_same_content_skipped(self):
+        """
+        Test that with --dedup-content a synced file rewritten with the
+        same data is not found again and its new mtime is recorded,
+        whilst one rewritten with different data of the same size is
+        """
+        same, changed = (os.path.join(self.run_dir, name)
+                         for name in ('RunParameters.xml', 'InterOp/Metrics.bin'))
+        for path in (same, changed):
+            write_file(path, 100)
+
+        args = make_args(self.run_dir, self.tmp_dir, dedup_content=True)
+        log = dsd.read_log(args)
+        tar_path = os.path.join(args.tar_directory, 'run_000.tar.gz')
+        files = {'size': 200, 'files': [same, changed]}
+        log = dsd.record_tar_file(tar_path, *dsd.build_tar_file(files, tar_path, args),
+                                  log, args)
+
+        os.utime(same, (1.5e9, 1.5e9))
+        write_file(changed, 100, mtime=1.5e9)
+
+        with self.subTest('wrong files found'):
+            assert list(dsd.get_files_to_upload(log, args)) == [changed]
+
+        args.state.close()
+        args.state = None
+        log = dsd.read_log(args)
+        with self.subTest('new mtime of unchanged file not recorded'):
+            assert log['files'][same]['mtime'] == 1.5e9
+
+
+    def test_churning_files_deferred_until_finish(self):
+        """
+        Test that with --churn-threshold a file changed that many times
+        is left for --finish, and that a directory is only found once
+        """
+        path = os.path.join(self.run_dir, 'InterOp', 'QMetricsOut.bin')
+        write_file(path, 100)
+        os.utime(os.path.dirname(path), (1e9, 1e9))
+
+        args = make_args(self.run_dir, self.tmp_dir, finish=False, min_age=0,
+                         churn_threshold=1)
+        log = dsd.read_log(args)
+
+        def sync(expected):
+            files = dsd.get_files_to_upload(log, args)
+            assert sorted(files) == expected
+            if files:
+                tar_path = os.path.join(args.tar_directory, dsd.get_tar_filename(log, args))
+                tar = {'size': 100, 'files': sorted(files), 'stats': files}
+                dsd.record_tar_file(tar_path, *dsd.build_tar_file(tar, tar_path, args),
+                                    log, args)
+
+        with self.subTest('new file and directory not found'):
+            sync([os.path.dirname(path), path])
+
+        write_file(path, 100, mtime=1.1e9)
+        os.utime(os.path.dirname(path), (1.1e9, 1.1e9))
+
+        with self.subTest('changed file not found once'):
+            sync([path])
+
+        with self.subTest('changes not counted'):
+            assert log['files'][path]['changes'] == 1
+
+        write_file(path, 100, mtime=1.2e9)
+        with self.subTest('churning file not deferred'):
+            sync([])
+
+        args.finish = True
+        with self.subTest('churning file not found on finish'):
+            sync([path])
+
+
+class TestReadChangeFeed(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.read_change_feed
+
+    With --change-feed, only files in the changes recorded since the
+    last invocation are checked, unless changes may have been missed
+    """
+    def test_changes_read_until_rescan(self):
+        """
+        Test that after a first full scan only changed files are found,
+        and that a full scan is made when the feed asks for one
+        """
+        feed = cf.ChangeFeed(os.path.join(self.tmp_dir, 'changes.db'))
+        self.addCleanup(feed.close)
+        feed.set_state(cf.WATCHING, epoch='1')
+        feed.heartbeat()
+
+        old_file = os.path.join(self.run_dir, 'RunInfo.xml')
+        synced_file = os.path.join(self.run_dir, 'RunParameters.xml')
+        write_file(old_file, 10)
+        write_file(synced_file, 10)
+        args = make_args(self.run_dir, self.tmp_dir, finish=False, min_age=0,
+                         change_feed=feed.db_path)
+        log = dsd.read_log(args)
+        log['files'][synced_file] = {'mtime': 1e9}
+
+        with self.subTest('first invocation did not scan'):
+            assert list(dsd.get_files_to_upload(log, args)) == [old_file]
+
+        log['files'][old_file] = {'mtime': 1e9}
+        log = dsd.update_log(log, args)
+
+        # changed without an event, as if the watcher missed it
+        os.utime(synced_file, (1.5e9, 1.5e9))
+        new_file = os.path.join(self.run_dir, 'Data', 'L001_1.cbcl')
+        write_file(new_file, 10)
+        feed.record([(new_file, cf.CHANGED)])
+
+        with self.subTest('files not from change feed'):
+            assert list(dsd.get_files_to_upload(log, args)) == [new_file]
+
+        with self.subTest('file found but not synced not checked again'):
+            assert list(dsd.get_files_to_upload(log, args)) == [new_file]
+
+        feed.record([(self.run_dir, cf.RESCAN)])
+
+        with self.subTest('full scan not made'):
+            assert synced_file in dsd.get_files_to_upload(log, args)
+
+
+    def test_closed_files_found_before_min_age(self):
+        """
+        Test that with --stable-scans a recently modified file seen
+        closed by the watcher is found straight away, unless it has been
+        modified since
+        """
+        feed = cf.ChangeFeed(os.path.join(self.tmp_dir, 'changes.db'))
+        self.addCleanup(feed.close)
+        feed.set_state(cf.WATCHING, epoch='1')
+        feed.heartbeat()
+
+        args = make_args(self.run_dir, self.tmp_dir, finish=False, min_age=1000,
+                         stable_scans=3, change_feed=feed.db_path)
+        log = dsd.read_log(args)
+        dsd.get_files_to_upload(log, args)
+
+        closed_file = os.path.join(self.run_dir, 'RunInfo.xml')
+        open_file = os.path.join(self.run_dir, 'RunParameters.xml')
+        write_file(closed_file, 10, mtime=time.time() - 10)
+        write_file(open_file, 10, mtime=time.time() - 5)
+        feed.record([(closed_file, cf.CHANGED, os.stat(closed_file).st_mtime),
+                     (open_file, cf.CHANGED, time.time() - 10)])
+
+        assert list(dsd.get_files_to_upload(log, args)) == [closed_file]
+
+
+    def test_changes_deleted_once_read_by_every_reader(self):
+        """
+        Test that changes are deleted from the feed only once every lane
+        reading it has read them, and that a lane which has not read
+        them since they were deleted makes a full scan
+        """
+        feed = cf.ChangeFeed(os.path.join(self.tmp_dir, 'changes.db'))
+        self.addCleanup(feed.close)
+        feed.set_state(cf.WATCHING, epoch='1')
+        feed.heartbeat()
+
+        lanes = []
+        for lane in ('1', '2'):
+            args = make_args(self.run_dir, self.tmp_dir, finish=False, min_age=0,
+                             change_feed=feed.db_path,
+                             log_file=os.path.join(self.tmp_dir, 'lane%s.log' % lane))
+            log = dsd.read_log(args)
+            dsd.get_files_to_upload(log, args)
+            lanes.append((args, log))
+
+        new_file = os.path.join(self.run_dir, 'RunInfo.xml')
+        write_file(new_file, 10)
+        feed.record([(new_file, cf.CHANGED)])
+        dsd.get_files_to_upload(lanes[0][1], lanes[0][0])
+
+        with self.subTest('changes deleted before every lane read them'):
+            assert len(feed.read(0)) == 1
+
+        dsd.get_files_to_upload(lanes[1][1], lanes[1][0])
+
+        with self.subTest('changes read by every lane not deleted'):
+            assert feed.read(0) == []
+
+        with self.subTest('seq reused after changes deleted'):
+            assert feed.last_seq() == 1
+
+        # lane 1 restarts from a log written before it read the change
+        args, log = lanes[0]
+        log['change_feed']['seq'] = 0
+        missed_file = os.path.join(self.run_dir, 'RunParameters.xml')
+        write_file(missed_file, 10)
+
+        with self.subTest('full scan not made for deleted changes'):
+            assert missed_file in dsd.get_files_to_upload(log, args)
+
+
+class TestSplitIntoTarFiles(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.split_into_tar_files
+
+    Function splits the files found into tar files of at most
+    max_tar_size, by default keeping each directory together
+    """
+    def find_files(self, args):
+        return dict((path, os.lstat(path)) for path in sorted(
+            os.path.join(root, name) for root, _, names in os.walk(self.run_dir)
+            for name in names
+        ))
+
+    def test_balanced_tars_keep_cycles_together(self):
+        """
+        Test that balanced packing makes near equal tar files which each
+        hold whole cycle directories, and that sequential packing fills
+        each tar file in turn
+        """
+        for cycle in range(1, 6):
+            for tile in range(3):
+                write_file(os.path.join(self.run_dir, 'L001', 'C%d.1' % cycle,
+                                        '%d.cbcl' % tile), 2**17)
+        args = make_args(self.run_dir, self.tmp_dir, max_tar_size=1)
+        files = self.find_files(args)
+
+        tars = dsd.split_into_tar_files(files, {}, args)
+
+        with self.subTest('files lost'):
+            assert sorted(f for tar in tars for f in tar['files']) == list(files)
+
+        with self.subTest('cycle split across tar files'):
+            for tar in tars:
+                cycles = set(os.path.dirname(f) for f in tar['files'])
+                assert len(tar['files']) == 3 * len(cycles)
+
+        with self.subTest('tar files not near equal'):
+            assert [len(tar['files']) for tar in tars] == [6, 6, 3]
+
+        args.packing = 'sequential'
+        with self.subTest('sequential packing changed'):
+            assert [len(tar['files']) for tar in dsd.split_into_tar_files(
+                files, {}, args)] == [8, 7]
+
+
+    def test_small_remainder_held_back(self):
+        """
+        Test that files too few to fill a tar file of min_tar_size are
+        held back part way through a run, but not when finishing
+        """
+        for cycle in range(1, 4):
+            write_file(os.path.join(self.run_dir, 'C%d.1' % cycle, 'L001_1.cbcl'),
+                       2**20 if cycle < 3 else 2**16)
+        args = make_args(self.run_dir, self.tmp_dir, finish=False, min_age=0,
+                         min_tar_size=1, max_tar_size=2)
+        files = self.find_files(args)
+        c1, c2, c3 = files
+
+        with self.subTest('remainder not held back'):
+            tars = dsd.split_into_tar_files(files, {}, args)
+            assert [tar['files'] for tar in tars] == [[c1, c2]]
+
+        args = make_args(self.run_dir, self.tmp_dir, max_tar_size=2)
+        with self.subTest('remainder held back when finishing'):
+            tars = dsd.split_into_tar_files(files, {}, args)
+            assert [tar['files'] for tar in tars] == [[c1, c3], [c2]]
+
+
+class TestUploadTarFileParts(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.upload_tar_file_parts
+
+    With --dxpy-upload, tar files are uploaded in parts recorded in the
+    log, so an interrupted upload carries on where it stopped
+    """
+    @patch('files.dx_sync_directory.upload_file_parts')
+    @patch('files.dx_sync_directory.dxpy.DXFile')
+    @patch('files.dx_sync_directory.get_uploaded_parts')
+    def test_resume_sends_missing_parts(self, mock_uploaded, mock_dxfile, mock_upload):
+        """
+        Test that parts both recorded in the log and complete on the
+        platform are skipped, and a recorded part the platform does not
+        have complete is sent again
+        """
+        tar_file = os.path.join(self.tmp_dir, 'run_000.tar.gz')
+        write_file(tar_file, 1024)
+        args = make_args(self.run_dir, self.tmp_dir, dxpy_upload=True)
+        resume = {'status': 'tarred', 'file_id': 'file-xxxx', 'part_size': 2**20,
+                  'parts': {'1': {'size': 10, 'md5': 'a'}, '2': {'size': 10, 'md5': 'b'}}}
+        mock_uploaded.return_value = ('open', {1: {'size': 10, 'md5': 'a'}})
+        mock_upload.return_value = {'file_id': 'file-xxxx', 'bytes': 10, 'parts': 1,
+                                    'seconds': 1, 'part_seconds': {2: 1}}
+        progress = []
+
+        file_id = dsd.upload_tar_file_parts(tar_file, 'project-xxxx', '/runs', args,
+                                            resume, progress.append)
+
+        with self.subTest('platform file not reused'):
+            assert file_id == 'file-xxxx'
+            mock_dxfile.assert_called_once_with('file-xxxx')
+
+        with self.subTest('wrong parts skipped'):
+            assert mock_upload.call_args.kwargs['skip'] == [1]
+
+        with self.subTest('progress not recorded before upload'):
+            assert progress[0]['parts'] == {'1': {'size': 10, 'md5': 'a'}}
+
+
+    @patch('files.dx_sync_directory.upload_file_parts')
+    @patch('files.dx_sync_directory.dxpy.DXFile')
+    @patch('files.dx_sync_directory.get_uploaded_parts',
+           return_value=('closed', {}))
+    def test_finished_upload_not_repeated(self, _, mock_dxfile, mock_upload):
+        """
+        Test that an upload which finished before the log recorded it
+        is not uploaded again
+        """
+        args = make_args(self.run_dir, self.tmp_dir, dxpy_upload=True)
+        resume = {'file_id': 'file-xxxx', 'part_size': 2**20, 'parts': {}}
+
+        file_id = dsd.upload_tar_file_parts('run_000.tar.gz', 'project-xxxx', '/runs',
+                                            args, resume)
+
+        assert file_id == 'file-xxxx'
+        mock_upload.assert_not_called()
+
+
+    @patch('files.dx_sync_directory.find_mismatched_parts', return_value=[2])
+    @patch('files.dx_sync_directory.upload_file_parts')
+    @patch('files.dx_sync_directory.get_part_uploader')
+    def test_mismatched_parts_leave_file_open(self, mock_uploader, mock_upload, _):
+        """
+        Test that the platform file is not closed, and the upload not
+        taken as done, when its parts do not match the tar file built
+        """
+        tar_file = os.path.join(self.tmp_dir, 'run_000.tar.gz')
+        write_file(tar_file, 1024)
+        args = make_args(self.run_dir, self.tmp_dir)
+        dx_file = mock_uploader.return_value.new_file.return_value
+        dx_file.get_id.return_value = 'file-xxxx'
+        resume = {'status': 'tarred', 'part_size': 2**20, 'part_md5s': ['a', 'b']}
+
+        with self.assertRaises(SystemExit):
+            dsd.upload_tar_file_parts(tar_file, 'project-xxxx', '/runs', args, resume)
+
+        with self.subTest('built part size not used'):
+            assert mock_upload.call_args.args[2] == 2**20
+
+        with self.subTest('file closed'):
+            dx_file.close.assert_not_called()
+
+
+class TestAbandonStreamedTarFiles(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.abandon_streamed_tar_files
+
+    Tar files left mid-stream are marked abandoned and their partial
+    uploads removed from the platform
+    """
+    @patch('files.dx_sync_directory.get_tar_destination',
+           return_value=('project-dest', '/runs'))
+    @patch('files.dx_sync_directory.dxpy.DXFile')
+    def test_partial_uploads_removed_from_project(self, mock_dxfile, _):
+        """
+        Test that each partial upload is removed from the project it was
+        streamed to, or the tar destination's if not recorded
+        """
+        args = make_args(self.run_dir, self.tmp_dir)
+        log = dsd.read_log(args)
+        log['tar_files'] = {
+            'run_000.tar.gz': {'status': 'streaming', 'file_id': 'file-0',
+                               'project': 'project-xxxx'},
+            'run_001.tar.gz': {'status': 'streaming', 'file_id': 'file-1'},
+            'run_002.tar.gz': {'status': 'removed', 'file_id': 'file-2'}
+        }
+
+        log = dsd.abandon_streamed_tar_files(log, args)
+
+        with self.subTest('partial uploads not removed from their project'):
+            assert mock_dxfile.call_args_list == [
+                (('file-0',), {'project': 'project-xxxx'}),
+                (('file-1',), {'project': 'project-dest'})
+            ]
+            assert mock_dxfile.return_value.remove.call_count == 2
+
+        with self.subTest('streams not abandoned'):
+            assert [entry['status'] for entry in log['tar_files'].values()] == [
+                'abandoned', 'abandoned', 'removed'
+            ]
+
+
+class TestUploadTarIndex(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.upload_tar_index
+
+    Function uploads the index of a tar file
+    """
+    @patch('files.dx_sync_directory.dxpy.upload_string')
+    def test_streamed_index_uploaded_from_memory(self, mock_upload):
+        """
+        Test that the index of a streamed tar file is uploaded from
+        memory, under the name it would have on disk, and not written
+        to the tar directory
+        """
+        mock_upload.return_value.get_id.return_value = 'file-index'
+        args = make_args(self.run_dir, self.tmp_dir, stream=True)
+        index = TarIndex('gzip', [['RunInfo.xml', 0, 512, 100]])
+
+        file_id = dsd.upload_tar_index('run_000.tar.gz', 'project-xxxx', '/runs', args, index)
+
+        with self.subTest('index not uploaded'):
+            assert file_id == 'file-index'
+            assert TarIndex.read(io.BytesIO(mock_upload.call_args[0][0])).members == index.members
+            assert mock_upload.call_args.kwargs['name'] == 'run_000.tar.gz' + INDEX_SUFFIX
+
+        with self.subTest('index written to tar directory'):
+            assert not [name for name in os.listdir(args.tar_directory)
+                        if name.endswith(INDEX_SUFFIX)]
+
+
+class TestBuildTarFile(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.build_tar_file
+
+    Function writes a tar file, hashing each part as it is written
+    """
+    def test_part_md5s_match_tar_file(self):
+        """
+        Test that the md5 recorded for each part is that of the part
+        of the tar file written, without reading it back
+        """
+        files = [os.path.join(self.run_dir, 'C%d.1' % x, 'L001_1.cbcl') for x in range(3)]
+        for path in files:
+            write_file(path, 3 * 2**20)
+        args = make_args(self.run_dir, self.tmp_dir, codec='none', part_size=5,
+                         sha256=True)
+        tar_path = os.path.join(args.tar_directory, 'run_000.tar')
+
+        entry, _, _ = dsd.build_tar_file(
+            {'size': 9 * 2**20, 'files': files}, tar_path, args
+        )
+
+        with open(tar_path, 'rb') as fh:
+            data = fh.read()
+
+        with self.subTest('wrong part md5s'):
+            assert entry['part_md5s'] == [
+                hashlib.md5(data[x:x + 5 * 2**20]).hexdigest()
+                for x in range(0, len(data), 5 * 2**20)
+            ]
+
+        with self.subTest('wrong sha256'):
+            assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+    def test_tar_file_shrunk_to_space_left(self):
+        """
+        Test that when space is left for only some of the files, the tar
+        file is built from those that fit, leaving the rest unrecorded
+        for the next sync, and its space is reserved
+        """
+        files = [os.path.join(self.run_dir, 'C%d.1' % x, 'L001_1.cbcl') for x in range(3)]
+        for path in files:
+            write_file(path, 3 * 2**20)
+        args = make_args(self.run_dir, self.tmp_dir, codec='none', finish=False)
+        args.space_ledger = SpaceLedger(
+            args.space_ledger.path, disk_free=lambda: HEADROOM + 7 * 2**20
+        )
+        tar_path = os.path.join(args.tar_directory, 'run_000.tar')
+
+        entry, log_updates, _ = dsd.build_tar_file(
+            {'size': 9 * 2**20, 'files': files}, tar_path, args
+        )
+
+        with tarfile.open(tar_path) as tar_file:
+            names = tar_file.getnames()
+
+        with self.subTest('tar file not shrunk'):
+            assert names == [os.path.relpath(f, self.run_dir) for f in files[:2]]
+
+        with self.subTest('files left out recorded'):
+            assert sorted(log_updates) == files[:2]
+            assert entry['size'] == 6 * 2**20
+
+        with self.subTest('space not reserved'):
+            assert list(args.space_ledger.get_reserved()) == [tar_path]
+
+
+    def test_finishing_tar_file_not_shrunk(self):
+        """
+        Test that when finishing, with no next sync to tar the rest,
+        the sync fails rather than tarring only the files that fit
+        """
+        files = [os.path.join(self.run_dir, 'C%d.1' % x, 'L001_1.cbcl') for x in range(3)]
+        for path in files:
+            write_file(path, 3 * 2**20)
+        args = make_args(self.run_dir, self.tmp_dir, codec='none')
+        now = [0]
+        args.space_ledger = SpaceLedger(
+            args.space_ledger.path, clock=lambda: now[0],
+            sleep=lambda seconds: now.__setitem__(0, now[0] + seconds),
+            disk_free=lambda: HEADROOM + 7 * 2**20
+        )
+        tar_path = os.path.join(args.tar_directory, 'run_000.tar')
+
+        with self.subTest('tar file of only some files built'):
+            with self.assertRaises(SystemExit):
+                dsd.build_tar_file({'size': 9 * 2**20, 'files': files}, tar_path, args)
+
+        with self.subTest('tar file written'):
+            assert not os.path.exists(tar_path)
+
+
+    def test_stopped_build_discarded(self):
+        """
+        Test that a build stopped part way through stops at the next
+        file, removing the partial tar file and releasing its space
+        """
+        files = [os.path.join(self.run_dir, 'C%d.1' % x, 'L001_1.cbcl') for x in range(3)]
+        for path in files:
+            write_file(path, 1024)
+        args = make_args(self.run_dir, self.tmp_dir)
+        tar_path = os.path.join(args.tar_directory, 'run_000.tar')
+        stop = threading.Event()
+        added = []
+        add_to_tar = dsd.add_to_tar
+
+        def add_then_stop(*args):
+            added.append(args[1])
+            stop.set()
+            return add_to_tar(*args)
+
+        with patch('files.dx_sync_directory.add_to_tar', side_effect=add_then_stop):
+            with self.assertRaises(dsd.TarBuildStopped):
+                dsd.build_tar_file({'size': 3 * 1024, 'files': files}, tar_path, args, stop)
+
+        with self.subTest('files added after stopping'):
+            assert added == files[:1]
+
+        with self.subTest('partial tar file left'):
+            assert os.listdir(args.tar_directory) == [LEDGER_FILE]
+
+        with self.subTest('space not released'):
+            assert args.space_ledger.get_reserved() == {}
+
+
+class TestAddToTar(SyncDirTestCase):
+    """
+    Tests for dx_sync_directory.add_to_tar
+
+    Function adds a file to a tar file using the stat from the scan
+    """
+    def test_header_matches_tarfile_add(self):
+        """
+        Test that the header written matches the one tarfile.add
+        would write after statting the file itself
+        """
+        path = os.path.join(self.run_dir, 'RunInfo.xml')
+        write_file(path, 100)
+        tar_path = os.path.join(self.tmp_dir, 'test.tar')
+
+        with tarfile.open(tar_path, 'w') as tar_file:
+            tar_file.add(path, arcname='expected', recursive=False)
+            dsd.add_to_tar(tar_file, path, 'RunInfo.xml', os.lstat(path))
+
+        with tarfile.open(tar_path) as tar_file:
+            expected, added = tar_file.getmembers()
+            added_data = tar_file.extractfile(added).read()
+
+        for attr in ('mode', 'uid', 'gid', 'uname', 'gname', 'mtime', 'size', 'type'):
+            with self.subTest('header differs', attr=attr):
+                assert getattr(added, attr) == getattr(expected, attr)
+
+        with open(path, 'rb') as fh:
+            assert added_data == fh.read()
+
+
+    def test_md5_and_offset_of_data_recorded(self):
+        """
+        Test that the md5 and offset returned for each file point at
+        its data in the tar file
+        """
+        tar_path = os.path.join(self.tmp_dir, 'test.tar')
+        entries = {}
+
+        with tarfile.open(tar_path, 'w') as tar_file:
+            for name, size in (('a', 700), ('b', 512), ('c', 0)):
+                path = os.path.join(self.run_dir, name)
+                write_file(path, size)
+                entries[name] = dsd.add_to_tar(tar_file, path, name, os.lstat(path))
+
+        with open(tar_path, 'rb') as fh:
+            tar_data = fh.read()
+
+        for name, entry in entries.items():
+            with open(os.path.join(self.run_dir, name), 'rb') as fh:
+                data = fh.read()
+
+            with self.subTest('wrong md5', name=name):
+                assert entry['md5'] == hashlib.md5(data).hexdigest()
+
+            with self.subTest('wrong offset', name=name):
+                assert tar_data[entry['offset']:entry['offset'] + len(data)] == data
+
+
+    def test_stopped_whilst_reading(self):
+        """
+        Test that a file is not read into the tar file once stopped
+        """
+        path = os.path.join(self.run_dir, 'RunInfo.xml')
+        write_file(path, 100)
+        stop = threading.Event()
+        stop.set()
+
+        with tarfile.open(os.path.join(self.tmp_dir, 'test.tar'), 'w') as tar_file:
+            with self.assertRaises(dsd.TarBuildStopped):
+                dsd.add_to_tar(tar_file, path, 'RunInfo.xml', os.lstat(path), stop=stop)
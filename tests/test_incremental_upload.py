@@ -1,6 +1,9 @@
+import argparse
 import os
 import shutil
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 import pytest
@@ -177,3 +180,174 @@ class TestFindLocalSamplesheet(unittest.TestCase):
         with self.subTest('Slack alert not sent'):
             # check we would send the Slack alert
             assert mock_slack.call_count == 1
+
+
+class TestRunSyncDir(unittest.TestCase):
+    """
+    Tests for incremental_upload.run_sync_dir
+
+    Function builds the dx_sync_directory.py arguments for a lane and
+    syncs it with the lane's engine, returning the file IDs uploaded
+    """
+    def make_args(self):
+        return argparse.Namespace(
+            exclude_patterns=['Logs', 'Logs'], upload_thumbnails=False,
+            samplesheet_delay=True, project='project-xxxx', temp_dir='/tmp',
+            min_size=1024, max_size=10000, upload_threads=8,
+            compress_threads=1, codec='gzip', pipeline_depth=1,
+            packing='balanced', compress_level=None, compress_policy=None,
+            api_token='token', verbose=False, dxpy_upload=False,
+            builtin_upload=False, sha256=False, bandwidth_schedule=None,
+            adaptive_upload=False, max_upload_threads=None, max_part_size=None,
+            stream=False, prune_unchanged_dirs=False, change_feed=None,
+            full_scan_interval=3600, min_age=1000, stable_scans=None,
+            dedup_content=False, churn_threshold=None, space_budget=None,
+            gentle_io=False, yield_to_writes=None, run_dir='/run', retries=3,
+            lane_workers=1
+        )
+
+
+    def make_lane(self):
+        return {'lane': 'all', 'log_path': '/logs/run.lane.all.log',
+                'remote_folder': '/run/runs', 'prefix': 'run.lane.all'}
+
+
+    @patch('files.incremental_upload.SyncEngine')
+    def test_exclude_patterns_not_accumulated(self, mock_engine):
+        """
+        Test that the patterns added for each invocation are not added
+        to args, and that the patterns passed on are deduplicated
+        """
+        args = self.make_args()
+        lane = self.make_lane()
+
+        for _ in range(3):
+            iu.run_sync_dir(lane, args)
+
+        with self.subTest('args modified'):
+            assert args.exclude_patterns == ['Logs', 'Logs']
+
+        invocation = lane['engine_args']
+        start = invocation.index('--exclude-patterns') + 1
+        end = invocation.index('--min-tar-size')
+
+        with self.subTest('wrong exclude patterns passed'):
+            assert invocation[start:end] == ['Logs', 'Images', 'SampleSheet.csv']
+
+
+    @patch('files.incremental_upload.SyncEngine')
+    def test_engine_kept_between_syncs(self, mock_engine):
+        """
+        Test that a lane's engine is started once and kept between
+        syncs, and replaced for the final sync whose arguments differ
+        """
+        mock_engine.return_value.sync.return_value = ['file-xxxx']
+        args = self.make_args()
+        lane = self.make_lane()
+
+        for _ in range(3):
+            file_ids = iu.run_sync_dir(lane, args)
+
+        with self.subTest('file IDs not returned'):
+            assert file_ids == ['file-xxxx']
+
+        with self.subTest('engine not kept'):
+            assert mock_engine.call_count == 1
+            assert mock_engine.return_value.sync.call_count == 3
+
+        iu.run_sync_dir(lane, args, finish=True)
+
+        with self.subTest('engine not replaced for final sync'):
+            assert mock_engine.call_count == 2
+            assert mock_engine.call_args[0][0].finish
+
+        with self.subTest('engine not closed after final sync'):
+            assert mock_engine.return_value.close.call_count == 2
+            assert lane['engine'] is None
+
+
+    @patch('files.incremental_upload.time.sleep')
+    @patch('files.incremental_upload.SyncEngine')
+    def test_failed_engine_replaced(self, mock_engine, mock_sleep):
+        """
+        Test that an engine which fails to sync is closed and a new one
+        started for the retry
+        """
+        mock_engine.return_value.sync.side_effect = [SystemExit(1), ['file-xxxx']]
+        args = self.make_args()
+        lane = self.make_lane()
+
+        file_ids = iu.run_sync_dir(lane, args)
+
+        with self.subTest('sync not retried'):
+            assert file_ids == ['file-xxxx']
+
+        with self.subTest('failed engine not replaced'):
+            assert mock_engine.call_count == 2
+            assert mock_engine.return_value.close.call_count == 1
+
+
+    @patch('files.incremental_upload.SyncEngine')
+    def test_threads_shared_between_lanes(self, mock_engine):
+        """
+        Test that lanes synced at once share the upload and compress
+        threads, each keeping at least one
+        """
+        args = self.make_args()
+        args.lane_workers = 4
+        lane = self.make_lane()
+
+        iu.run_sync_dir(lane, args)
+        invocation = lane['engine_args']
+
+        with self.subTest('upload threads not shared'):
+            assert invocation[invocation.index('--upload-threads') + 1] == '2'
+
+        with self.subTest('compress threads not kept at one'):
+            assert invocation[invocation.index('--compress-threads') + 1] == '1'
+
+
+class TestSyncLanes(unittest.TestCase):
+    """
+    Tests for incremental_upload.sync_lanes
+
+    Function syncs lanes at once on a pool, waiting for them all
+    """
+    def test_lanes_synced_at_once(self):
+        """
+        Test that lanes are synced concurrently, each lane only waiting
+        for itself
+        """
+        barrier = threading.Barrier(3, timeout=5)
+        synced = []
+
+        def sync(lane):
+            barrier.wait()
+            synced.append(lane)
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            iu.sync_lanes(pool, ['1', '2', '3'], sync)
+
+        with self.subTest('lanes not synced at once'):
+            assert sorted(synced) == ['1', '2', '3']
+
+
+    def test_failure_raised_after_all_lanes(self):
+        """
+        Test that a lane failing does not stop the other lanes, and the
+        failure is raised once they have finished
+        """
+        synced = []
+
+        def sync(lane):
+            if lane == '1':
+                raise SystemExit(1)
+            synced.append(lane)
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            with self.subTest('failure not raised'):
+                with self.assertRaises(SystemExit):
+                    iu.sync_lanes(pool, ['1', '2', '3'], sync)
+
+        with self.subTest('other lanes not synced'):
+            assert synced == ['2', '3']
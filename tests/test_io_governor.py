@@ -0,0 +1,162 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from files import io_governor as iog
+
+
+class TestGovernedReader(unittest.TestCase):
+    """
+    Tests for io_governor.IOGovernor.open
+
+    Source files opened by a gentle governor are read with a sequential
+    hint, dropping the pages read from the page cache behind the reader
+    """
+    def setUp(self):
+        fh = tempfile.NamedTemporaryFile(delete=False)
+        fh.write(os.urandom(20 * 2**20 + 5))
+        fh.close()
+        self.path = fh.name
+        self.addCleanup(os.remove, self.path)
+
+
+    @patch('files.io_governor.os.posix_fadvise')
+    def test_pages_read_dropped(self, mock_fadvise):
+        """
+        Test that every page read is dropped from the cache, in chunks
+        as it is read, and the data read is unchanged
+        """
+        with iog.IOGovernor(gentle=True).open(self.path) as reader:
+            data = b''.join(iter(lambda: reader.read(2**20), b''))
+
+        with open(self.path, 'rb') as fh:
+            with self.subTest('wrong data read'):
+                assert data == fh.read()
+
+        advice = [call[0][1:] for call in mock_fadvise.call_args_list]
+
+        with self.subTest('sequential access not hinted'):
+            assert advice[0] == (0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        dropped = [(offset, length) for offset, length, hint in advice
+                   if hint == os.POSIX_FADV_DONTNEED]
+
+        with self.subTest('pages not dropped as read'):
+            assert len(dropped) == 3
+
+        with self.subTest('not every page dropped'):
+            assert [offset for offset, _ in dropped] == [0, iog.DROP_CHUNK, 2 * iog.DROP_CHUNK]
+            assert sum(length for _, length in dropped) == len(data)
+
+
+    def test_plain_file_when_not_governed(self):
+        """
+        Test that a file is opened as is when there is nothing to govern
+        """
+        with iog.IOGovernor().open(self.path) as reader:
+            with self.subTest('file wrapped'):
+                assert not isinstance(reader, iog.GovernedReader)
+
+
+class TestYieldToWrites(unittest.TestCase):
+    """
+    Tests for io_governor.IOGovernor.wait_for_writes and WriteRateMonitor
+
+    Reading pauses whilst others write to the disk faster than the
+    limit, for at most MAX_PAUSE at a time
+    """
+    def make_governor(self, rates):
+        self.now = 0
+
+        def sleep(seconds):
+            self.now += seconds
+
+        governor = iog.IOGovernor(clock=lambda: self.now, sleep=sleep)
+        governor.write_limit = 10
+
+        class Monitor():
+            def get_rate(self):
+                return rates.pop(0) if rates else 0
+        governor.monitor = Monitor()
+        return governor
+
+
+    def test_reading_paused_whilst_writes_above_limit(self):
+        """
+        Test that reading waits until the write rate drops below the
+        limit, and the rate is not sampled again straight away
+        """
+        governor = self.make_governor([50, 20, 5])
+        governor.wait_for_writes()
+
+        with self.subTest('did not pause until rate dropped'):
+            assert governor.paused == 2 * iog.SAMPLE_SECONDS
+
+        governor.monitor.get_rate = lambda: 50
+        governor.wait_for_writes()
+
+        with self.subTest('rate sampled again straight away'):
+            assert governor.paused == 2 * iog.SAMPLE_SECONDS
+
+
+    def test_pause_limited(self):
+        """
+        Test that a steady stream of writes only pauses reading for at
+        most MAX_PAUSE at a time
+        """
+        governor = self.make_governor([])
+        governor.monitor.get_rate = lambda: 50
+        governor.wait_for_writes()
+
+        with self.subTest('pause not limited'):
+            assert governor.paused == iog.MAX_PAUSE
+
+
+    @patch('files.io_governor.get_own_written', side_effect=[0, 30, 30, 30])
+    @patch('files.io_governor.get_disk_written', side_effect=[0, 20, 60, 100])
+    def test_own_writes_not_counted(self, _, __):
+        """
+        Test that the disk's writes are put down to this process' own
+        writes until they cover them, as those reach the disk later
+        """
+        clock = iter([0, 1, 2, 3])
+        monitor = iog.WriteRateMonitor(tempfile.gettempdir(), clock=lambda: next(clock))
+
+        with self.subTest('own writes not yet on disk counted'):
+            assert monitor.get_rate() == 0
+
+        with self.subTest('own writes counted once on disk'):
+            assert monitor.get_rate() == 30
+            assert monitor.get_rate() == 40
+
+
+class TestRun(unittest.TestCase):
+    """
+    Tests for io_governor.IOGovernor.run
+
+    Function calls a function, in a low priority thread if gentle
+    """
+    def test_function_run_at_low_priority(self):
+        """
+        Test that a gentle governor runs the function at a low CPU
+        priority, leaving the calling thread's priority alone
+        """
+        before = os.getpriority(os.PRIO_PROCESS, 0)
+        nice = iog.IOGovernor(gentle=True).run(os.getpriority, os.PRIO_PROCESS, 0)
+
+        with self.subTest('function not run at low priority'):
+            assert nice == iog.WORKER_NICE
+
+        with self.subTest('calling thread priority changed'):
+            assert os.getpriority(os.PRIO_PROCESS, 0) == before
+
+
+    def test_errors_raised(self):
+        """
+        Test that errors in the function are raised to the caller
+        """
+        with self.subTest('error not raised'):
+            with self.assertRaises(SystemExit):
+                iog.IOGovernor(gentle=True).run(sys.exit, 'failed')
@@ -0,0 +1,48 @@
+import io
+import os
+import tempfile
+import unittest
+
+from files import manifest as mf
+
+
+class TestWriteManifest(unittest.TestCase):
+    """
+    Tests for manifest.write_manifest and manifest.read_manifest
+
+    Functions write and read back the gzipped TSV manifest of the files
+    synced from a directory
+    """
+    def test_rows_read_back_as_written(self):
+        """
+        Test that rows are read back with their types, missing values
+        as None and mtimes exactly as written
+        """
+        rows = [
+            {'path': 'RunInfo.xml', 'size': 100, 'mtime': 1700000000.123456789,
+             'md5': 'a' * 32, 'tar_index': 0, 'tar_file_id': 'file-xxxx', 'offset': 512},
+            {'path': 'Data', 'size': 4096, 'mtime': 1700000000.5, 'tar_index': 0,
+             'tar_file_id': 'file-xxxx'}
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'run' + mf.MANIFEST_SUFFIX)
+            count = mf.write_manifest(path, iter(rows))
+
+            with open(path, 'rb') as fh:
+                read = list(mf.read_manifest(io.BytesIO(fh.read())))
+
+            with self.subTest('temporary file left behind'):
+                assert os.listdir(tmp_dir) == [os.path.basename(path)]
+
+        with self.subTest('wrong count returned'):
+            assert count == 2
+
+        with self.subTest('rows not read back as written'):
+            assert read == [dict(dict.fromkeys(mf.COLUMNS), **row) for row in rows]
+
+
+    def test_tar_index_from_name(self):
+        """Test that the tar index is taken from a tar file's name"""
+        assert mf.get_tar_index('/tmp/run.lane.all_000012.tar.gz') == 12
+        assert mf.get_tar_index('/tmp/run.lane.all.log') is None
@@ -0,0 +1,364 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from hashlib import md5, sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from files import bandwidth
+from files import part_upload as pu
+
+
+class TestStreamingPartWriter(unittest.TestCase):
+    """
+    Tests for part_upload.StreamingPartWriter
+
+    Writer cuts everything written to it into fixed size parts and
+    uploads each part to a new platform file
+    """
+    part_size = pu.MIN_PART_SIZE
+
+    def setUp(self):
+        self.dx_file = MagicMock()
+        self.dx_file.get_id.return_value = 'file-xxxx'
+
+        patcher = patch(
+            'files.part_upload.dxpy.new_dxfile', return_value=self.dx_file
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_data_cut_into_parts(self):
+        """
+        Test that data is uploaded as full size parts followed by the
+        remainder, and that each part is reported back
+        """
+        parts = {}
+        writer = pu.StreamingPartWriter(
+            'test.tar.gz', 'project-xxxx', '/', part_size=self.part_size,
+            max_in_flight=2,
+            on_part=lambda idx, size, md5: parts.update({idx: size})
+        )
+
+        writer.write(b'a' * (self.part_size + 10))
+        writer.write(b'b' * self.part_size)
+        file_id = writer.close()
+
+        with self.subTest('wrong file ID returned'):
+            assert file_id == 'file-xxxx'
+
+        with self.subTest('parts wrongly sized'):
+            assert parts == {
+                1: self.part_size, 2: self.part_size, 3: 10
+            }
+
+        with self.subTest('file not closed'):
+            self.dx_file.close.assert_called_once_with(block=True)
+
+
+    def test_part_error_raised_on_close(self):
+        """
+        Test that a failed part upload is raised on close and the file
+        is left open
+        """
+        self.dx_file.upload_part.side_effect = RuntimeError('upload failed')
+
+        writer = pu.StreamingPartWriter(
+            'test.tar.gz', 'project-xxxx', '/', part_size=self.part_size
+        )
+        writer.write(b'a' * 10)
+
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+        self.dx_file.close.assert_not_called()
+
+
+    def test_part_size_below_platform_minimum(self):
+        """
+        Test that a part size below the platform minimum is rejected
+        """
+        with self.assertRaises(ValueError):
+            pu.StreamingPartWriter(
+                'test.tar.gz', 'project-xxxx', '/', part_size=1024
+            )
+
+
+class TestUploadFileParts(unittest.TestCase):
+    """
+    Tests for part_upload.upload_file_parts
+
+    Function uploads a local file in parts to an open platform file,
+    skipping parts uploaded by an earlier attempt
+    """
+    part_size = pu.MIN_PART_SIZE
+
+    def setUp(self):
+        self.dx_file = MagicMock()
+        fh = tempfile.NamedTemporaryFile(delete=False)
+        fh.write(b'a' * self.part_size * 2 + b'b' * 10)
+        fh.close()
+        self.path = fh.name
+        self.addCleanup(os.remove, self.path)
+
+
+    def test_uploaded_parts_skipped(self):
+        """
+        Test that only the parts not already uploaded are sent, with
+        their contents read from the right offsets
+        """
+        parts = {}
+        pu.upload_file_parts(
+            self.path, self.dx_file, self.part_size, threads=2, skip=[1],
+            on_part=lambda idx, size, md5: parts.update({idx: size})
+        )
+
+        with self.subTest('wrong parts uploaded'):
+            assert parts == {2: self.part_size, 3: 10}
+
+        with self.subTest('last part read from wrong offset'):
+            self.dx_file.upload_part.assert_any_call(b'b' * 10, index=3)
+
+        with self.subTest('file not closed'):
+            self.dx_file.close.assert_called_once_with(block=True)
+
+
+    def test_part_error_leaves_file_open(self):
+        """
+        Test that a failed part is raised and the file is left open for
+        a later attempt to carry on with
+        """
+        self.dx_file.upload_part.side_effect = RuntimeError('upload failed')
+
+        with self.assertRaises(RuntimeError):
+            pu.upload_file_parts(self.path, self.dx_file, self.part_size)
+
+        self.dx_file.close.assert_not_called()
+
+
+    def test_threads_set_by_controller(self):
+        """
+        Test that with a controller no more parts are uploaded at once
+        than it allows, and it is told of each part
+        """
+        controller = MagicMock(threads=1, max_threads=4)
+        in_flight = []
+        lock = threading.Lock()
+
+        def upload_part(data, index):
+            with lock:
+                in_flight.append(index)
+                assert len(in_flight) == 1, 'parts uploaded at once'
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(index)
+
+        self.dx_file.upload_part.side_effect = upload_part
+        pu.upload_file_parts(self.path, self.dx_file, self.part_size, controller=controller)
+
+        assert controller.record_part.call_count == 3
+
+
+    @patch('files.part_upload.dxpy.api.file_describe')
+    def test_only_complete_parts_reported(self, mock_describe):
+        """
+        Test that parts still uploading on the platform are not taken
+        to have been uploaded
+        """
+        mock_describe.return_value = {'state': 'open', 'parts': {
+            '1': {'state': 'complete', 'size': 10, 'md5': 'x'},
+            '2': {'state': 'pending'}
+        }}
+
+        assert pu.get_uploaded_parts('file-xxxx') == (
+            'open', {1: {'size': 10, 'md5': 'x'}}
+        )
+
+
+class FakeUploadHandler(BaseHTTPRequestHandler):
+    """Stores each part PUT to it, failing the first attempt at part 2"""
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/file-xxxx/2' and self.path not in self.server.failed:
+            self.server.failed.add(self.path)
+            self.send_response(500)
+        else:
+            self.server.parts[self.path] = (data, self.headers.get('x-test'))
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPI():
+    """Stands in for dxpy.api, giving upload URLs on a local server"""
+    def __init__(self, port):
+        self.port = port
+        self.closed = []
+
+    def file_new(self, input_params):
+        return {'id': 'file-xxxx'}
+
+    def file_upload(self, file_id, input_params):
+        return {'url': f"http://127.0.0.1:{self.port}/{file_id}/{input_params['index']}",
+                'headers': {'x-test': input_params['md5']}}
+
+    def file_close(self, file_id, input_params):
+        self.closed.append(file_id)
+
+    def file_describe(self, file_id, input_params):
+        return {'state': 'closed'}
+
+
+class TestPartUploader(unittest.TestCase):
+    """
+    Tests for part_upload.PartUploader
+
+    Uploader sends parts to the URLs given by the API over a shared
+    HTTP session, retrying failed parts
+    """
+    part_size = pu.MIN_PART_SIZE
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeUploadHandler)
+        self.server.parts = {}
+        self.server.failed = set()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.api = FakeAPI(self.server.server_address[1])
+
+        fh = tempfile.NamedTemporaryFile(delete=False)
+        fh.write(b'a' * self.part_size + b'b' * 10)
+        fh.close()
+        self.path = fh.name
+        self.addCleanup(os.remove, self.path)
+
+
+    @patch('files.part_upload.time.sleep')
+    def test_file_uploaded_with_retries(self, _):
+        """
+        Test that every part reaches the server with the headers given
+        by the API, a failed part is retried and the file is closed
+        """
+        uploader = pu.PartUploader(threads=2, retries=2, api=self.api)
+        dx_file = uploader.new_file('test.tar.gz', 'project-xxxx', '/')
+
+        result = pu.upload_file_parts(self.path, dx_file, self.part_size, threads=2)
+
+        with self.subTest('parts not received'):
+            assert self.server.parts['/file-xxxx/1'][0] == b'a' * self.part_size
+            assert self.server.parts['/file-xxxx/2'][0] == b'b' * 10
+
+        with self.subTest('API headers not sent'):
+            assert self.server.parts['/file-xxxx/2'][1] == md5(b'b' * 10).hexdigest()
+
+        with self.subTest('failed part not retried'):
+            assert self.server.failed == {'/file-xxxx/2'}
+
+        with self.subTest('file not closed'):
+            assert self.api.closed == ['file-xxxx']
+
+        with self.subTest('wrong result returned'):
+            assert result['file_id'] == 'file-xxxx'
+            assert result['bytes'] == self.part_size + 10
+            assert sorted(result['part_seconds']) == [1, 2]
+
+
+    @patch('files.part_upload.time.sleep')
+    def test_parts_sent_through_bucket(self, _):
+        """
+        Test that with a bandwidth bucket each part is still sent whole,
+        with every byte sent taken from the bucket
+        """
+        taken = []
+        bucket = bandwidth.TokenBucket(None, [])
+        bucket.take = taken.append
+        uploader = pu.PartUploader(threads=1, retries=2, api=self.api, bucket=bucket)
+        dx_file = uploader.new_file('test.tar.gz', 'project-xxxx', '/')
+
+        pu.upload_file_parts(self.path, dx_file, self.part_size, threads=1)
+
+        with self.subTest('parts not received'):
+            assert self.server.parts['/file-xxxx/1'][0] == b'a' * self.part_size
+            assert self.server.parts['/file-xxxx/2'][0] == b'b' * 10
+
+        with self.subTest('bytes sent not taken from bucket'):
+            # part 2 is sent twice, failing the first time
+            assert sum(taken) == self.part_size + 20
+
+
+    @patch('files.part_upload.time.sleep')
+    def test_part_fails_after_retries(self, _):
+        """
+        Test that a part failing more than the retries allowed raises
+        and the file is left open
+        """
+        uploader = pu.PartUploader(threads=1, retries=0, api=self.api)
+        dx_file = uploader.open_file('file-xxxx')
+
+        with self.assertRaises(requests.HTTPError):
+            pu.upload_file_parts(self.path, dx_file, self.part_size)
+
+        assert self.api.closed == []
+
+
+class TestPartHasher(unittest.TestCase):
+    """
+    Tests for part_upload.PartHasher
+
+    Hasher computes the md5 of each part of what is written through it
+    """
+    def test_parts_hashed_across_writes(self):
+        """
+        Test that writes spanning part boundaries give the md5 of each
+        part, and the sha256 of the whole
+        """
+        data = os.urandom(2500)
+        out = io.BytesIO()
+        hasher = pu.PartHasher(out, 1000, with_sha256=True)
+
+        for start in range(0, len(data), 333):
+            hasher.write(data[start:start + 333])
+        part_md5s, whole_sha256 = hasher.finish()
+
+        with self.subTest('data not written through'):
+            assert out.getvalue() == data
+
+        with self.subTest('wrong part md5s'):
+            assert part_md5s == [
+                md5(data[x:x + 1000]).hexdigest() for x in range(0, 2500, 1000)
+            ]
+
+        with self.subTest('wrong sha256'):
+            assert whole_sha256 == sha256(data).hexdigest()
+
+
+    def test_empty_file_has_one_part(self):
+        """Test that an empty file is hashed as a single empty part"""
+        hasher = pu.PartHasher(io.BytesIO(), 1000)
+
+        assert hasher.finish() == ([md5(b'').hexdigest()], None)
+
+
+    @patch('files.part_upload.get_uploaded_parts')
+    def test_mismatched_parts_found(self, mock_uploaded):
+        """
+        Test that parts missing, differing or beyond the last expected
+        on the platform are all found
+        """
+        mock_uploaded.return_value = ('open', {
+            1: {'md5': 'a'}, 2: {'md5': 'x'}, 4: {'md5': 'd'}
+        })
+
+        assert pu.find_mismatched_parts('file-xxxx', ['a', 'b', 'c']) == [2, 3, 4]
@@ -0,0 +1,70 @@
+import re
+import unittest
+
+from files import path_matcher as pm
+
+
+class TestPathMatcher(unittest.TestCase):
+    """
+    Tests for path_matcher.PathMatcher
+
+    Matcher tests a path against all patterns in one pass, with fast
+    paths for plain string patterns
+    """
+    patterns = [
+        'Images', 's_1_', 'SampleSheet.csv', r'\.cbcl$', r'L00[12]/C\d+\.1',
+        r'(?i)thumbnail', r'(_)\1', r'RunInfo\.xml\b', 'Images'
+    ]
+    paths = [
+        '/run/Thumbnail_Images/L001/C1.1/s_1_1101_a.jpg',
+        '/run/Data/Intensities/BaseCalls/L001/C12.1/L001_1.cbcl',
+        '/run/Data/Intensities/BaseCalls/L003/C12.1/L003_1.cbcl.tmp',
+        '/run/SampleSheet.csv', '/run/SampleSheetXcsv', '/run/RunInfo.xml',
+        '/run/RunInfo.xmlx', '/run/THUMBNAIL', '/run/a__b', '/run/Logs/a_b.log'
+    ]
+
+    def test_matches_same_as_re_search(self):
+        """
+        Test that every path matches exactly when re.search would find
+        one of the patterns in it
+        """
+        matcher = pm.PathMatcher(self.patterns)
+
+        for path in self.paths:
+            expected = any(re.search(pattern, path) for pattern in self.patterns)
+            with self.subTest('match differs from re.search', path=path):
+                assert matcher.matches(path) == expected
+
+
+    def test_plain_patterns_not_compiled(self):
+        """
+        Test that plain string and end anchored plain string patterns
+        use the fast paths, and that duplicates are removed
+        """
+        matcher = pm.PathMatcher(self.patterns)
+
+        with self.subTest('duplicate not removed'):
+            assert matcher.patterns.count('Images') == 1
+
+        with self.subTest('plain strings not found'):
+            assert matcher._all.substrings == ('Images', 's_1_')
+
+        with self.subTest('suffix not found'):
+            assert matcher._all.suffixes == ('.cbcl',)
+
+
+    def test_matches_below_only_for_prefix_safe_patterns(self):
+        """
+        Test that a directory is only excluded outright when a pattern
+        matching it is certain to match every path below it
+        """
+        matcher = pm.PathMatcher(['Images', r'RunInfo\b', r'Logs$'])
+
+        with self.subTest('excluded dir not pruned'):
+            assert matcher.matches_below('/run/Thumbnail_Images')
+
+        with self.subTest('end anchored pattern pruned dir'):
+            assert not matcher.matches_below('/run/Logs')
+
+        with self.subTest('word boundary pattern pruned dir'):
+            assert not matcher.matches_below('/run/RunInfo')
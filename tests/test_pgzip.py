@@ -0,0 +1,67 @@
+import gzip
+import io
+import tarfile
+import unittest
+
+from files import pgzip
+
+
+class TestParallelGzipWriter(unittest.TestCase):
+    """
+    Tests for pgzip.ParallelGzipWriter
+
+    Writer compresses blocks in parallel, and must still produce a
+    standard gzip stream
+    """
+    def test_round_trip(self):
+        """
+        Test that data spanning several blocks decompresses back to
+        the original bytes
+        """
+        data = bytes(range(256)) * 1000
+        out = io.BytesIO()
+
+        writer = pgzip.ParallelGzipWriter(out, threads=4, block_size=4096)
+        writer.write(data[:100])
+        writer.write(data[100:])
+        writer.close()
+
+        with self.subTest('data does not round trip'):
+            assert gzip.decompress(out.getvalue()) == data
+
+        with self.subTest('byte counts wrong'):
+            assert writer.bytes_in == len(data)
+            assert writer.bytes_out == len(out.getvalue())
+
+
+    def test_empty_stream_is_valid_gzip(self):
+        """
+        Test that closing without writing still gives a valid gzip stream
+        """
+        out = io.BytesIO()
+        pgzip.ParallelGzipWriter(out, threads=2).close()
+
+        assert gzip.decompress(out.getvalue()) == b''
+
+
+    def test_tar_readable(self):
+        """
+        Test that a tar stream written through the writer can be read
+        back with tarfile's gzip support
+        """
+        out = io.BytesIO()
+        writer = pgzip.ParallelGzipWriter(out, threads=2, block_size=1024)
+        tar_file = tarfile.open(fileobj=writer, mode='w|')
+
+        content = b'x' * 5000
+        info = tarfile.TarInfo('Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl')
+        info.size = len(content)
+        tar_file.addfile(info, io.BytesIO(content))
+        tar_file.close()
+        writer.close()
+
+        out.seek(0)
+        with tarfile.open(fileobj=out, mode='r:gz') as tar_file:
+            member = tar_file.extractfile(info.name).read()
+
+        assert member == content
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from files import reconcile as rc
+from files.path_matcher import PathMatcher
+
+
+class TestReconcile(unittest.TestCase):
+    """
+    Tests for reconcile.reconcile
+
+    Function compares a local run directory with the rows of the
+    manifests uploaded with its tar files
+    """
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.run_dir)
+
+        os.makedirs(os.path.join(self.run_dir, 'Data'))
+        os.makedirs(os.path.join(self.run_dir, 'Logs'))
+        self.manifest = {}
+        for name in ('RunInfo.xml', 'Data/a.cbcl', 'Data/b.cbcl', 'Logs/x.log'):
+            path = os.path.join(self.run_dir, name)
+            with open(path, 'wb') as fh:
+                fh.write(b'data')
+            os.utime(path, (1e9, 1e9))
+            self.manifest[name] = {
+                'path': name, 'size': 4, 'mtime': 1e9, 'tar_file_id': 'file-0000',
+                'md5': '8d777f385d3dfec8815d20f7496026dc'
+            }
+        self.manifest['Data'] = {'path': 'Data', 'size': 4096, 'mtime': 0.0,
+                                 'tar_file_id': 'file-0000', 'md5': None}
+        del self.manifest['Logs/x.log']
+
+
+    def test_matching_directory(self):
+        """
+        Test that nothing is found for a directory matching its
+        manifest, with excluded files and directory mtimes ignored
+        """
+        found = rc.reconcile(
+            self.run_dir, self.manifest, {'file-0000'}, PathMatcher(['Logs']),
+            check_md5=True
+        )
+
+        assert not any(found.values()), found
+
+
+    def test_discrepancies_found(self):
+        """
+        Test that each kind of discrepancy is found, with the md5 only
+        checked when asked for
+        """
+        with open(os.path.join(self.run_dir, 'Data/a.cbcl'), 'wb') as fh:
+            fh.write(b'more data')
+        with open(os.path.join(self.run_dir, 'Data/b.cbcl'), 'wb') as fh:
+            fh.write(b'diff')
+        os.utime(os.path.join(self.run_dir, 'Data/b.cbcl'), (1e9, 1e9))
+        os.remove(os.path.join(self.run_dir, 'RunInfo.xml'))
+        self.manifest['Data']['tar_file_id'] = 'file-1111'
+
+        found = rc.reconcile(self.run_dir, self.manifest, {'file-0000'},
+                             check_md5=True)
+        not_checked = rc.reconcile(self.run_dir, self.manifest, {'file-0000'})
+
+        with self.subTest('wrong discrepancies found'):
+            assert found == {
+                rc.MISSING: ['Logs', 'Logs/x.log'],
+                rc.CHANGED: ['Data/a.cbcl'],
+                rc.MD5_MISMATCH: ['Data/b.cbcl'],
+                rc.REMOTE_ONLY: ['RunInfo.xml'],
+                rc.TAR_MISSING: ['Data']
+            }
+
+        with self.subTest('md5 checked when not asked for'):
+            assert not_checked[rc.MD5_MISMATCH] == []
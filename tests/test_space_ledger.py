@@ -0,0 +1,141 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from files import space_ledger as sl
+
+
+MB = 2**20
+
+
+class TestSpaceLedger(unittest.TestCase):
+    """
+    Tests for space_ledger.SpaceLedger
+
+    Reservations shared through a ledger file are granted within the
+    free space on the disk and an optional budget, shrinking to what is
+    left or waiting for space
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, sl.LEDGER_FILE)
+        self.free = 100 * MB + sl.HEADROOM
+        self.now = 0
+        self.slept = []
+
+
+    def tearDown(self):
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+        os.rmdir(self.tmp_dir)
+
+
+    def make_ledger(self, budget=None):
+        def sleep(seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+
+        return sl.SpaceLedger(self.path, budget, clock=lambda: self.now, sleep=sleep,
+                              disk_free=lambda: self.free)
+
+
+    def test_reservations_shared_through_file(self):
+        """
+        Test that ledgers on the same file see each other's reservations,
+        so the second is shrunk to the space left and a third waits for
+        space until it gives up
+        """
+        first, second = self.make_ledger(), self.make_ledger()
+
+        with self.subTest('reservation not granted in full'):
+            assert first.reserve('a', 60 * MB, 10 * MB) == 60 * MB
+            assert not self.slept
+
+        with self.subTest('reservation not shrunk to space left'):
+            assert second.reserve('b', 60 * MB, 10 * MB) == 40 * MB
+
+        with self.subTest('reservation without space granted'):
+            with self.assertRaises(TimeoutError):
+                first.reserve('c', 20 * MB, 10 * MB, timeout=60)
+
+        with self.subTest('did not wait for space'):
+            assert sum(self.slept) >= 60
+
+        second.release('b')
+
+        with self.subTest('released space not granted'):
+            assert first.reserve('c', 20 * MB, 10 * MB) == 20 * MB
+            assert second.get_reserved() == {'a': 60 * MB, 'c': 20 * MB}
+
+
+    def test_written_space_not_counted_twice(self):
+        """
+        Test that the part of a reservation already written to its files,
+        which the free space already accounts for, is not taken off again
+        """
+        ledger = self.make_ledger()
+        tar_path = os.path.join(self.tmp_dir, 'run_000.tar')
+        ledger.reserve('a', 60 * MB, 60 * MB, paths=(tar_path,))
+
+        with open(tar_path, 'wb') as fh:
+            fh.truncate(50 * MB)
+        self.free -= 50 * MB
+
+        with self.subTest('written space counted twice'):
+            assert ledger.reserve('b', 60 * MB, 10 * MB) == 40 * MB
+
+
+    def test_budget_limits_reservations(self):
+        """
+        Test that reservations together are kept within the budget
+        """
+        ledger = self.make_ledger(budget=30 * MB)
+
+        with self.subTest('first reservation over budget'):
+            assert ledger.reserve('a', 60 * MB, 10 * MB) == 30 * MB
+
+        with self.subTest('second reservation over budget'):
+            with self.assertRaises(TimeoutError):
+                ledger.reserve('b', 10 * MB, 1 * MB, timeout=0)
+
+
+    def test_wait_ends_when_stopped(self):
+        """
+        Test that a reservation waiting for space gives up as soon as
+        it is stopped, without reserving anything
+        """
+        ledger = self.make_ledger()
+        ledger.reserve('a', 100 * MB, 100 * MB)
+        stop = threading.Event()
+        ledger.sleep = lambda seconds: stop.set()
+
+        with self.subTest('stopped reservation granted'):
+            assert ledger.reserve('b', 10 * MB, 10 * MB, stop=stop) == 0
+
+        with self.subTest('stopped reservation recorded'):
+            assert ledger.get_reserved() == {'a': 100 * MB}
+
+
+    def test_reservations_of_exited_processes_dropped(self):
+        """
+        Test that reservations held by a process which has exited are
+        dropped
+        """
+        process = subprocess.run(
+            [sys.executable, '-c', 'import os; print(os.getpid())'],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        )
+        with open(self.path, 'w') as fh:
+            fh.write('{"reservations": {"a": {"size": %d, "pid": %s, "paths": []}}}'
+                     % (100 * MB, process.stdout.strip()))
+
+        ledger = self.make_ledger()
+
+        with self.subTest('reservation of exited process kept'):
+            assert ledger.get_reserved() == {}
+
+        with self.subTest('space of exited process not granted'):
+            assert ledger.reserve('b', 100 * MB, 100 * MB) == 100 * MB
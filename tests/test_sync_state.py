@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from files import sync_state as ss
+from files import dx_sync_directory as dsd
+from tests.test_dx_sync_directory import make_args
+
+
+class TestSyncState(unittest.TestCase):
+    """
+    Tests for sync_state.SyncState
+
+    Store keeps the sync log in SQLite, committing only what changed
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sync_dir = '/data/run'
+        self.state = ss.SyncState(
+            os.path.join(self.tmp_dir, 'sync.log.db'), self.sync_dir
+        )
+        self.log = {
+            'sync_dir': self.sync_dir, 'tar_destination': 'project-xxxx:/runs',
+            'file_prefix': 'run', 'include_patterns': [], 'exclude_patterns': [],
+            'next_tar_index': 1,
+            'tar_files': {'/tmp/run_000.tar.gz': {'status': 'removed', 'file_id': 'file-1'}},
+            'files': {
+                '/data/run/RunInfo.xml': {'mtime': 10.0},
+                '/data/run/Data/L001/C1.1/L001_1.cbcl': {'mtime': 20.0, 'size': 5},
+                '/data/run/Data/L001/C1.1': {'mtime': 20.0}
+            }
+        }
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_import_export_round_trip(self):
+        """
+        Test that a JSON log imported into the store exports unchanged
+        """
+        self.state.import_log(json.loads(json.dumps(self.log)))
+
+        self.assertEqual(self.state.export_log(), self.log)
+
+
+    def test_paths_stored_relative_to_sync_dir(self):
+        """
+        Test that file paths are stored relative to the sync dir, with
+        each directory stored once
+        """
+        self.state.import_log(self.log)
+
+        dirs = sorted(
+            path for path, in self.state.conn.execute("SELECT path FROM dirs")
+        )
+
+        self.assertEqual(dirs, ['', 'Data/L001', 'Data/L001/C1.1'])
+
+
+    def test_updates_visible_before_and_after_commit(self):
+        """
+        Test that files set on the loaded log are seen straight away,
+        and are persisted by commit along with the changed tar entry
+        """
+        self.state.import_log(self.log)
+        log = self.state.load()
+
+        new_file = '/data/run/Data/L001/C2.1/L001_1.cbcl'
+        log['files'][new_file] = {'mtime': 30.0}
+        log['tar_files']['/tmp/run_001.tar.gz'] = {'status': 'tarred'}
+        log['next_tar_index'] = 2
+
+        with self.subTest('pending file not visible'):
+            self.assertIn(new_file, log['files'])
+            self.assertEqual(len(log['files']), 4)
+
+        self.state.commit(log)
+        reloaded = self.state.load()
+
+        with self.subTest('file not committed'):
+            self.assertEqual(reloaded['files'][new_file], {'mtime': 30.0})
+
+        with self.subTest('tar files not committed in order'):
+            self.assertEqual(
+                list(reloaded['tar_files']),
+                ['/tmp/run_000.tar.gz', '/tmp/run_001.tar.gz']
+            )
+
+        with self.subTest('meta not committed'):
+            self.assertEqual(reloaded['next_tar_index'], 2)
+
+        with self.subTest('unknown file found'):
+            self.assertNotIn('/data/run/Data/L002/C1.1/L002_1.cbcl', reloaded['files'])
+
+
+    def test_files_read_in_batches_stay_current(self):
+        """
+        Test that files committed after their directory, or a directory
+        read with it, was looked up are seen by later lookups
+        """
+        self.state.import_log(self.log)
+        log = self.state.load()
+        cycle_file = '/data/run/Data/L001/C1.1/L001_1.cbcl'
+        new_file = '/data/run/Data/L001/C2.1/L001_1.cbcl'
+
+        with self.subTest('file not found'):
+            self.assertEqual(log['files'].get(cycle_file), {'mtime': 20.0, 'size': 5})
+            self.assertIsNone(log['files'].get(new_file))
+
+        log['files'][cycle_file] = {'mtime': 25.0, 'size': 6}
+        log['files'][new_file] = {'mtime': 30.0}
+        self.state.commit(log)
+
+        with self.subTest('changed file not seen'):
+            self.assertEqual(log['files'][cycle_file], {'mtime': 25.0, 'size': 6})
+
+        with self.subTest('file in new directory not seen'):
+            self.assertEqual(log['files'][new_file], {'mtime': 30.0})
+
+
+class TestReadLog(unittest.TestCase):
+    """
+    Tests for dx_sync_directory.read_log and export_log
+
+    The log of a run started with a JSON log file is imported into the
+    state database, and written back out as JSON on --finish
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, 'run')
+        os.mkdir(self.run_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_json_log_imported_and_exported(self):
+        """
+        Test that an existing JSON log is imported, and that the export
+        matches it after an update
+        """
+        args = make_args(self.run_dir, self.tmp_dir)
+        json_log = {
+            'tar_files': {}, 'next_tar_index': 3,
+            'files': {os.path.join(self.run_dir, 'RunInfo.xml'): {'mtime': 1.0}},
+            'tar_destination': args.tar_destination, 'file_prefix': args.prefix,
+            'sync_dir': args.sync_dir, 'include_patterns': [], 'exclude_patterns': []
+        }
+        with open(args.log_file, 'w') as fh:
+            json.dump(json_log, fh)
+
+        log = dsd.read_log(args)
+
+        with self.subTest('database not created'):
+            self.assertTrue(os.path.exists(args.log_file + dsd.STATE_SUFFIX))
+
+        with self.subTest('files not imported'):
+            self.assertIn(os.path.join(self.run_dir, 'RunInfo.xml'), log['files'])
+
+        log['files'][os.path.join(self.run_dir, 'SampleSheet.csv')] = {'mtime': 2.0}
+        dsd.update_log(log, args)
+        dsd.export_log(args)
+
+        with open(args.log_file) as fh:
+            exported = json.load(fh)
+
+        json_log['files'][os.path.join(self.run_dir, 'SampleSheet.csv')] = {'mtime': 2.0}
+        self.assertEqual(exported, json_log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import gzip
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+
+from files import tar_codecs as tc
+
+
+class TestCompressionPolicy(unittest.TestCase):
+    """
+    Tests for tar_codecs.CompressionPolicy
+
+    Policy decides from the file path if a file is stored or compressed
+    """
+    def test_default_policy(self):
+        """
+        Test that the default policy stores CBCLs and compresses XML,
+        InterOp and unmatched files
+        """
+        policy = tc.CompressionPolicy()
+        run = '/runs/RUN_1/'
+
+        with self.subTest('CBCL not stored'):
+            assert policy.classify(
+                run + 'Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl'
+            )[1] == tc.STORE
+
+        with self.subTest('XML not compressed'):
+            assert policy.classify(run + 'RunInfo.xml')[1] == tc.COMPRESS
+
+        with self.subTest('InterOp not compressed'):
+            assert policy.classify(
+                run + 'InterOp/C1.1/ErrorMetricsOut.bin'
+            )[1] == tc.COMPRESS
+
+        with self.subTest('unmatched file not compressed'):
+            assert policy.classify(run + 'some.file') == (
+                tc.UNMATCHED, tc.COMPRESS
+            )
+
+
+    def test_load_invalid_action(self):
+        """
+        Test that loading a policy with an unknown action raises an error
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fh:
+            json.dump([[r'\.cbcl$', 'skip']], fh)
+            fh.flush()
+
+            with self.assertRaises(ValueError):
+                tc.CompressionPolicy.load(fh.name)
+
+
+class TestTarCompressor(unittest.TestCase):
+    """
+    Tests for tar_codecs.TarCompressor
+
+    Compressor switches between storing and compressing as each file
+    is added, and the output must be a standard compressed tar stream
+    """
+    members = {
+        'Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl': os.urandom(50000),
+        'RunInfo.xml': b'<RunInfo></RunInfo>' * 1000
+    }
+
+    def write_tar(self, codec):
+        out = io.BytesIO()
+        compressor = tc.TarCompressor(
+            out, codec, tc.DEFAULT_LEVELS.get(codec), threads=2,
+            policy=tc.CompressionPolicy()
+        )
+        tar_file = tarfile.open(fileobj=compressor.fileobj, mode='w')
+        for name, content in self.members.items():
+            compressor.start_file('/runs/RUN_1/' + name)
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar_file.addfile(info, io.BytesIO(content))
+        tar_file.close()
+        compressor.close()
+
+        return out.getvalue(), compressor
+
+
+    def read_members(self, data):
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r') as tar_file:
+            return {
+                m.name: tar_file.extractfile(m).read()
+                for m in tar_file.getmembers()
+            }
+
+
+    def test_gzip_round_trip_and_stats(self):
+        """
+        Test gzip output reads back and stats are recorded per pattern
+        """
+        data, compressor = self.write_tar('gzip')
+
+        with self.subTest('members do not round trip'):
+            assert self.read_members(gzip.decompress(data)) == self.members
+
+        with self.subTest('stats missing for patterns'):
+            assert r'\.cbcl$' in compressor.stats
+            assert r'\.xml$' in compressor.stats
+
+        with self.subTest('stored data not probed'):
+            assert compressor.stats[r'\.cbcl$']['probe_in'] > 0
+
+        with self.subTest('XML not compressed'):
+            xml_stats = compressor.stats[r'\.xml$']
+            assert xml_stats['bytes_out'] < xml_stats['bytes_in'] / 10
+
+
+    def test_none_codec_writes_plain_tar(self):
+        """
+        Test that the none codec writes an uncompressed tar
+        """
+        data, compressor = self.write_tar('none')
+
+        with self.subTest('members do not round trip'):
+            assert self.read_members(data) == self.members
+
+        with self.subTest('stats recorded without compression'):
+            assert compressor.stats == {}
+
+
+    @unittest.skipIf(tc.zstandard is None, 'zstandard not installed')
+    def test_zstd_round_trip(self):
+        """
+        Test zstd output of concatenated frames reads back
+        """
+        data, _ = self.write_tar('zstd')
+        reader = tc.zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True
+        )
+
+        assert self.read_members(reader.read()) == self.members
@@ -0,0 +1,124 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from files import dx_sync_directory as dsd
+from files import tar_codecs as tc
+from files import tar_index as ti
+from tests.test_dx_sync_directory import make_args, write_file
+
+
+class TestReadMember(unittest.TestCase):
+    """
+    Tests for tar_index.read_member
+
+    Function reads a single member of a tar file through its index,
+    reading only the (compressed) bytes covering the member's data
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, 'run')
+
+        # large enough to span blocks, mixing stored and compressed files
+        self.sizes = {
+            'RunInfo.xml': 1000,
+            'Data/C1.1/L001_1.cbcl': 3 * 2**20 + 17,
+            'Data/C1.1/empty.txt': 0,
+            'InterOp/metrics.bin': 2**20,
+            'Data/C2.1/L001_1.cbcl': 5
+        }
+        for name, size in self.sizes.items():
+            write_file(os.path.join(self.run_dir, name), size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, codec):
+        """Build a tar file of the run directory, returning its path and index"""
+        args = make_args(self.run_dir, self.tmp_dir, codec=codec)
+        tar_path = os.path.join(args.tar_directory, 'run_000' + tc.EXTENSIONS[codec])
+        files = [os.path.join(self.run_dir, 'Data')] + [
+            os.path.join(self.run_dir, name) for name in self.sizes
+        ]
+        dsd.build_tar_file({'size': sum(self.sizes.values()), 'files': files},
+                           tar_path, args)
+
+        with open(ti.get_index_path(tar_path), 'rb') as fh:
+            return tar_path, ti.TarIndex.read(io.BytesIO(fh.read()))
+
+    def check_members(self, codec):
+        tar_path, index = self.build(codec)
+        with open(tar_path, 'rb') as fh:
+            tar_data = fh.read()
+
+        read = []
+        def read_range(start, end):
+            read.append(end - start)
+            return tar_data[start:end]
+
+        for name, size in self.sizes.items():
+            with open(os.path.join(self.run_dir, name), 'rb') as fh:
+                data = fh.read()
+
+            with self.subTest('wrong data read', codec=codec, name=name):
+                assert ti.read_member(index, name, read_range) == data
+
+            # random data barely compresses, so at most a block either
+            # side of the member is read
+            with self.subTest('more than the member\'s blocks read', codec=codec, name=name):
+                assert sum(read) <= size + 2 * (tc.DEFAULT_BLOCK_SIZE + 1024)
+            read.clear()
+
+        return index
+
+
+    def test_uncompressed_members_read(self):
+        """
+        Test that each file is read back from an uncompressed tar file,
+        at the header offset recorded
+        """
+        index = self.check_members('none')
+
+        tar_path = os.path.join(self.tmp_dir, 'tars', 'run_000.tar')
+        with tarfile.open(tar_path) as tar_file:
+            offsets = dict((member.name, member.offset) for member in tar_file.getmembers())
+
+        with self.subTest('wrong header offsets'):
+            assert dict((name, header) for name, header, _, _ in index.members) == offsets
+
+
+    def test_gzip_members_read(self):
+        """
+        Test that each file is read back from a gzipped tar file by
+        decompressing only the blocks covering it
+        """
+        index = self.check_members('gzip')
+
+        with self.subTest('blocks not recorded'):
+            assert len(index.blocks) > 4
+
+
+    @unittest.skipIf(tc.zstandard is None, 'zstandard not installed')
+    def test_zstd_members_read(self):
+        """
+        Test that each file is read back from a zstd tar file by
+        decompressing only the frames covering it
+        """
+        self.check_members('zstd')
+
+
+    def test_directory_has_no_data(self):
+        """
+        Test that a directory is indexed without data
+        """
+        _, index = self.build('gzip')
+
+        with self.subTest('directory has data'):
+            assert index.get_member('Data')[2:] == [None, 0]
+
+        with self.subTest('read of directory did not fail'):
+            with self.assertRaises(ValueError):
+                index.get_range('Data')
@@ -0,0 +1,55 @@
+import unittest
+
+from files import tar_packing as tp
+
+
+class TestPackBalanced(unittest.TestCase):
+    """
+    Tests for tar_packing.pack_balanced
+
+    Function packs files into near equal tar files, keeping the files
+    in each directory together where they fit
+    """
+    def test_large_directory_cut_into_near_equal_pieces(self):
+        """
+        Test that a directory too large for one tar file is cut into
+        near equal pieces, with the directory entry leading the first
+        """
+        files = [('/run/C1.1', 0, True)] + [
+            ('/run/C1.1/%d.cbcl' % x, 10, False) for x in range(9)
+        ]
+
+        tars, held_back = tp.pack_balanced(files, 40, 0, True)
+
+        with self.subTest('files held back when finishing'):
+            assert held_back == []
+
+        with self.subTest('pieces not near equal'):
+            assert [len(tar) for tar in tars] == [4, 3, 3]
+
+        with self.subTest('scan order not kept'):
+            assert [path for tar in tars for path in tar] == [x[0] for x in files]
+
+
+    def test_file_larger_than_max_size_packed(self):
+        """
+        Test that a single file larger than the maximum size is packed
+        in a tar file of its own rather than lost
+        """
+        files = [('/run/a/big', 100, False), ('/run/b/small', 5, False)]
+
+        tars, held_back = tp.pack_balanced(files, 40, 10, False)
+
+        with self.subTest('file lost'):
+            assert sorted(path for tar in tars + [held_back] for path in tar) == \
+                ['/run/a/big', '/run/b/small']
+
+        with self.subTest('big file shares a tar file'):
+            assert ['/run/a/big'] in tars
+
+
+    def test_sequential_matches_previous_split(self):
+        """Test that sequential packing fills each tar file in turn"""
+        files = [('/run/%d' % x, size, False) for x, size in enumerate([30, 20, 25, 5])]
+
+        assert tp.pack_sequential(files, 50) == [['/run/0', '/run/1'], ['/run/2', '/run/3']]
@@ -0,0 +1,80 @@
+import unittest
+
+from files import upload_control as uc
+
+
+MB = 2**20
+
+
+class TestUploadController(unittest.TestCase):
+    """
+    Tests for upload_control.UploadController
+
+    Controller adjusts the threads and part size from the throughput
+    of each window of parts and the errors hit
+    """
+    def setUp(self):
+        self.now = 0.0
+        self.controller = uc.UploadController(
+            2, 10 * MB, max_threads=3, max_part_size=15 * MB, min_part_size=5 * MB,
+            clock=lambda: self.now
+        )
+
+
+    def send_window(self, rate):
+        """Complete a window of parts at rate MB/s"""
+        for _ in range(self.controller.threads):
+            self.now += 1.0 / self.controller.threads
+            self.controller.record_part(rate * MB / self.controller.threads, 1.0)
+
+
+    def test_increase_then_take_back(self):
+        """
+        Test that threads are added up to the maximum, then the part
+        size is stepped up, and an increase that slows uploads down is
+        taken back
+        """
+        self.send_window(10)
+        with self.subTest('thread not added'):
+            assert (self.controller.threads, self.controller.part_size) == (3, 10 * MB)
+
+        self.send_window(12)
+        with self.subTest('part size not stepped'):
+            assert (self.controller.threads, self.controller.part_size) == (3, 15 * MB)
+
+        self.send_window(5)
+        with self.subTest('slower increase not taken back'):
+            assert (self.controller.threads, self.controller.part_size) == (3, 10 * MB)
+
+
+    def test_congestion_halves_once_a_window(self):
+        """
+        Test that throttling halves the threads and part size, only
+        once for the errors in a window, and that other client errors
+        are not taken as congestion
+        """
+        self.controller.record_error(404)
+        with self.subTest('client error taken as congestion'):
+            assert self.controller.decisions == 0
+
+        self.controller.record_error(429)
+        self.controller.record_error(None)
+
+        with self.subTest('not halved once'):
+            assert (self.controller.threads, self.controller.part_size) == (1, 5 * MB)
+            assert self.controller.decisions == 1
+
+        self.send_window(10)
+        with self.subTest('increased in the window halved'):
+            assert self.controller.threads == 1
+
+        self.send_window(10)
+        with self.subTest('not increased after'):
+            assert self.controller.threads == 2
+
+
+    def test_state_carried_over_within_bounds(self):
+        """Test that a state from an earlier invocation is kept in bounds"""
+        self.controller.set_state({'threads': 10, 'part_size': 1})
+
+        assert self.controller.get_state() == {'threads': 3, 'part_size': 5 * MB}